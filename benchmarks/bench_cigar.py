@@ -0,0 +1,95 @@
+import sys
+import os
+import random
+import time
+import regex
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','core'))
+from cigar_utils import as_cigartuples
+from find_primer import endogenous_seq_match
+from find_gene import return_read_end_pos
+
+'''
+Compare the CIGAR checks of find_primer and find_gene , now walking the CIGAR
+operations with cigar_utils , against the previous implementations expanding the
+CIGAR string to a list of one character per base , on random STAR like CIGARs.
+The new checks are timed on the CIGAR strings and on pysam like cigartuples ,
+as count_umi.read_tuples yields them.
+
+Usage : python bench_cigar.py [reads] [seed]
+'''
+
+PATTERN = regex.compile('([0-9]+)([A-Z])')
+
+def endogenous_seq_match_expanded(cigar,primer_len,read_is_reverse,num_flanking_bases=30,cigars_to_ignore=['N','D','H','P']):
+    ''' The previous find_primer.endogenous_seq_match
+    :rtype bool
+    '''
+    expanded_cigar = []
+    for num_bases,cigar_char in regex.findall(PATTERN,cigar):
+        if cigar_char in cigars_to_ignore:
+            continue
+        else:
+            expanded_cigar.extend(cigar_char*int(num_bases))
+    if read_is_reverse:
+        cigar_to_search = expanded_cigar[-(primer_len+num_flanking_bases):-(primer_len+1)]
+    else:
+        cigar_to_search = expanded_cigar[primer_len:(primer_len+num_flanking_bases+1)]
+    return (cigar_to_search.count('M') >= 25)
+
+def return_read_end_pos_regex(read_pos,cigar,flag=False,cigars_to_ignore=['I','S','H','P']):
+    ''' The previous find_gene.return_read_end_pos
+    :rtype int
+    '''
+    bases=0
+    if flag:
+        cigars_to_ignore = ['S','I','H','P','N']
+    for num_bases,cigar_char in regex.findall(PATTERN,cigar):
+        if cigar_char in cigars_to_ignore:
+            continue
+        else:
+            bases+=int(num_bases)
+    return read_pos+bases
+
+def random_cigar(rng):
+    ''' A CIGAR string of a spliced , clipped read , with small indels and a few rarer operations
+    :rtype str
+    '''
+    ops = []
+    if rng.random() < 0.3:
+        ops.append((rng.randint(1,30),'S'))
+    for i in xrange(rng.choice([1,1,1,2,3])):
+        if i:
+            ops.append((rng.randint(50,5000),'N'))
+        ops.append((rng.randint(5,80),'M'))
+        if rng.random() < 0.2:
+            ops.append((rng.randint(1,3),rng.choice('IDX=')))
+            ops.append((rng.randint(5,60),'M'))
+    if rng.random() < 0.3:
+        ops.append((rng.randint(1,30),'S'))
+    return "".join("{}{}".format(n,op) for n,op in ops)
+
+def timed(func,cases):
+    start = time.time()
+    results = [func(*case) for case in cases]
+    return (results,time.time()-start)
+
+if __name__ == '__main__':
+    nreads = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    rng = random.Random(seed)
+    cigars = [random_cigar(rng) for i in xrange(nreads)]
+    tuples = [as_cigartuples(cigar) for cigar in cigars]
+    primer_lens = [rng.randint(18,30) for i in xrange(nreads)]
+    strands = [rng.random() < 0.5 for i in xrange(nreads)]
+    positions = [rng.randint(0,10**8) for i in xrange(nreads)]
+    print "Reads : {}".format(nreads)
+    for name,old,new,args in [
+            ("endogenous_seq_match",endogenous_seq_match_expanded,endogenous_seq_match,lambda c,i:(c,primer_lens[i],strands[i])),
+            ("return_read_end_pos",return_read_end_pos_regex,return_read_end_pos,lambda c,i:(positions[i],c,strands[i]))]:
+        expected,t_old = timed(old,[args(c,i) for i,c in enumerate(cigars)])
+        from_strings,t_strings = timed(new,[args(c,i) for i,c in enumerate(cigars)])
+        from_tuples,t_tuples = timed(new,[args(c,i) for i,c in enumerate(tuples)])
+        assert expected == from_strings == from_tuples, "{} disagrees with the previous implementation".format(name)
+        print "{n:<21}: previous {a:.2f} s ; cigar_utils , strings {b:.2f} s ({sb:.1f}x) , cigartuples {c:.2f} s ({sc:.1f}x)".format(
+            n=name,a=t_old,b=t_strings,sb=t_old/t_strings,c=t_tuples,sc=t_old/t_tuples)
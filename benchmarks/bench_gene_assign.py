@@ -0,0 +1,57 @@
+import sys
+import os
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','core'))
+from create_annotation_tables import create_gene_index
+from find_gene import find_gene
+from gene_index import assign_genes,UNMAPPED,UNKNOWN,UNKNOWN_CHROM
+from count_umi import iterate_bam_reads,read_slice,read_tuples,BYTES_PER_TARGETED_READ,BUFFER_BYTES_PER_READ
+
+'''
+Compare the vectorised gene assignment (gene_index.assign_genes) against
+the per read find_gene calls it replaced , on an aligned , UMI tagged bam
+
+Usage : python bench_gene_assign.py annotation.gtf ercc.bed species Aligned.sortedByCoord.out.bam [max_reads]
+'''
+
+## find_gene result for each assign_genes code
+CODE_NAMES = {UNMAPPED:'Unmapped',UNKNOWN:'Unknown',UNKNOWN_CHROM:'Unknown_Chrom'}
+
+def benchmark(annotation_gtf,ercc_bed,species,bam,max_reads):
+    ''' Time both implementations on the same reads and check that they agree
+    :param str annotation_gtf: the gtf file
+    :param str ercc_bed: the ERCC bed file
+    :param str species: species name
+    :param str bam: the aligned bam
+    :param int max_reads: number of reads to use
+    '''
+    gene_index = create_gene_index(annotation_gtf,ercc_bed,species)
+    ## the umi column is sized for 16 bases , the chunk ends early on reads longer than the buffers allow for
+    chunk = next(iterate_bam_reads(bam,chunk_bytes=max_reads*(BYTES_PER_TARGETED_READ+16+BUFFER_BYTES_PER_READ)))
+    reads = list(read_tuples(read_slice(chunk,0,len(chunk.tid))))
+
+    start = time.time()
+    expected = [find_gene(gene_index,read) for read in reads]
+    t_find_gene = time.time() - start
+
+    start = time.time()
+    codes,ercc = assign_genes(gene_index,chunk.ref_names,chunk.tid,chunk.pos,chunk.pos+chunk.alen,chunk.is_reverse)
+    t_assign = time.time() - start
+
+    mismatches = 0
+    for (gene_info,mt,count,nh),code,is_ercc in zip(expected,codes.tolist(),ercc.tolist()):
+        observed = CODE_NAMES[code] if code < 0 else gene_index.genes[code]
+        observed_count = 0 if code < 0 or is_ercc else 1
+        if gene_info != observed or count != observed_count:
+            mismatches += 1
+    nreads = len(reads)
+    print "Reads : {}".format(nreads)
+    print "Disagreements : {}".format(mismatches)
+    print "find_gene per read : {t:.3f} s ({r:.0f} reads/s)".format(t=t_find_gene,r=nreads/t_find_gene)
+    print "assign_genes       : {t:.3f} s ({r:.0f} reads/s)".format(t=t_assign,r=nreads/t_assign)
+    print "Speedup : {:.1f}x".format(t_find_gene/t_assign)
+
+if __name__ == '__main__':
+    max_reads = int(sys.argv[5]) if len(sys.argv) > 5 else 1000000
+    benchmark(sys.argv[1],sys.argv[2],sys.argv[3],sys.argv[4],max_reads)
@@ -0,0 +1,95 @@
+import sys
+import os
+import random
+import time
+import regex
+from Bio.Seq import Seq
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','core'))
+from primer_match import PrimerMatcher
+
+'''
+Compare the fuzzy regular expressions count_umi compiled for the primers against
+primer_match.PrimerMatcher , on a synthetic panel of primers and reads starting
+(or ending , for - strand primers) with a primer carrying 0 to 5 random edits.
+Each read is checked against its primer and a decoy , as for overlapping primers.
+
+Both the time to build the matchers of the panel and the time to match the reads
+are reported. The regex module does not try every alignment when matching fuzzily ,
+so it misses a few reads with 3 edits that match the constraints ; those are reported
+, and a read matched by a regex but not by its PrimerMatcher fails the benchmark.
+
+Usage : python bench_primer_match.py [primers] [reads] [seed]
+'''
+
+FORWARD = r'^(%s){d<=2,i<=2,s<=2,1d+1i+1s<=3}[ACGTN]*$'
+REVERSE = r'^[ACGTN]*(%s){d<=2,i<=2,s<=2,1d+1i+1s<=3}$'
+
+def random_seq(rng,length,bases="ACGT"):
+    return "".join(rng.choice(bases) for i in xrange(length))
+
+def mutate(rng,seq,edits):
+    ''' Apply random substitutions , insertions and deletions to a sequence
+    :rtype str
+    '''
+    seq = list(seq)
+    for i in xrange(edits):
+        kind = rng.choice("sid")
+        if kind == "s":
+            seq[rng.randrange(len(seq))] = rng.choice("ACGTN")
+        elif kind == "i":
+            seq.insert(rng.randrange(len(seq)+1),rng.choice("ACGT"))
+        else:
+            del seq[rng.randrange(len(seq))]
+    return "".join(seq)
+
+def synthetic_panel(nprimers,nreads,seed=0):
+    ''' A panel of primers , and reads from them
+    :returns (list of (primer seq , on - strand) , list of (read , primer number , decoy primer number))
+    :rtype tuple
+    '''
+    rng = random.Random(seed)
+    primers = [(random_seq(rng,rng.randint(18,30)),rng.random() < 0.5) for i in xrange(nprimers)]
+    reads = []
+    for i in xrange(nreads):
+        k = rng.randrange(nprimers)
+        seq,reverse = primers[k]
+        primed = mutate(rng,str(Seq(seq).reverse_complement()) if reverse else seq,rng.choice([0,0,0,1,1,2,3,4,5]))
+        rest = random_seq(rng,rng.randint(80,120),"ACGTN")
+        reads.append((rest+primed if reverse else primed+rest,k,rng.randrange(nprimers)))
+    return (primers,reads)
+
+def build_regex(primers):
+    return [regex.compile(REVERSE%str(Seq(seq).reverse_complement()) if reverse else FORWARD%seq) for seq,reverse in primers]
+
+def build_matchers(primers):
+    return [PrimerMatcher(seq,reverse) for seq,reverse in primers]
+
+def match_regex(expressions,reads):
+    return [(bool(expressions[k].match(read)),bool(expressions[d].match(read))) for read,k,d in reads]
+
+def match_matchers(matchers,reads):
+    return [(matchers[k].match(read),matchers[d].match(read)) for read,k,d in reads]
+
+def timed(func,*args):
+    start = time.time()
+    result = func(*args)
+    return (result,time.time()-start)
+
+if __name__ == '__main__':
+    nprimers = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    nreads = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    primers,reads = synthetic_panel(nprimers,nreads,seed)
+    print "Primers : {p} ; reads : {r} , each checked against 2 primers".format(p=nprimers,r=nreads)
+    expressions,t_compile = timed(build_regex,primers)
+    matchers,t_build = timed(build_matchers,primers)
+    print "Build  , regex : {a:.2f} s ; PrimerMatcher : {b:.2f} s".format(a=t_compile,b=t_build)
+    regex_results,t_regex = timed(match_regex,expressions,reads)
+    matcher_results,t_matcher = timed(match_matchers,matchers,reads)
+    print "Match  , regex : {a:.2f} s ({ra:.0f} reads/s) ; PrimerMatcher : {b:.2f} s ({rb:.0f} reads/s) ; speedup {s:.1f}x".format(
+        a=t_regex,ra=nreads/t_regex,b=t_matcher,rb=nreads/t_matcher,s=t_regex/t_matcher)
+    checks = [(a,b) for ra,rb in zip(regex_results,matcher_results) for a,b in zip(ra,rb)]
+    print "Matches , regex : {a} ; PrimerMatcher : {b} ; missed by the regex : {m}".format(
+        a=sum(a for a,b in checks),b=sum(b for a,b in checks),m=sum(b and not a for a,b in checks))
+    assert not any(a and not b for a,b in checks), "A regex match was not found by PrimerMatcher"
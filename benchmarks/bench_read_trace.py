@@ -0,0 +1,49 @@
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','core'))
+import pysam
+from create_annotation_tables import create_gene_hash
+from count_umi import count_umis
+
+'''
+Targeted UMI counting throughput with read tracing off (the counts of each
+outcome only) , sampled and full , on an aligned , UMI tagged bam of a cell.
+The size of the log written by each run is reported , full tracing writes about
+a line per read as the per read logging did before read_trace.
+
+Usage : python bench_read_trace.py annotation.gtf ercc.bed primers.txt Aligned.sortedByCoord.out.bam [cores] [every]
+'''
+
+def run(gene_hash,primer_bed,bam,cores,trace,work_dir):
+    ''' Count the UMIs of the bam with a trace spec
+    :returns (seconds , log size in bytes)
+    :rtype tuple
+    '''
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    logfile = os.path.join(out_dir,'log.txt')
+    start = time.time()
+    count_umis(gene_hash,primer_bed,bam,os.path.join(out_dir,'umi_count.primers.txt'),
+               os.path.join(out_dir,'umi_count.txt'),os.path.join(out_dir,'read_stats.txt'),
+               logfile,cores,trace=trace)
+    return (time.time()-start,os.path.getsize(logfile))
+
+if __name__ == '__main__':
+    annotation_gtf,ercc_bed,primer_bed,bam = sys.argv[1:5]
+    cores = int(sys.argv[5]) if len(sys.argv) > 5 else 3
+    every = int(sys.argv[6]) if len(sys.argv) > 6 else 100
+    gene_hash = create_gene_hash(annotation_gtf,ercc_bed)
+    nreads = sum(1 for read in pysam.AlignmentFile(bam,'rb').fetch(until_eof=True))
+    work_dir = tempfile.mkdtemp()
+    try:
+        run(gene_hash,primer_bed,bam,cores,None,work_dir) ## start the pool and read the primers once
+        print "Reads : {}".format(nreads)
+        for name,trace in [('off',None),('sampled','every={}'.format(every)),('full','all')]:
+            seconds,log_size = run(gene_hash,primer_bed,bam,cores,trace,work_dir)
+            print "Tracing {n:<8}: {t:.2f} s ({r:.0f} reads/s) , log {l:.1f} KB".format(
+                n=name,t=seconds,r=nreads/seconds,l=log_size/1024.0)
+    finally:
+        shutil.rmtree(work_dir)
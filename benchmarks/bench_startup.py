@@ -0,0 +1,107 @@
+import sys
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+
+'''
+Time the startup of the luigi pipeline module : importing single_cell_rnaseq ,
+and building the task graph of WriteExcelSheet (instantiating every task and
+calling requires() , as the scheduler does) for a synthetic run , with the
+annotation gtf and the cell index file generated here.
+
+Each tree is measured in a fresh interpreter , so another checkout (e.g. a
+git worktree of an older commit) can be compared against this one.
+
+Usage : python bench_startup.py [samples] [cells] [genes] [repo_dir ...]
+'''
+
+## Run in the child interpreter , prints the timings
+CHILD = r'''
+import sys,time,luigi
+from luigi.task import flatten
+start = time.time()
+import single_cell_rnaseq as pipeline
+t_import = time.time() - start
+modules = len([m for m in sys.modules if sys.modules[m] is not None])
+heavy = [m for m in ['pysam','pyximport','pathos','xlsxwriter','Bio','guppy'] if m in sys.modules]
+start = time.time()
+root = pipeline.WriteExcelSheet(output_dir=sys.argv[1],samples_cfg=sys.argv[2],cell_index_file=sys.argv[3],
+                                vector_sequence="AAGCAGTGGTATCAACGCAGAGTAC",isolator="ACG",mt_len=12,
+                                num_cores=1,num_errors=3)
+seen = set([root.task_id])
+queue = [root]
+while queue:
+    for task in flatten(queue.pop().requires()):
+        if task.task_id not in seen:
+            seen.add(task.task_id)
+            queue.append(task)
+t_graph = time.time() - start
+print "{ti:.3f} {m} {tg:.3f} {n} {h}".format(ti=t_import,m=modules,tg=t_graph,n=len(seen),h=",".join(heavy) or "-")
+'''
+
+def write_inputs(work_dir,nsamples,ncells,ngenes,seed=0):
+    ''' The cell index file , samples config , annotation and luigi config of a synthetic run
+    :param str work_dir: the directory to write to
+    :param int nsamples: number of samples
+    :param int ncells: number of cell indices
+    :param int ngenes: number of genes in the gtf
+    :param int seed: the random seed
+    :returns (luigi config , samples config , cell index file)
+    :rtype tuple
+    '''
+    rng = random.Random(seed)
+    cell_index_file = os.path.join(work_dir,"cell_indices.txt")
+    with open(cell_index_file,'w') as OUT:
+        for i in xrange(ncells):
+            OUT.write("".join(rng.choice("ACGT") for j in xrange(10))+"\n")
+    samples_cfg = os.path.join(work_dir,"samples.cfg")
+    with open(samples_cfg,'w') as OUT:
+        for i in xrange(nsamples):
+            OUT.write("[S{i}]\nR1_fastq = S{i}_R1.fastq.gz\nR2_fastq = S{i}_R2.fastq.gz\nInstrument = NextSeq\n\n".format(i=i+1))
+    gtf = os.path.join(work_dir,"genes.gtf")
+    with open(gtf,'w') as OUT:
+        for i in xrange(ngenes):
+            start = rng.randint(1,10**8)
+            OUT.write('chr{c}\tensembl\tgene\t{s}\t{e}\t.\t{st}\t.\tgene_id "ENSG{i:011d}"; gene_version "1"; '
+                      'gene_name "G{i}"; gene_source "ensembl"; gene_biotype "protein_coding";\n'.format(
+                          c=rng.randint(1,22),s=start,e=start+rng.randint(100,50000),st=rng.choice("+-"),i=i))
+    ercc_bed = os.path.join(work_dir,"ercc.bed")
+    with open(ercc_bed,'w') as OUT:
+        OUT.write("ERCC-00002\t0\t1061\tNNNN\t+\tERCC-00002\n")
+    luigi_cfg = os.path.join(work_dir,"pipeline.cfg")
+    with open(luigi_cfg,'w') as OUT:
+        OUT.write("[config]\nstar = STAR\nstar_params = --runMode alignReads\nstar_load_params = --genomeLoad LoadAndExit\n"
+                  "genome_dir = genome\nseqtype = wts\nprimer_file =\nannotation_gtf = {gtf}\nercc_bed = {bed}\n"
+                  "is_low_input = 1\ncatalog_number = polyA-human\nspecies = human\neditdist = 1\n"
+                  "cell_indices_used = all\n".format(gtf=gtf,bed=ercc_bed))
+    return (luigi_cfg,samples_cfg,cell_index_file)
+
+def measure(repo_dir,work_dir,luigi_cfg,samples_cfg,cell_index_file):
+    ''' Time the startup of the pipeline module of a tree , in a fresh interpreter
+    :returns (import seconds , modules loaded , task graph seconds , tasks , heavy modules imported)
+    :rtype tuple
+    '''
+    output_dir = tempfile.mkdtemp(dir=work_dir)
+    env = dict(os.environ,LUIGI_CONFIG_PATH=luigi_cfg,PYTHONPATH=repo_dir)
+    out = subprocess.check_output([sys.executable,"-c",CHILD,output_dir,samples_cfg,cell_index_file],
+                                  env=env,cwd=work_dir,stderr=open(os.devnull,'w'))
+    t_import,modules,t_graph,tasks,heavy = out.strip().split('\n')[-1].split()
+    return (float(t_import),int(modules),float(t_graph),int(tasks),heavy)
+
+if __name__ == '__main__':
+    nsamples = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    ncells = int(sys.argv[2]) if len(sys.argv) > 2 else 96
+    ngenes = int(sys.argv[3]) if len(sys.argv) > 3 else 60000
+    repo_dirs = sys.argv[4:] or [os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')]
+    work_dir = tempfile.mkdtemp()
+    try:
+        luigi_cfg,samples_cfg,cell_index_file = write_inputs(work_dir,nsamples,ncells,ngenes)
+        for repo_dir in repo_dirs:
+            repo_dir = os.path.abspath(repo_dir)
+            t_import,modules,t_graph,tasks,heavy = measure(repo_dir,work_dir,luigi_cfg,samples_cfg,cell_index_file)
+            print "{r}\n  import : {ti:.3f} s , {m} modules , heavy modules : {h}".format(r=repo_dir,ti=t_import,m=modules,h=heavy)
+            print "  task graph : {n} tasks in {tg:.3f} s".format(n=tasks,tg=t_graph)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,216 @@
+import sys
+import os
+import argparse
+import datetime
+import json
+import platform
+import shutil
+import subprocess
+from collections import OrderedDict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(BENCH_DIR,'..','core'))
+import synthetic_data
+from profiling import usage,usage_delta
+
+'''
+End to end benchmarks of the pipeline stages on synthetic data (see synthetic_data.py) :
+    demux   demultiplex_cells.demux of the paired fastqs into cell fastqs
+    count   count_umi.count_umis_wts_by_cell of the sample BAM into the count file of each cell
+    merge   merge_count_files of the cell count files of the sample , as JoinCountFiles ,
+            then combine_count_files , as CombineSamples
+    excel   write_excel_workbook of the combined counts , as WriteExcelSheet
+at scales of 1M , 10M and 100M reads (any number of reads , e.g. 200k , can be given).
+
+The data of a scale is generated once in the data directory and reused. Each scenario runs in
+its own process , after the scenarios it depends on. Its reads/s , CPU time and peak RSS , of
+the process and of its largest worker , are appended to a JSON history with the git commit ,
+and compared to the previous run of the scenario and scale on this host.
+
+Usage : python bench_suite.py [--scales 1M,10M,100M] [--scenarios demux,count,merge,excel]
+                              [--data-dir DIR] [--history FILE] [--cores 4] [--buffer-size 16] [--seed 0]
+'''
+
+SCENARIOS = ['demux','count','merge','excel']
+DEPENDS = {'merge':'count','excel':'merge'}
+SAMPLE = 'Sample1'
+
+def parse_scale(scale):
+    ''' The number of reads of a scale
+    :param str scale: e.g. 1M , 200k or 5000
+    :rtype int
+    '''
+    units = {'K':10**3,'M':10**6,'G':10**9}
+    scale = scale.strip().upper()
+    if scale[-1] in units:
+        return int(float(scale[:-1])*units[scale[-1]])
+    return int(scale)
+
+def git_commit():
+    ''' The commit of the code benchmarked , None outside of a git checkout
+    :rtype str
+    '''
+    try:
+        with open(os.devnull,'w') as NULL:
+            return subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=BENCH_DIR,stderr=NULL).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def run_paths(data,work_dir):
+    ''' The outputs of the scenarios , laid out as a run directory
+    :param dict data: see synthetic_data.generate
+    :param str work_dir: the run directory
+    :rtype dict
+    '''
+    primary_dir = os.path.join(work_dir,'primary_analysis')
+    return {'demux_dir':os.path.join(work_dir,'demux'),
+            'primary_dir':primary_dir,
+            'sample_dir':os.path.join(primary_dir,SAMPLE),
+            'sample_counts':os.path.join(primary_dir,SAMPLE,SAMPLE+'.umi_counts.txt'),
+            'combined_counts':os.path.join(primary_dir,'synthetic.umi_counts.gene.txt'),
+            'workbook':os.path.join(primary_dir,'QIAseqUltraplexRNA_synthetic.xlsx')}
+
+def run_scenario(scenario,data,work_dir,cores,buffer_size):
+    ''' Run a scenario on the synthetic data
+    :param str scenario: one of SCENARIOS
+    :param dict data: see synthetic_data.generate
+    :param str work_dir: the run directory holding the outputs
+    :param int cores: the number of cores
+    :param int buffer_size: demux only , MB read for each read pair for each core
+    '''
+    paths,settings = data['paths'],data['settings']
+    out = run_paths(data,work_dir)
+    if scenario == 'demux':
+        from demultiplex_cells import demux
+        if os.path.exists(out['demux_dir']):
+            shutil.rmtree(out['demux_dir'])
+        os.makedirs(out['demux_dir'])
+        demux(paths['r1'],paths['r2'],paths['cell_index_file'],out['demux_dir'],
+              os.path.join(out['demux_dir'],'read_stats.txt'),'all',settings['vector'],settings['instrument'],
+              settings['wts'],True,settings['cell_index_len'],settings['mt_len'],1,3,cores,buffer_size,
+              os.path.join(out['demux_dir'],'log.txt'))
+    elif scenario == 'count':
+        from count_umi import count_umis_wts_by_cell
+        from create_annotation_tables import create_gene_index
+        from fastq_io import read_cell_index_file
+        gene_index = create_gene_index(paths['gtf'],paths['ercc_bed'],'human')
+        outputs = {}
+        for cell_index,cell_num in read_cell_index_file(paths['cell_index_file'],'all').items():
+            cell_dir = os.path.join(out['sample_dir'],'Cell{n}_{c}'.format(n=cell_num,c=cell_index))
+            if not os.path.exists(cell_dir):
+                os.makedirs(cell_dir)
+            outputs[cell_index] = (os.path.join(cell_dir,'umi_count.txt'),os.path.join(cell_dir,'read_stats.txt'))
+        count_umis_wts_by_cell(gene_index,paths['bam'],outputs,os.path.join(out['sample_dir'],'count_log.txt'),cores)
+    elif scenario == 'merge':
+        import glob
+        from combine_cell_results import merge_count_files
+        from combine_sample_results import combine_count_files
+        files_to_merge = glob.glob(os.path.join(out['sample_dir'],'*/umi_count.txt'))
+        merge_count_files(out['sample_dir'],out['sample_counts'],SAMPLE,True,settings['cells'],files_to_merge)
+        combine_count_files(glob.glob(os.path.join(out['primary_dir'],'*/*/umi_count.txt')),out['combined_counts'],True)
+    elif scenario == 'excel':
+        from create_excel_sheet import write_excel_workbook
+        write_excel_workbook([out['combined_counts']],out['workbook'],None,'human')
+    else:
+        raise ValueError("Unknown scenario : {}".format(scenario))
+
+def measure(scenario,data,work_dir,cores,buffer_size):
+    ''' Run a scenario in this process and measure it , with the worker pools closed at the
+    end so that the CPU time and the peak RSS of the workers are accounted for
+    :rtype OrderedDict
+    '''
+    from executor import shutdown
+    start = usage()
+    run_scenario(scenario,data,work_dir,cores,buffer_size)
+    shutdown()
+    return usage_delta(start,usage())
+
+def run_child(scenario,data_dir,nreads,work_dir,cores,buffer_size,seed):
+    ''' Measure a scenario in a new process , so that the peak RSS is its own
+    :rtype dict
+    '''
+    cmd = [sys.executable,os.path.abspath(__file__),'--child',scenario,'--data-dir',data_dir,
+           '--scales',str(nreads),'--work-dir',work_dir,'--cores',str(cores),
+           '--buffer-size',str(buffer_size),'--seed',str(seed)]
+    output = subprocess.check_output(cmd)
+    return json.loads(output.strip().split('\n')[-1],object_pairs_hook=OrderedDict)
+
+def load_history(history_file):
+    ''' The benchmark results so far
+    :rtype list
+    '''
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file) as IN:
+        return json.load(IN,object_pairs_hook=OrderedDict)
+
+def previous_result(history,result):
+    ''' The last result of the same scenario , scale and settings on this host
+    :rtype dict
+    '''
+    keys = ['host','scenario','reads','cores','buffer_size','seed']
+    for entry in reversed(history):
+        if all(entry.get(key) == result[key] for key in keys):
+            return entry
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the pipeline stages on synthetic data")
+    parser.add_argument('--scales',default='1M',help="comma separated number of reads , e.g. 1M,10M,100M")
+    parser.add_argument('--scenarios',default=','.join(SCENARIOS),help="comma separated , among "+",".join(SCENARIOS))
+    parser.add_argument('--data-dir',default=os.path.join(BENCH_DIR,'data'),help="the synthetic data and the outputs")
+    parser.add_argument('--history',default=None,help="the JSON history , <data-dir>/history.json by default")
+    parser.add_argument('--cores',type=int,default=4)
+    parser.add_argument('--buffer-size',type=int,default=16,help="demux MB read for each read pair for each core")
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--child',default=None,help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir',default=None,help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child: ## measure one scenario and print the result , as the last line
+        nreads = parse_scale(args.scales)
+        data = synthetic_data.generate(os.path.join(args.data_dir,str(nreads)),nreads,seed=args.seed)
+        print json.dumps(measure(args.child,data,args.work_dir,args.cores,args.buffer_size))
+        return
+
+    history_file = args.history or os.path.join(args.data_dir,'history.json')
+    history = load_history(history_file)
+    scenarios = args.scenarios.split(',')
+    for scenario in scenarios:
+        assert scenario in SCENARIOS, "Unknown scenario : {}".format(scenario)
+    for scale in args.scales.split(','):
+        nreads = parse_scale(scale)
+        print "Generating {} reads in {}".format(nreads,args.data_dir)
+        synthetic_data.generate(os.path.join(args.data_dir,str(nreads)),nreads,seed=args.seed)
+        work_dir = os.path.join(args.data_dir,str(nreads),'run')
+        done = set()
+        for scenario in scenarios:
+            ## the outputs a scenario starts from , unless the run has them already
+            needed = []
+            dependency = DEPENDS.get(scenario)
+            while dependency and dependency not in scenarios and dependency not in done:
+                needed.insert(0,dependency)
+                dependency = DEPENDS.get(dependency)
+            for dependency in needed:
+                run_child(dependency,args.data_dir,nreads,work_dir,args.cores,args.buffer_size,args.seed)
+                done.add(dependency)
+            fields = run_child(scenario,args.data_dir,nreads,work_dir,args.cores,args.buffer_size,args.seed)
+            done.add(scenario)
+            result = OrderedDict([('date',datetime.datetime.now().isoformat()),('commit',git_commit()),
+                                  ('host',platform.node()),('scenario',scenario),('scale',scale),('reads',nreads),
+                                  ('cores',args.cores),('buffer_size',args.buffer_size),('seed',args.seed),
+                                  ('reads_per_s',round(nreads/fields['wall_s'],1) if fields['wall_s'] > 0 else None)])
+            result.update(fields)
+            previous = previous_result(history,result)
+            change = ""
+            if previous and previous['reads_per_s'] and result['reads_per_s']:
+                change = " , {:+.1%} reads/s vs {}".format(result['reads_per_s']/previous['reads_per_s']-1,previous['commit'])
+            print "{s:<6} {n:>10} reads : {t:.1f} s , {r:.0f} reads/s , peak RSS {m:.0f} MB , workers {w:.0f} MB{c}".format(
+                s=scenario,n=nreads,t=result['wall_s'],r=result['reads_per_s'] or 0,m=result['peak_rss_mb'],
+                w=result['children_peak_rss_mb'],c=change)
+            history.append(result)
+            with open(history_file,'w') as OUT:
+                json.dump(history,OUT,indent=1)
+
+if __name__ == '__main__':
+    main()
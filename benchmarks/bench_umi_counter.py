@@ -0,0 +1,99 @@
+import sys
+import os
+import time
+import resource
+import numpy as np
+from collections import defaultdict
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','core'))
+from umi_counter import UmiCounter
+
+'''
+Compare the memory and time of the nested dicts of strings that count_umi used
+to count UMIs , against umi_counter.UmiCounter , on a synthetic single cell.
+Each counter runs in its own forked process so that the peak RSS of one does
+not hide the other.
+
+Usage : python bench_umi_counter.py [reads] [genes] [umi_length] [chunk_reads]
+'''
+
+def synthetic_cell(nreads,ngenes,umi_length,seed=0):
+    ''' Reads of a deep cell , with a skewed gene distribution and a few reads per molecule
+    :param int nreads: number of reads
+    :param int ngenes: number of genes
+    :param int umi_length: the UMI length
+    :param int seed: the random seed
+    :returns (gene id of each read , UMI of each read)
+    :rtype tuple of numpy arrays
+    '''
+    rng = np.random.RandomState(seed)
+    weights = 1.0/np.arange(1,ngenes+1)
+    ## about 3 reads per molecule , each molecule being a gene and a UMI
+    nmolecules = max(1,nreads//3)
+    molecule_genes = rng.choice(ngenes,size=nmolecules,p=weights/weights.sum()).astype(np.int32)
+    molecule_umis = rng.randint(0,4**umi_length,size=nmolecules,dtype=np.int64)
+    picked = rng.randint(0,nmolecules,size=nreads)
+    genes = molecule_genes[picked]
+    codes = molecule_umis[picked]
+    bases = np.array(list("ACGT"))
+    umis = np.empty(nreads,dtype='S%i'%umi_length)
+    letters = bases[(codes[:,None] >> (2*np.arange(umi_length)[::-1])) & 3]
+    umis[:] = letters.view('S1').reshape(nreads,umi_length).view('S%i'%umi_length).ravel()
+    return (genes,umis)
+
+def count_dicts(genes,umis,chunk_reads):
+    ''' Count as count_umi did , a dict of gene tuples of UMI strings
+    :rtype int
+    '''
+    umi_counter = defaultdict(lambda:defaultdict(int))
+    for start in xrange(0,len(genes),chunk_reads):
+        for gene,umi in zip(genes[start:start+chunk_reads].tolist(),umis[start:start+chunk_reads].tolist()):
+            ## the gene was keyed by its 6 field information tuple
+            umi_counter[('ENSG%011i'%gene,'GENE%i'%gene,'1','chr1',gene,gene+1000)][umi]+=1
+    return sum(len(u) for u in umi_counter.itervalues())
+
+def count_umi_counter(genes,umis,chunk_reads):
+    ''' Count with UmiCounter , a chunk at a time
+    :rtype int
+    '''
+    counter = UmiCounter()
+    cells = np.zeros(len(genes),dtype=np.int32)
+    for start in xrange(0,len(genes),chunk_reads):
+        stop = start + chunk_reads
+        counter.add(cells[start:stop],genes[start:stop],umis[start:stop])
+    return sum(m for m,n in counter.molecules(0).itervalues())
+
+def run_forked(func,genes,umis,chunk_reads):
+    ''' Run a counter in a child process
+    :returns (molecules , seconds , peak RSS increase in MB)
+    :rtype tuple
+    '''
+    read_end,write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        molecules = func(genes,umis,chunk_reads)
+        seconds = time.time() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_end,'{} {} {}'.format(molecules,seconds,(peak-before)/1024.0))
+        os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end,1024).split()
+    os.waitpid(pid,0)
+    return (int(result[0]),float(result[1]),float(result[2]))
+
+if __name__ == '__main__':
+    nreads = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    ngenes = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    umi_length = int(sys.argv[3]) if len(sys.argv) > 3 else 12
+    chunk_reads = int(sys.argv[4]) if len(sys.argv) > 4 else 2000000
+    genes,umis = synthetic_cell(nreads,ngenes,umi_length)
+    print "Reads : {}".format(nreads)
+    results = {}
+    for name,func in [('nested dicts',count_dicts),('UmiCounter',count_umi_counter)]:
+        results[name] = run_forked(func,genes,umis,chunk_reads)
+        print "{n:<13}: {m} molecules , {t:.1f} s , peak RSS +{r:.0f} MB".format(n=name,m=results[name][0],
+                                                                             t=results[name][1],r=results[name][2])
+    assert results['nested dicts'][0] == results['UmiCounter'][0], "The counters disagree"
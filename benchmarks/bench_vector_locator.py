@@ -0,0 +1,74 @@
+import sys
+import os
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','core'))
+import edlib
+import pyximport
+pyximport.install()
+from _utils import locate_vector
+from demultiplex_cells import open_fh,iterate_fastq
+
+'''
+Compare the bit-parallel vector locator (_utils.locate_vector) against
+the per read edlib.align call it replaced , on recorded MiSeq/HiSeq reads
+
+Usage : python bench_vector_locator.py R1.fastq(.gz) R2.fastq(.gz) [vector] [errors] [max_chunks]
+'''
+
+def edlib_offsets(buf2,vector,error):
+    ''' The previous per read implementation
+    :param bytes buf2: R2 chunk
+    :param str vector: the vector sequence
+    :param int error: Number of Indels/SNPs to tolerate in vector sequence
+    :rtype list
+    '''
+    offsets = []
+    lines = buf2.split(b'\n')
+    for i in xrange(1,len(lines),4):
+        if i + 2 >= len(lines):
+            break
+        alignment = edlib.align(vector,lines[i],mode="SHW")
+        if alignment["editDistance"] <= error:
+            offsets.append(alignment["locations"][-1][1] + 1)
+        else:
+            offsets.append(-1)
+    return offsets
+
+def benchmark(r1,r2,vector,error,max_chunks):
+    ''' Time both implementations on the same chunks and check that they agree
+    :param str r1: R1 fastq file
+    :param str r2: R2 fastq file
+    :param str vector: the vector sequence
+    :param int error: Number of Indels/SNPs to tolerate in vector sequence
+    :param int max_chunks: number of 16MB chunks to use
+    '''
+    f,f2 = open_fh(r1,r2)
+    nreads = 0
+    mismatches = 0
+    t_edlib = 0.0
+    t_myers = 0.0
+    for chunks in iterate_fastq(f,f2,max_chunks,16*1024**2):
+        for buf1,buf2 in chunks:
+            start = time.time()
+            expected = edlib_offsets(buf2,vector,error)
+            t_edlib += time.time() - start
+            start = time.time()
+            observed = locate_vector(buf2,vector,error)
+            t_myers += time.time() - start
+            nreads += len(expected)
+            mismatches += sum(1 for e,o in zip(expected,observed) if e != o)
+        break
+    f.close()
+    f2.close()
+    print "Reads : {}".format(nreads)
+    print "Disagreements : {}".format(mismatches)
+    print "edlib.align per read : {t:.3f} s ({r:.0f} reads/s)".format(t=t_edlib,r=nreads/t_edlib)
+    print "locate_vector        : {t:.3f} s ({r:.0f} reads/s)".format(t=t_myers,r=nreads/t_myers)
+    print "Speedup : {:.1f}x".format(t_edlib/t_myers)
+
+if __name__ == '__main__':
+    vector = sys.argv[3] if len(sys.argv) > 3 else "AAGCAGTGGTATCAACGCAGAGTAC"
+    error = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+    max_chunks = int(sys.argv[5]) if len(sys.argv) > 5 else 4
+    benchmark(sys.argv[1],sys.argv[2],vector,error,max_chunks)
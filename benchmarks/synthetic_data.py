@@ -0,0 +1,314 @@
+import sys
+import os
+import gzip
+import json
+from collections import OrderedDict
+import numpy as np
+import pysam
+
+'''
+Synthetic QIAseq UltraplexRNA data for the benchmarks , the same for a seed :
+1. a toy annotation , a GTF of genes on a few chromosomes , and an ERCC bed
+2. a cell index file , the cell indices at least 3 substitutions apart
+3. paired fastqs with the read layout demultiplex_cells expects :
+       R2 : vector , cell index , UMI , then the cDNA (NextSeq : no vector)
+       R1 : the cDNA , followed by a polyA tail for some of the reads
+   A few reads have an all N R2 , or an R2 without the vector. Substitutions are
+   made at a rate in the vector and the cell index , and in all the bases of R1
+4. a coordinate sorted BAM of the reads of all the cells aligned to the toy annotation ,
+   with the cell index in the CB tag and the UMI in the UB tag and after the last ':' of
+   the read name , as count_umi reads it from a sample BAM or from a cell BAM.
+   The reads of a cell and gene share a few UMIs , some with a substitution
+
+The files are written once in a directory and reused while the settings are the same ,
+see generate.
+
+Usage : python synthetic_data.py out_dir reads [seed]
+'''
+
+SETTINGS = OrderedDict([
+    ('seed',0),
+    ('cells',96),
+    ('cell_index_len',10),
+    ('mt_len',12),
+    ('vector','AAGCAGTGGTATCAACGCAGAGTAC'),
+    ('instrument','MiSeq/HiSeq'),
+    ('wts',True),
+    ('r1_len',100),
+    ('r2_len',60),
+    ('genes',2000),
+    ('base_error_rate',0.002),   ## R1 substitutions , per base
+    ('vector_error_rate',0.01),  ## vector substitutions , per base
+    ('cell_error_rate',0.01),    ## cell index and UMI substitutions , per base
+    ('n_read_rate',0.01),        ## reads with an all N R2
+    ('no_vector_rate',0.03),     ## reads with an R2 of random bases
+    ('polya_rate',0.3),          ## reads with a polyA tail on R1
+    ('unmapped_rate',0.05),
+    ('ercc_rate',0.03),
+    ('intergenic_rate',0.1),
+    ('reads_per_molecule',3)])
+BASES = np.frombuffer(b'ACGT',dtype=np.uint8)
+CHROMS = [('chr1',50000000),('chr2',40000000),('chr3',30000000),('chrX',20000000)]
+ERCCS = [('ERCC-{:05d}'.format(i),1000) for i in xrange(1,11)]
+MANIFEST = 'manifest.json'
+BLOCK_READS = 200000
+
+def random_bases(rng,shape):
+    ''' Random ACGT bases
+    :param RandomState rng: the random generator
+    :param tuple shape: the shape of the array
+    :returns ASCII codes
+    :rtype numpy.ndarray of uint8
+    '''
+    return BASES[rng.randint(0,4,size=shape)]
+
+def substitute(rng,seqs,rate):
+    ''' Substitute bases at a rate , in place
+    :param RandomState rng: the random generator
+    :param numpy.ndarray seqs: ASCII codes
+    :param float rate: the probability of a substitution for each base
+    '''
+    if rate <= 0 or seqs.size == 0:
+        return
+    where = rng.random_sample(seqs.shape) < rate
+    shifted = (np.searchsorted(BASES,seqs[where]) + rng.randint(1,4,size=where.sum())) % 4
+    seqs[where] = BASES[shifted]
+
+def write_cell_indices(path,ncells,length,rng):
+    ''' Write a cell index file , the cell indices at least 3 substitutions apart
+    :param str path: the output file
+    :param int ncells: number of cell indices
+    :param int length: length of the cell indices
+    :param RandomState rng: the random generator
+    :returns the cell indices
+    :rtype numpy.ndarray of uint8 , one row per cell
+    '''
+    cells = []
+    while len(cells) < ncells:
+        cell = random_bases(rng,length)
+        if all((cell != other).sum() >= 3 for other in cells):
+            cells.append(cell)
+    cells = np.array(cells,dtype=np.uint8)
+    with open(path,'w') as OUT:
+        for cell in cells:
+            OUT.write(cell.tostring()+'\n')
+    return cells
+
+def write_annotation(gtf,ercc_bed,ngenes,rng):
+    ''' Write a toy GTF , genes of 1 to 20 kb spread over CHROMS , and an ERCC bed
+    :param str gtf: the output GTF
+    :param str ercc_bed: the output ERCC bed
+    :param int ngenes: number of genes
+    :param RandomState rng: the random generator
+    :returns the reference names and lengths , and the genes as (reference id , start , end) arrays
+    :rtype tuple
+    '''
+    lengths = np.array([length for chrom,length in CHROMS],dtype=np.int64)
+    gene_tid = np.sort(rng.choice(len(CHROMS),size=ngenes,p=lengths/float(lengths.sum())))
+    gene_len = rng.randint(1000,20000,size=ngenes)
+    gene_start = (rng.random_sample(ngenes)*(lengths[gene_tid]-gene_len-1)).astype(np.int64) + 1
+    order = np.lexsort((gene_start,gene_tid))
+    gene_tid,gene_start,gene_len = gene_tid[order],gene_start[order],gene_len[order]
+    gene_end = gene_start + gene_len
+    strands = rng.randint(0,2,size=ngenes)
+    with open(gtf,'w') as OUT:
+        for i in xrange(ngenes):
+            fields = [CHROMS[gene_tid[i]][0],'synthetic',None,str(gene_start[i]),str(gene_end[i]),'.','+-'[strands[i]],'.']
+            attributes = 'gene_id "SYNG{i:06d}"; gene_type "protein_coding"; gene_name "GENE{i}";'.format(i=i)
+            for feature in ['gene','exon']:
+                fields[2] = feature
+                OUT.write('\t'.join(fields)+'\t'+attributes+'\n')
+    with open(ercc_bed,'w') as OUT:
+        for name,length in ERCCS:
+            OUT.write('{n}\t1\t{l}\t{s}\t+\t{n}\n'.format(n=name,l=length,s='A'*10))
+    references = [(chrom,length) for chrom,length in CHROMS] + ERCCS
+    return (references,(gene_tid,gene_start,gene_end))
+
+def fastq_block(first,seqs,mate):
+    ''' The fastq records of a block of reads , named by their number
+    :param int first: the number of the first read
+    :param numpy.ndarray seqs: the read sequences , a row per read
+    :param int mate: 1 or 2
+    :rtype str
+    '''
+    n,length = seqs.shape
+    name = np.frombuffer('@SYN:0000000000 {}:N:0:1\n'.format(mate),dtype=np.uint8)
+    width = len(name) + 2*length + 4
+    block = np.empty((n,width),dtype=np.uint8)
+    block[:,:len(name)] = name
+    ## the read number , 10 digits
+    numbers = np.arange(first,first+n,dtype=np.int64)
+    block[:,5:15] = (numbers[:,None] // 10**np.arange(9,-1,-1)) % 10 + ord('0')
+    seq_start = len(name)
+    block[:,seq_start:seq_start+length] = seqs
+    block[:,seq_start+length:seq_start+length+3] = np.frombuffer(b'\n+\n',dtype=np.uint8)
+    block[:,seq_start+length+3:-1] = ord('F')
+    block[:,-1] = ord('\n')
+    return block.tostring()
+
+def write_fastqs(r1,r2,cells,nreads,settings,rng):
+    ''' Write the paired fastqs , gzipped
+    :param str r1: the R1 fastq
+    :param str r2: the R2 fastq
+    :param numpy.ndarray cells: the cell indices , see write_cell_indices
+    :param int nreads: number of read pairs
+    :param dict settings: see SETTINGS
+    :param RandomState rng: the random generator
+    '''
+    vector = np.frombuffer(settings['vector'],dtype=np.uint8)
+    if settings['instrument'].upper() == 'NEXTSEQ':
+        vector = vector[:0]
+    cell_index_len,mt_len = settings['cell_index_len'],settings['mt_len']
+    r1_len,r2_len = settings['r1_len'],settings['r2_len']
+    cell_start = len(vector)
+    umi_start = cell_start + cell_index_len
+    umi_end = umi_start + mt_len
+    assert umi_end <= r2_len, "R2 shorter than the vector , cell index and UMI"
+    ## the cDNA kept before a polyA tail , as the polyA trimming of demultiplex_cells expects
+    min_insert = 30 if settings['wts'] else 44
+    OUT1 = gzip.open(r1,'wb',1)
+    OUT2 = gzip.open(r2,'wb',1)
+    for first in xrange(0,nreads,BLOCK_READS):
+        n = min(BLOCK_READS,nreads-first)
+        ## R2
+        seqs2 = random_bases(rng,(n,r2_len))
+        seqs2[:,:cell_start] = vector
+        substitute(rng,seqs2[:,:cell_start],settings['vector_error_rate'])
+        seqs2[:,cell_start:umi_start] = cells[rng.randint(0,len(cells),size=n)]
+        substitute(rng,seqs2[:,cell_start:umi_end],settings['cell_error_rate'])
+        kind = rng.random_sample(n)
+        seqs2[kind < settings['n_read_rate']] = ord('N')
+        no_vector = (kind >= settings['n_read_rate']) & (kind < settings['n_read_rate']+settings['no_vector_rate'])
+        seqs2[no_vector] = random_bases(rng,(no_vector.sum(),r2_len))
+        ## R1
+        seqs1 = random_bases(rng,(n,r1_len))
+        tails = np.flatnonzero(rng.random_sample(n) < settings['polya_rate'])
+        if r1_len - 9 > min_insert:
+            tail_start = rng.randint(min_insert,r1_len-9,size=len(tails))
+            seqs1[tails,tail_start-1] = ord('C')
+            rows = seqs1[tails]
+            rows[np.arange(r1_len)[None,:] >= tail_start[:,None]] = ord('A')
+            seqs1[tails] = rows
+        substitute(rng,seqs1,settings['base_error_rate'])
+        OUT1.write(fastq_block(first,seqs1,1))
+        OUT2.write(fastq_block(first,seqs2,2))
+    OUT1.close()
+    OUT2.close()
+
+def write_bam(bam,references,genes,cells,nreads,settings,rng):
+    ''' Write the coordinate sorted BAM of the reads of all cells , a reference at a time
+    :param str bam: the output BAM
+    :param list references: (name , length) of each reference
+    :param tuple genes: (reference id , start , end) arrays , see write_annotation
+    :param numpy.ndarray cells: the cell indices , see write_cell_indices
+    :param int nreads: number of reads
+    :param dict settings: see SETTINGS
+    :param RandomState rng: the random generator
+    '''
+    gene_tid,gene_start,gene_end = genes
+    ngenes = len(gene_tid)
+    read_len = settings['r1_len']
+    ## the reads of each gene (skewed) , intergenic region of a chromosome , ERCC , and unmapped
+    weights = 1.0/np.arange(1,ngenes+1)
+    weights = weights[rng.permutation(ngenes)]
+    weights *= (1.0 - settings['unmapped_rate'] - settings['ercc_rate'] - settings['intergenic_rate'])/weights.sum()
+    chrom_lengths = np.array([length for chrom,length in CHROMS],dtype=np.float64)
+    intergenic = settings['intergenic_rate']*chrom_lengths/chrom_lengths.sum()
+    ercc = np.full(len(ERCCS),settings['ercc_rate']/len(ERCCS))
+    counts = rng.multinomial(nreads,np.concatenate([weights,intergenic,ercc,[settings['unmapped_rate']]]))
+    gene_counts = counts[:ngenes]
+    ## about reads_per_molecule reads for each cell , gene and UMI , the UMI being picked among
+    ## the UMIs of the gene , some with a substitution
+    umis_per_gene = max(1,int(nreads/float(settings['reads_per_molecule']*len(cells)*ngenes)))
+    umi_codes = random_bases(rng,((ngenes+1)*umis_per_gene,settings['mt_len']))
+    cell_names = [row.tostring() for row in cells]
+    seq = random_bases(rng,read_len).tostring()
+    qualities = pysam.qualitystring_to_array('F'*read_len)
+    header = {'HD':{'VN':'1.4','SO':'coordinate'},'SQ':[{'SN':name,'LN':length} for name,length in references]}
+    read = pysam.AlignedSegment()
+    read_number = 0
+    with pysam.AlignmentFile(bam,'wb',header=header) as OUT:
+        for tid in range(len(references)) + [-1]:
+            if tid < 0:
+                n = counts[-1]
+                pos = np.full(n,-1,dtype=np.int64)
+                gene = np.full(n,ngenes,dtype=np.int64)
+            else:
+                on_ref = np.flatnonzero(gene_tid == tid)
+                gene = np.repeat(on_ref,gene_counts[on_ref])
+                pos = gene_start[gene] + (rng.random_sample(len(gene))*(gene_end-gene_start)[gene]).astype(np.int64)
+                n_other = counts[ngenes+tid]
+                other_len = references[tid][1] - read_len
+                other_pos = (rng.random_sample(n_other)*other_len).astype(np.int64)
+                gene = np.concatenate([gene,np.full(n_other,ngenes,dtype=np.int64)])
+                pos = np.concatenate([pos,other_pos])
+                order = np.argsort(pos,kind='mergesort')
+                gene,pos = gene[order],pos[order]
+            for first in xrange(0,len(pos),BLOCK_READS):
+                block_pos = pos[first:first+BLOCK_READS]
+                block_gene = gene[first:first+BLOCK_READS]
+                n = len(block_pos)
+                umis = umi_codes[block_gene*umis_per_gene + rng.randint(0,umis_per_gene,size=n)]
+                substitute(rng,umis,settings['cell_error_rate'])
+                umis = [row.tostring() for row in umis]
+                block_cells = rng.randint(0,len(cells),size=n).tolist()
+                reverse = rng.randint(0,2,size=n).tolist()
+                for p,u,c,rev in zip(block_pos.tolist(),umis,block_cells,reverse):
+                    read.query_name = 'SYN:{}:{}'.format(read_number,u)
+                    read_number += 1
+                    read.query_sequence = seq
+                    read.query_qualities = qualities
+                    if tid < 0:
+                        read.flag = 4
+                        read.reference_id = -1
+                        read.reference_start = -1
+                        read.mapping_quality = 0
+                        read.set_tags([('NH',0),('CB',cell_names[c]),('UB',u)])
+                    else:
+                        read.flag = 16 if rev else 0
+                        read.reference_id = tid
+                        read.reference_start = p
+                        read.cigartuples = [(0,read_len)]
+                        read.mapping_quality = 255
+                        read.set_tags([('NH',1),('CB',cell_names[c]),('UB',u)])
+                    OUT.write(read)
+
+def generate(out_dir,nreads,**settings):
+    ''' Write the synthetic data of a run in a directory , unless it already holds
+    the data for these settings
+    :param str out_dir: the output directory
+    :param int nreads: number of reads
+    :param settings: overrides of SETTINGS
+    :returns the paths and the settings of the data
+    :rtype dict
+    '''
+    unknown = set(settings) - set(SETTINGS)
+    assert not unknown, "Unknown synthetic data settings : {}".format(",".join(sorted(unknown)))
+    wanted = OrderedDict(SETTINGS)
+    wanted.update(settings)
+    wanted['reads'] = nreads
+    paths = OrderedDict([(name,os.path.join(out_dir,filename)) for name,filename in [
+        ('gtf','genes.gtf'),('ercc_bed','ercc.bed'),('cell_index_file','cell_indices.txt'),
+        ('r1','R1.fastq.gz'),('r2','R2.fastq.gz'),('bam','Aligned.sortedByCoord.out.bam')]])
+    manifest = os.path.join(out_dir,MANIFEST)
+    if os.path.exists(manifest):
+        with open(manifest) as IN:
+            if json.load(IN)['settings'] == json.loads(json.dumps(wanted)):
+                return {'paths':paths,'settings':wanted}
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    rng = np.random.RandomState(wanted['seed'])
+    cells = write_cell_indices(paths['cell_index_file'],wanted['cells'],wanted['cell_index_len'],rng)
+    references,genes = write_annotation(paths['gtf'],paths['ercc_bed'],wanted['genes'],rng)
+    write_fastqs(paths['r1'],paths['r2'],cells,nreads,wanted,rng)
+    write_bam(paths['bam'],references,genes,cells,nreads,wanted,rng)
+    with open(manifest,'w') as OUT:
+        json.dump({'settings':wanted,'paths':paths},OUT,indent=1)
+    return {'paths':paths,'settings':wanted}
+
+if __name__ == '__main__':
+    out_dir = sys.argv[1]
+    nreads = int(float(sys.argv[2]))
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    data = generate(out_dir,nreads,seed=seed)
+    print json.dumps(data['paths'],indent=1)
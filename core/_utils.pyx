@@ -1,4 +1,9 @@
 cimport cython
+from libc.string cimport memchr, memcmp, memcpy
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from cpython cimport array
+import array
+import edlib
 ctypedef fused bytes_or_bytearray:
     bytes
     bytearray
@@ -17,11 +22,20 @@ def two_fastq_heads(bytes_or_bytearray buf1, bytes_or_bytearray buf2, Py_ssize_t
     buf2[:length2] contain the same number of lines (where the
     line number is divisible by four).
     '''
+    return _two_fastq_heads(buf1, buf2, end1, end2)
+
+def two_fastq_heads_view(const unsigned char[::1] buf1, const unsigned char[::1] buf2, Py_ssize_t end1, Py_ssize_t end2):
+    '''
+    Same as two_fastq_heads for any contiguous buffer , i.e. the shared memory slots of shared_ring
+    '''
+    if end1 == 0 or end2 == 0:
+        return 0, 0
+    return _two_fastq_heads(&buf1[0], &buf2[0], end1, end2)
+
+cdef _two_fastq_heads(const unsigned char * data1, const unsigned char * data2, Py_ssize_t end1, Py_ssize_t end2):
     cdef:
         Py_ssize_t pos1 = 0, pos2 = 0
         Py_ssize_t linebreaks = 0
-        unsigned char * data1 = buf1
-        unsigned char * data2 = buf2
         Py_ssize_t record_start1 = 0
         Py_ssize_t record_start2 = 0
 
@@ -46,6 +60,407 @@ def two_fastq_heads(bytes_or_bytearray buf1, bytes_or_bytearray buf2, Py_ssize_t
     return record_start1, record_start2
 
 
+'''
+The functions below are not from cutadapt, they implement the per read
+logic of demultiplex_cells.process_reads directly on the chunk buffers
+yielded by demultiplex_cells.iterate_fastq
+'''
+
+cdef inline Py_ssize_t _line_end(const char * data, Py_ssize_t pos, Py_ssize_t end):
+    ''' Return the position of the next newline, or end if there is none
+    '''
+    cdef const char * hit
+    if pos >= end:
+        return end
+    hit = <const char *>memchr(data + pos, b'\n', end - pos)
+    if hit == NULL:
+        return end
+    return hit - data
+
+cdef inline bint _is_base(char c):
+    return c == b'A' or c == b'C' or c == b'G' or c == b'T' or c == b'N'
+
+cdef Py_ssize_t _polyA_trim_index(const char * seq, Py_ssize_t n, bint wts):
+    ''' Return the start of the polyA tail on R1 or -1 if there is none.
+    Mirrors the compiled regexes in demultiplex_cells.compile_regex :
+        wts     : ^([ACGTN]*?[CGTN])([A]{9,}[ACGNT]*$)      , first valid split
+        non wts : ^([ACGTN]{42,}[CGTN])([A]{8,}[ACGNT]{1,}$) , last valid split
+    '''
+    cdef Py_ssize_t i, j, p
+    cdef Py_ssize_t run = 0 # length of the run of A's starting at p
+    for i in range(n):
+        if not _is_base(seq[i]):
+            return -1
+    if wts:
+        p = 1
+        while p + 9 <= n:
+            if seq[p - 1] != b'A':
+                j = 0
+                while j < 9 and seq[p + j] == b'A':
+                    j += 1
+                if j == 9:
+                    return p
+                p += j + 1
+            else:
+                p += 1
+        return -1
+    else:
+        p = n - 9
+        if p < 43:
+            return -1
+        # walk backwards keeping track of the run of A's starting at p
+        j = p
+        while j < n and seq[j] == b'A':
+            j += 1
+        run = j - p
+        while p >= 43:
+            if run >= 8 and seq[p - 1] != b'A':
+                return p
+            p -= 1
+            if seq[p] == b'A':
+                run += 1
+            else:
+                run = 0
+        return -1
+
+cdef inline long long _encode_2bit(const char * seq, Py_ssize_t n):
+    ''' Pack a A/C/G/T sequence 2 bits per base , same as cell_index_correction.encode
+    Return -1 if the sequence has any other character
+    '''
+    cdef long long code = 0
+    cdef Py_ssize_t i
+    for i in range(n):
+        if seq[i] == b'A':
+            code = code << 2
+        elif seq[i] == b'C':
+            code = (code << 2) | 1
+        elif seq[i] == b'G':
+            code = (code << 2) | 2
+        elif seq[i] == b'T':
+            code = (code << 2) | 3
+        else:
+            return -1
+    return code
+
+cdef Py_ssize_t _vector_end(const char * seq, Py_ssize_t n, const char * vector, Py_ssize_t m,
+                            const unsigned long long * peq, int error):
+    ''' Locate the vector at the start of a read , same as
+    edlib.align(vector, seq, mode="SHW")["locations"][-1][1] + 1 when the edit distance is <= error.
+    Uses Myers' bit-parallel edit distance with the first row of the dp matrix fixed to
+    0,1,2.. so that the alignment is anchored at the start of the read. Among the ends
+    with the lowest edit distance , the largest is returned. Return -1 if there is none
+    within error edits. The vector has to be at most 64 bases long
+    '''
+    cdef:
+        unsigned long long pv = ~0ULL, mv = 0ULL
+        unsigned long long eq, xv, xh, ph, mh
+        unsigned long long last = 1ULL << (m - 1)
+        Py_ssize_t j, best_end = -1
+        int score = m, best_score = error
+    # most reads have the vector without any errors
+    if n >= m and memcmp(seq, vector, m) == 0:
+        return m
+    for j in range(n):
+        # the edit distance at any later end is at least j + 1 - m
+        if j + 1 - m > best_score:
+            break
+        eq = peq[<unsigned char>seq[j]]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = (ph << 1) | 1ULL # the first row increases by 1 in each column
+        mh = mh << 1
+        pv = mh | ~(xv | ph)
+        mv = ph & xv
+        if score <= best_score:
+            best_score = score
+            best_end = j
+    if best_end < 0:
+        return -1
+    return best_end + 1
+
+def locate_vector(const unsigned char[::1] buf2, bytes vector, int error):
+    '''
+    Locate the vector sequence at the start of each read in a chunk of R2 reads
+
+    :param buffer buf2: R2 chunk, whole fastq records
+    :param bytes vector: vector sequence on R2
+    :param int error: Number of Indels/SNPs to tolerate in vector sequence
+    :returns for each read , the 0-based position on the read just after the vector ,
+             -1 if the vector was not found within error edits
+    :rtype array.array of longs
+    '''
+    cdef:
+        const char * data2 = NULL
+        const char * vec = vector
+        Py_ssize_t end2 = buf2.shape[0]
+        Py_ssize_t m = len(vector)
+        Py_ssize_t pos2 = 0, s2s, s2e, i
+        unsigned long long peq[256]
+        array.array offsets = array.array('l')
+    for i in range(256):
+        peq[i] = 0
+    for i in range(min(m, 64)):
+        peq[<unsigned char>vec[i]] |= 1ULL << i
+    if end2 > 0:
+        data2 = <const char *>&buf2[0]
+
+    while pos2 < end2:
+        s2s = _line_end(data2, pos2, end2) + 1
+        s2e = _line_end(data2, s2s, end2)
+        pos2 = _line_end(data2, _line_end(data2, s2e + 1, end2) + 1, end2) + 1
+        if s2e >= end2: # truncated record at the end of the buffer
+            break
+        if m <= 64:
+            offsets.append(_vector_end(data2 + s2s, s2e - s2s, vec, m, peq, error))
+        else: # too long for a single machine word
+            alignment = edlib.align(vector, data2[s2s:s2e], mode="SHW")
+            if alignment["editDistance"] <= error:
+                offsets.append(alignment["locations"][-1][1] + 1)
+            else:
+                offsets.append(-1)
+    return offsets
+
+cdef inline char * _put_le(char * p, long long v, int nbytes):
+    ''' Write an integer in little endian byte order , return the position after it
+    '''
+    cdef int i
+    for i in range(nbytes):
+        p[i] = <char>((v >> (8 * i)) & 0xff)
+    return p + nbytes
+
+cdef inline unsigned char _bam_base(char c):
+    ''' 4-bit encoding of a base , as in the BAM spec "=ACMGRSVTWYHKDBN"
+    '''
+    if c == b'A':
+        return 1
+    elif c == b'C':
+        return 2
+    elif c == b'G':
+        return 4
+    elif c == b'T':
+        return 8
+    return 15
+
+cdef bytes _bam_record(const char * name, Py_ssize_t name_len, const char * seq, const char * qual,
+                       Py_ssize_t seq_len, bytes cellid, bytes umi):
+    ''' Encode an unmapped single end BAM record with CB and UB tags
+    '''
+    cdef:
+        Py_ssize_t tags_len = 2 * 3 + len(cellid) + 1 + len(umi) + 1
+        Py_ssize_t block_size = 32 + name_len + 1 + (seq_len + 1) // 2 + seq_len + tags_len
+        bytes record = PyBytes_FromStringAndSize(NULL, block_size + 4)
+        char * p = PyBytes_AS_STRING(record)
+        Py_ssize_t i
+    p = _put_le(p, block_size, 4)
+    p = _put_le(p, -1, 4)          # refID
+    p = _put_le(p, -1, 4)          # pos
+    p = _put_le(p, name_len + 1, 1)
+    p = _put_le(p, 255, 1)         # mapq
+    p = _put_le(p, 4680, 2)        # bin for an unmapped read
+    p = _put_le(p, 0, 2)           # n_cigar_op
+    p = _put_le(p, 4, 2)           # flag , unmapped
+    p = _put_le(p, seq_len, 4)
+    p = _put_le(p, -1, 4)          # next_refID
+    p = _put_le(p, -1, 4)          # next_pos
+    p = _put_le(p, 0, 4)           # tlen
+    memcpy(p, name, name_len)
+    p[name_len] = 0
+    p += name_len + 1
+    for i in range(0, seq_len, 2):
+        if i + 1 < seq_len:
+            p[i // 2] = <char>((_bam_base(seq[i]) << 4) | _bam_base(seq[i + 1]))
+        else:
+            p[i // 2] = <char>(_bam_base(seq[i]) << 4)
+    p += (seq_len + 1) // 2
+    for i in range(seq_len):
+        p[i] = qual[i] - 33
+    p += seq_len
+    memcpy(p, b"CBZ", 3)
+    p += 3
+    memcpy(p, <const char *>cellid, len(cellid) + 1)
+    p += len(cellid) + 1
+    memcpy(p, b"UBZ", 3)
+    p += 3
+    memcpy(p, <const char *>umi, len(umi) + 1)
+    return record
+
+def process_reads_chunk(const unsigned char[::1] buf1, const unsigned char[::1] buf2, dict correction_table, dict correction_n_table,
+                        list slot_cells, bint wts, int cell_index_len, int umi_len,
+                        long[:] vector_offsets, bint is_nextseq, bint bam_output=False):
+    '''
+    Demultiplex a chunk of paired reads , identify the cell id and umi on R2,
+    trim the polyA tail on R1 and build the output fastq records for each cell
+
+    :param buffer buf1: R1 chunk, whole fastq records , bytes or a shared memory slot
+    :param buffer buf2: R2 chunk, same number of records as buf1
+    :param dict correction_table: 2-bit packed cell id -> (slot << 3) | correction ,
+                                  see cell_index_correction
+    :param dict correction_n_table: cell id with an N -> (slot << 3) | correction
+    :param list slot_cells: slot -> cell index
+    :param bool wts: Whether this is a polyA wts experiment
+    :param int cell_index_len: Cell Index oligo length
+    :param int umi_len: UMI oligo length
+    :param array vector_offsets: MiSeq/HiSeq reads , the position after the vector on each R2 ,
+                                 as returned by locate_vector ; None for NextSeq reads
+    :param bool is_nextseq: Whether the reads are from a NextSeq
+    :param bool bam_output: Whether to build unmapped BAM records with CB/UB tags instead of fastq records
+    :returns (out_blocks,cell_metrics,num_reads,reads_dropped_all_N,
+              reads_dropped_cellid_not_extracted,reads_dropped_cellid_not_matching_oligo,
+              reads_dropped_lt_25bp,reads_dropped_cellid_ambiguous)
+              out_blocks : cell index -> bytes , newline terminated fastq records or
+                           uncompressed BAM records
+              cell_metrics : cell index -> [reads total, reads after qc,
+                                            reads for each correction type]
+    :rtype tuple
+    '''
+    cdef:
+        const char * data1 = NULL
+        const char * data2 = NULL
+        Py_ssize_t end1 = buf1.shape[0]
+        Py_ssize_t end2 = buf2.shape[0]
+        Py_ssize_t pos1 = 0, pos2 = 0
+        Py_ssize_t h1s, h1e, s1s, s1e, q1s, q1e
+        Py_ssize_t h2s, h2e, s2s, s2e, q2s, q2e
+        Py_ssize_t id1e, id2e, r2_len, offset, trim, i
+        bint all_N
+        long num_reads = 0
+        long reads_dropped_all_N = 0
+        long reads_dropped_cellid_not_extracted = 0
+        long reads_dropped_cellid_not_matching_oligo = 0
+        long reads_dropped_lt_25bp = 0
+        long reads_dropped_cellid_ambiguous = 0
+        long long code
+        long value
+        int correction, shift
+        Py_ssize_t multiplex_len = cell_index_len + umi_len
+        bytearray block
+        list counts
+    out_blocks = {}
+    cell_metrics = {}
+    if end1 > 0 and end2 > 0:
+        data1 = <const char *>&buf1[0]
+        data2 = <const char *>&buf2[0]
+
+    while pos1 < end1 and pos2 < end2:
+        # R1 record
+        h1s = pos1
+        h1e = _line_end(data1, h1s, end1)
+        s1s = h1e + 1
+        s1e = _line_end(data1, s1s, end1)
+        q1s = _line_end(data1, s1e + 1, end1) + 1
+        q1e = _line_end(data1, q1s, end1)
+        pos1 = q1e + 1
+        # R2 record
+        h2s = pos2
+        h2e = _line_end(data2, h2s, end2)
+        s2s = h2e + 1
+        s2e = _line_end(data2, s2s, end2)
+        q2s = _line_end(data2, s2e + 1, end2) + 1
+        q2e = _line_end(data2, q2s, end2)
+        pos2 = q2e + 1
+        if q1s > end1 or q2s > end2: # truncated record at the end of the buffer
+            break
+        num_reads += 1
+
+        # have R1 and R2 ready to process now
+        id1e = h1s
+        while id1e < h1e and data1[id1e] != b' ':
+            id1e += 1
+        id2e = h2s
+        while id2e < h2e and data2[id2e] != b' ':
+            id2e += 1
+        if id1e - h1s != id2e - h2s or memcmp(data1 + h1s, data2 + h2s, id1e - h1s) != 0:
+            raise UserWarning("demultiplex_cells:R1,R2 read ids are not in sync : R1:{r1} ; R2:{r2}".format(
+                r1=data1[h1s:id1e],r2=data2[h2s:id2e]))
+        elif q1e - q1s != s1e - s1s or q2e - q2s != s2e - s2s:
+            raise UserWarning("demultiplex_cells:Read has different length qual and seq strings {}".format(data1[h1s:id1e]))
+
+        # extract cell id , umi region from R2
+        r2_len = s2e - s2s
+        offset = -1
+        if is_nextseq:
+            offset = 0
+        else:
+            offset = vector_offsets[num_reads - 1] # 0-based position on r2
+        if offset >= 0 and r2_len - offset >= multiplex_len - 1 and r2_len - offset > 0: # allow 1 base offset
+            # correct the cell id with the lookup table
+            code = -1
+            if r2_len - offset >= cell_index_len:
+                code = _encode_2bit(data2 + s2s + offset, cell_index_len)
+            if code >= 0:
+                entry = correction_table.get(code)
+            else:
+                entry = correction_n_table.get(data2[s2s + offset:s2s + offset + cell_index_len])
+            if entry is None:
+                reads_dropped_cellid_not_matching_oligo += 1
+                continue
+            value = entry
+            if value < 0:
+                reads_dropped_cellid_ambiguous += 1
+                reads_dropped_cellid_not_matching_oligo += 1
+                continue
+            cellid = slot_cells[value >> 3]
+            correction = value & 7
+            # the umi moves with an indel in the cell id
+            shift = -1 if correction == 3 else 1 if correction == 4 else 0
+            umi = data2[s2s + offset + cell_index_len + shift:s2s + min(offset + multiplex_len + shift, r2_len)]
+        else:
+            all_N = r2_len > 0
+            for i in range(s2s, s2e):
+                if data2[i] != b'N':
+                    all_N = False
+                    break
+            if all_N:
+                reads_dropped_all_N += 1
+            else:
+                reads_dropped_cellid_not_extracted += 1
+            continue
+
+        # polyA trim
+        trim = _polyA_trim_index(data1 + s1s, s1e - s1s, wts)
+        if trim < 0:
+            trim = s1e - s1s
+
+        # store per cell level metrics
+        counts = cell_metrics.get(cellid)
+        if counts is None:
+            counts = cell_metrics[cellid] = [0, 0, 0, 0, 0, 0, 0]
+        counts[0] += 1
+        counts[2 + correction] += 1
+        if trim < 25:
+            reads_dropped_lt_25bp += 1
+            continue
+        counts[1] += 1
+
+        block = out_blocks.get(cellid)
+        if block is None:
+            block = out_blocks[cellid] = bytearray()
+        if bam_output: # the read name without the leading @
+            block += _bam_record(data1 + h1s + 1, id1e - h1s - 1, data1 + s1s, data1 + q1s, trim, cellid, umi)
+            continue
+        block += data1[h1s:id1e]
+        block += b":"
+        block += umi
+        block += b"\n"
+        block += data1[s1s:s1s + trim]
+        block += b"\n+\n"
+        block += data1[q1s:q1s + trim]
+        block += b"\n"
+
+    for cellid in out_blocks:
+        out_blocks[cellid] = bytes(out_blocks[cellid])
+
+    return (out_blocks, cell_metrics, num_reads, reads_dropped_all_N,
+            reads_dropped_cellid_not_extracted, reads_dropped_cellid_not_matching_oligo,
+            reads_dropped_lt_25bp, reads_dropped_cellid_ambiguous)
+
+
 def quality_trim(str qualities, str bases, int cutoff_back, bint is_nextseq, int base=33):
     '''
     '''
@@ -1,7 +1,13 @@
+import re
 import subprocess
 import pysam
 import sys
 
+## RAM in bytes for sorting the output BAM , required with a genome in shared memory
+BAM_SORT_RAM = 10000000000
+## The oldest STAR aligning an unaligned BAM and keeping its tags , see star_bam_input_options
+STAR_BAM_INPUT_VERSION = (2,7,0)
+
 def run_cmd(cmd):
     ''' Run a shell command
     :param str cmd: the command to run
@@ -11,6 +17,33 @@ def run_cmd(cmd):
     if p.returncode:
         raise subprocess.CalledProcessError(p.returncode,cmd)
     
+def star_version(star):
+    ''' The version of a STAR executable
+    :param str star: path to the star executable
+    :returns (major,minor,patch) , None if the version could not be read
+    :rtype tuple
+    '''
+    try:
+        out = subprocess.check_output([star,'--version'],stderr=subprocess.STDOUT)
+    except (OSError,subprocess.CalledProcessError):
+        return None
+    match = re.search(r'(\d+)\.(\d+)\.(\d+)',out)
+    if match is None:
+        return None
+    return tuple(int(n) for n in match.groups())
+
+def check_star_version(star,minimum,reason):
+    ''' Fail unless the STAR executable is at least of some version
+    :param str star: path to the star executable
+    :param tuple minimum: the oldest version (major,minor,patch) usable
+    :param str reason: what needs this version , for the error message
+    :raises UserWarning: for an older or unknown version
+    '''
+    version = star_version(star)
+    if version is None or version < minimum:
+        raise UserWarning("{r} needs STAR >= {m} , the STAR configured ({s}) is {v}".format(
+            r=reason,m='.'.join(map(str,minimum)),s=star,v='.'.join(map(str,version)) if version else 'of an unknown version'))
+
 def star_load_index(star,genome_dir,program_options):
     ''' Load star index
     :param str star: path to the star executable
@@ -25,7 +58,54 @@ def star_remove_index(star,genome_dir,program_options):
     '''
     cmd = star + ' --genomeDir %s'%genome_dir + ' ' + program_options
     run_cmd(cmd)
+
+def star_shared_genome_options(program_options):
+    ''' Return the alignment options for using a genome already loaded in
+    shared memory by star_load_index , replacing any --genomeLoad option.
+    STAR can not sort BAMs with a shared genome without a limit on the sorting RAM
+    :param str program_options: options to use with star
+    :rtype str
+    '''
+    options = re.sub(r'\s*--genomeLoad\s+\S+','',program_options).strip()
+    options += ' --genomeLoad LoadAndKeep'
+    if 'SortedByCoordinate' in options and '--limitBAMsortRAM' not in options:
+        options += ' --limitBAMsortRAM %i'%BAM_SORT_RAM
+    return options
+
+def star_read_group_options(program_options,read_groups):
+    ''' Return the STAR options for aligning several fastqs in one pass ,
+    tagging the reads from each fastq with a read group
+    :param str program_options: options already used with star
+    :param list read_groups: the read group id for each fastq , in the order given to --readFilesIn
+    :rtype str
+    '''
+    options = ' --outSAMattrRGline ' + ' , '.join('ID:%s'%rg for rg in read_groups)
+    if '--outSAMattributes' not in program_options:
+        options += ' --outSAMattributes NH HI AS nM RG'
+    return options
     
+def star_read_files_command(program_options,r1):
+    ''' Return the STAR option for reading compressed fastqs , if needed
+    :param str program_options: options already used with star
+    :param str r1: path to r1 fastq
+    :rtype str
+    '''
+    if r1.endswith('.gz') and '--readFilesCommand' not in program_options:
+        return ' --readFilesCommand gunzip -c'
+    return ''
+
+def star_bam_input_options(program_options):
+    ''' Return the STAR options for aligning an unaligned , CB/UB tagged BAM
+    (as written by demultiplex_cells with output=bam) and keeping the tags
+    on the aligned reads , needs STAR >= STAR_BAM_INPUT_VERSION and samtools
+    :param str program_options: options already used with star
+    :rtype str
+    '''
+    options = ' --readFilesType SAM SE --readFilesSAMattrKeep CB UB'
+    if '--readFilesCommand' not in program_options:
+        options += ' --readFilesCommand samtools view'
+    return options
+
 def star_alignment(star,genome_dir,output_dir,logfile,program_options,r1,r2=None):
     '''
     Wrapper function to call STAR aligner with appropriate options
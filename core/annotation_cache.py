@@ -0,0 +1,189 @@
+'''
+An on disk cache of the annotation built from the gtf , so that the gtf is parsed
+once per genome instead of once per run.
+
+Each cache entry is a directory of .npy files , one per column , loaded with
+memory mapping :
+1. <gtf>.gene_index.<key> : the columns of a GeneIndex (see GeneIndex.to_columns) , for WTS
+2. <gtf>.gene_hash.<key>  : the rows of create_annotation_tables.create_gene_hash , for targeted
+
+The key hashes the content of the gtf and ERCC bed files , the species and the
+cache version , so an entry is never used for another annotation. Hashing a large
+gtf takes a few seconds , so the checksum of a file is remembered in a .sha1 stamp
+next to the cache , against the file's size and modification time.
+
+The cache is written next to the gtf by default. Entries are written to a
+temporary directory and renamed , other processes might be building the same
+entry. When the cache directory is not writable the annotation is built as
+before , without caching.
+
+Usage , to build the cache ahead of the runs , seqtype being wts or targeted :
+    python annotation_cache.py seqtype annotation.gtf ercc.bed species [cache_dir]
+'''
+
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import time
+import numpy as np
+## Modules from this project
+from create_annotation_tables import read_gene_intervals,create_gene_hash
+from gene_index import GeneIndex
+
+CACHE_VERSION = 1
+GENE_HASH_COLUMNS = ["genes","chroms","starts","ends","strands","names","gene_types"]
+
+def file_checksum(path,cache_dir):
+    ''' SHA-1 of a file's content , remembered in cache_dir so that an unchanged file is hashed once
+    :param str path: the file
+    :param str cache_dir: the cache directory
+    :rtype str
+    '''
+    stat = os.stat(path)
+    stamp = "{size} {mtime!r}".format(size=stat.st_size,mtime=stat.st_mtime)
+    stamp_file = os.path.join(cache_dir,"{name}.{h}.sha1".format(
+        name=os.path.basename(path),h=hashlib.sha1(os.path.abspath(path)).hexdigest()[:8]))
+    if os.path.exists(stamp_file):
+        with open(stamp_file,'r') as IN:
+            cached_stamp,checksum = IN.read().rstrip('\n').rsplit(' ',1)
+        if cached_stamp == stamp:
+            return checksum
+    h = hashlib.sha1()
+    with open(path,'rb') as IN:
+        for block in iter(lambda:IN.read(1 << 20),''):
+            h.update(block)
+    checksum = h.hexdigest()
+    try:
+        temp = stamp_file + ".{}.tmp".format(os.getpid())
+        with open(temp,'w') as OUT:
+            OUT.write(stamp+' '+checksum+'\n')
+        os.rename(temp,stamp_file)
+    except (IOError,OSError):
+        pass ## not writable , hash again next time
+    return checksum
+
+def cache_path(kind,annotation_gtf,ercc_bed,species,cache_dir):
+    ''' The directory of a cache entry
+    :param str kind: gene_index or gene_hash
+    :param str annotation_gtf: the gtf file
+    :param str ercc_bed: the ERCC bed file
+    :param str species: species name , only part of the gene_index key
+    :param str cache_dir: the cache directory
+    :rtype str
+    '''
+    h = hashlib.sha1()
+    h.update("{v}:{k}:{s}".format(v=CACHE_VERSION,k=kind,s=species.lower() if kind == "gene_index" else ""))
+    h.update(file_checksum(annotation_gtf,cache_dir))
+    h.update(file_checksum(ercc_bed,cache_dir))
+    return os.path.join(cache_dir,"{name}.{kind}.{key}".format(
+        name=os.path.basename(annotation_gtf),kind=kind,key=h.hexdigest()[:16]))
+
+def save_columns(path,columns):
+    ''' Write a cache entry , a .npy file per column
+    :param str path: the entry directory
+    :param dict columns: column name -> numpy array
+    '''
+    temp = path + ".{}.tmp".format(os.getpid())
+    os.mkdir(temp)
+    for name,column in columns.iteritems():
+        np.save(os.path.join(temp,name+".npy"),column)
+    try:
+        os.rename(temp,path)
+    except OSError: ## written by another process in the meantime
+        shutil.rmtree(temp,ignore_errors=True)
+
+def load_columns(path):
+    ''' Memory map the columns of a cache entry
+    :param str path: the entry directory
+    :returns column name -> numpy array
+    :rtype dict
+    '''
+    return dict((f[:-len(".npy")],np.load(os.path.join(path,f),mmap_mode='r'))
+                for f in os.listdir(path) if f.endswith(".npy"))
+
+def writable_cache_dir(annotation_gtf,cache_dir,logger):
+    ''' The cache directory , None if it can not be written
+    :param str annotation_gtf: the gtf file
+    :param str cache_dir: the cache directory , None or empty for the directory of the gtf
+    :param object logger: the logger
+    :rtype str
+    '''
+    if not cache_dir:
+        cache_dir = os.path.dirname(os.path.abspath(annotation_gtf))
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+    if os.path.isdir(cache_dir) and os.access(cache_dir,os.W_OK):
+        return cache_dir
+    logger.warning("Annotation cache directory not writable , not caching : {}".format(cache_dir))
+    return None
+
+def load_gene_index(annotation_gtf,ercc_bed,species,cache_dir=None,logger=None):
+    ''' The GeneIndex of an annotation , from the cache , building and caching it on a miss
+    :param str annotation_gtf: the gtf file
+    :param str ercc_bed: the ERCC bed file
+    :param str species: species name (qiagen's internal alias)
+    :param str cache_dir: the cache directory , None for the directory of the gtf
+    :param object logger: the logger
+    :rtype GeneIndex
+    '''
+    logger = logger or logging.getLogger(__name__)
+    start = time.time()
+    cache_dir = writable_cache_dir(annotation_gtf,cache_dir,logger)
+    path = cache_path("gene_index",annotation_gtf,ercc_bed,species,cache_dir) if cache_dir else None
+    if path and os.path.isdir(path):
+        gene_index = GeneIndex.from_columns(load_columns(path))
+        logger.info("Annotation cache hit , loaded the gene index of {n} intervals in {t:.3f} s : {p}".format(
+            n=len(gene_index),t=time.time()-start,p=path))
+        return gene_index
+    ngenes,intervals = read_gene_intervals(annotation_gtf,ercc_bed,species)
+    gene_index = GeneIndex(set(intervals)) ## identical intervals are stored once , as in the IntervalTree
+    if path:
+        save_columns(path,gene_index.to_columns())
+    logger.info("Annotation cache miss , built the gene index of {ngenes} genes , {n} intervals in {t:.1f} s : {p}".format(
+        ngenes=ngenes,n=len(gene_index),t=time.time()-start,p=path))
+    return gene_index
+
+def load_gene_hash(annotation_gtf,ercc_bed,cache_dir=None,logger=None):
+    ''' The gene annotation dict of create_gene_hash , from the cache , building and caching it on a miss
+    :param str annotation_gtf: the gtf file
+    :param str ercc_bed: the ERCC bed file
+    :param str cache_dir: the cache directory , None for the directory of the gtf
+    :param object logger: the logger
+    :returns gene -> [chrom,start,end,strand,gene,gene_type]
+    :rtype dict
+    '''
+    logger = logger or logging.getLogger(__name__)
+    start = time.time()
+    cache_dir = writable_cache_dir(annotation_gtf,cache_dir,logger)
+    path = cache_path("gene_hash",annotation_gtf,ercc_bed,"",cache_dir) if cache_dir else None
+    if path and os.path.isdir(path):
+        columns = load_columns(path)
+        rows = zip(*[columns[name].tolist() for name in GENE_HASH_COLUMNS])
+        gene_hash = dict((row[0],list(row[1:])) for row in rows)
+        logger.info("Annotation cache hit , loaded {n} gene annotations in {t:.3f} s : {p}".format(
+            n=len(gene_hash),t=time.time()-start,p=path))
+        return gene_hash
+    gene_hash = create_gene_hash(annotation_gtf,ercc_bed)
+    if path:
+        genes = sorted(gene_hash)
+        columns = dict((name,np.array([gene_hash[gene][i] for gene in genes],dtype=np.str_))
+                       for i,name in enumerate(GENE_HASH_COLUMNS[1:]))
+        columns["genes"] = np.array(genes,dtype=np.str_)
+        save_columns(path,columns)
+    logger.info("Annotation cache miss , built {n} gene annotations in {t:.1f} s : {p}".format(
+        n=len(gene_hash),t=time.time()-start,p=path))
+    return gene_hash
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,format="%(asctime)s %(message)s")
+    seqtype,annotation_gtf,ercc_bed,species = sys.argv[1:5]
+    cache_dir = sys.argv[5] if len(sys.argv) > 5 else None
+    if seqtype.upper() == 'WTS':
+        load_gene_index(annotation_gtf,ercc_bed,species,cache_dir)
+    else:
+        load_gene_hash(annotation_gtf,ercc_bed,cache_dir)
@@ -0,0 +1,187 @@
+'''
+Lookup tables for correcting sequencing errors in the cell index.
+
+Every cell index used in the experiment is expanded into its neighbours
+(substitutions within a Hamming distance , and optionally a single insertion
+or deletion). Neighbours made of A/C/G/T only are keyed by their 2-bit packed
+integer code , neighbours containing an N are kept in a small side table keyed
+by the sequence. The value for a key packs the slot of the cell index (its
+position in the list of cell indices used) and the type of correction :
+
+    value = (slot << 3) | correction
+
+A neighbour which is equally close to more than one cell index is marked
+AMBIGUOUS instead of being assigned to either of them.
+'''
+
+import hashlib
+import os
+import numpy as np
+
+# types of correction , stored in the lower 3 bits of a table value
+EXACT      = 0
+HAMMING_1  = 1
+HAMMING_2  = 2
+DELETION   = 3 # cell index on the read is missing a base , the UMI starts 1 base early
+INSERTION  = 4 # cell index on the read has an extra base , the UMI starts 1 base late
+CORRECTION_NAMES = ["exact match","hamming distance 1","hamming distance 2","deletion","insertion"]
+# number of edits for each correction type , used to pick the closest cell index
+CORRECTION_EDITS = [0,1,2,1,1]
+AMBIGUOUS  = -1
+
+BASES = "ACGTN"
+BASE_CODE = {"A":0,"C":1,"G":2,"T":3}
+TABLE_VERSION = 1
+
+def encode(seq):
+    ''' Pack a A/C/G/T sequence into an integer , 2 bits per base
+    :param str seq: the dna sequence
+    :return the packed code , -1 if the sequence has any other character
+    :rtype int
+    '''
+    code = 0
+    for b in seq:
+        if b not in BASE_CODE:
+            return -1
+        code = (code << 2) | BASE_CODE[b]
+    return code
+
+def substitutions(seq,k):
+    ''' All sequences with exactly k substitutions (including N) of seq
+    :param str seq: the dna sequence
+    :param int k: number of substitutions , 1 or 2
+    :yields the mutated sequences
+    '''
+    for i in xrange(len(seq)):
+        for b in BASES:
+            if b == seq[i]:
+                continue
+            temp = seq[:i] + b + seq[i+1:]
+            if k == 1:
+                yield temp
+            else:
+                for j in xrange(i+1,len(seq)):
+                    for b2 in BASES:
+                        if b2 != seq[j]:
+                            yield temp[:j] + b2 + temp[j+1:]
+
+def deletions(seq):
+    ''' Sequences read in place of seq when one of its bases is deleted ,
+    the following base on the read is unknown
+    :param str seq: the dna sequence
+    :yields the mutated sequences
+    '''
+    for i in xrange(len(seq)):
+        for b in BASES:
+            yield seq[:i] + seq[i+1:] + b
+
+def insertions(seq):
+    ''' Sequences read in place of seq when a base is inserted , truncated to the length of seq
+    :param str seq: the dna sequence
+    :yields the mutated sequences
+    '''
+    for i in xrange(1,len(seq)):
+        for b in BASES:
+            yield seq[:i] + b + seq[i:-1]
+
+def neighbours(seq,max_hamming,allow_indel):
+    ''' All sequences to correct to seq along with the type of correction
+    :param str seq: the cell index
+    :param int max_hamming: max number of substitutions , 0-2
+    :param bool allow_indel: whether to allow a single insertion or deletion
+    :yields tuples of (sequence,correction)
+    '''
+    yield (seq,EXACT)
+    if max_hamming >= 1:
+        for m in substitutions(seq,1):
+            yield (m,HAMMING_1)
+    if max_hamming >= 2:
+        for m in substitutions(seq,2):
+            yield (m,HAMMING_2)
+    if allow_indel:
+        for m in deletions(seq):
+            yield (m,DELETION)
+        for m in insertions(seq):
+            yield (m,INSERTION)
+
+def build_correction_table(cell_indices,max_hamming,allow_indel):
+    ''' Build the lookup tables for the given cell indices
+    :param list cell_indices: the cell indices used , in slot order
+    :param int max_hamming: max number of substitutions , 0-2
+    :param bool allow_indel: whether to allow a single insertion or deletion
+    :return (packed code -> value , sequence -> value for sequences with an N)
+    :rtype tuple of dicts
+    '''
+    best = {} # sequence -> (edits,correction,slot)
+    for slot,cell_index in enumerate(cell_indices):
+        for seq,correction in neighbours(cell_index,max_hamming,allow_indel):
+            edits = CORRECTION_EDITS[correction]
+            if seq not in best:
+                best[seq] = (edits,correction,slot)
+                continue
+            prev_edits,prev_correction,prev_slot = best[seq]
+            if edits < prev_edits:
+                best[seq] = (edits,correction,slot)
+            elif edits == prev_edits:
+                if prev_slot == AMBIGUOUS:
+                    continue
+                if slot != prev_slot: # equally close to two cell indices
+                    best[seq] = (edits,prev_correction,AMBIGUOUS)
+                elif correction < prev_correction:
+                    best[seq] = (edits,correction,slot)
+
+    table = {}
+    n_table = {}
+    for seq,(edits,correction,slot) in best.iteritems():
+        value = AMBIGUOUS if slot == AMBIGUOUS else (slot << 3) | correction
+        code = encode(seq)
+        if code < 0:
+            n_table[seq] = value
+        else:
+            table[code] = value
+    return (table,n_table)
+
+def cache_key(cell_index_file,cell_indices,max_hamming,allow_indel):
+    ''' Key for the cached table , the hash of the cell index file and the table parameters
+    :rtype str
+    '''
+    h = hashlib.sha1()
+    with open(cell_index_file,'rb') as IN:
+        h.update(IN.read())
+    h.update(",".join(cell_indices))
+    h.update("{v}:{m}:{i}".format(v=TABLE_VERSION,m=max_hamming,i=int(allow_indel)))
+    return h.hexdigest()
+
+def load_correction_table(cell_index_file,cell_indices,max_hamming,allow_indel,cache_dir,logger=None):
+    ''' Load the lookup tables from the on disk cache , building and caching them if needed
+    :param str cell_index_file: the cell index file
+    :param list cell_indices: the cell indices used , in slot order
+    :param int max_hamming: max number of substitutions , 0-2
+    :param bool allow_indel: whether to allow a single insertion or deletion
+    :param str cache_dir: directory for the cache files
+    :param object logger: the logger
+    :return (packed code -> value , sequence -> value for sequences with an N)
+    :rtype tuple of dicts
+    '''
+    assert max_hamming in [0,1,2], "Cell index correction supports a hamming distance of 0,1 or 2"
+    key = cache_key(cell_index_file,cell_indices,max_hamming,allow_indel)
+    cache_file = os.path.join(cache_dir,"cell_index_table.{}.npz".format(key))
+    if os.path.exists(cache_file):
+        if logger:
+            logger.info("Loading cell index correction table from cache : {}".format(cache_file))
+        cached = np.load(cache_file)
+        table = dict(zip(cached["codes"].tolist(),cached["values"].tolist()))
+        n_table = dict(zip(cached["n_seqs"].tolist(),cached["n_values"].tolist()))
+        return (table,n_table)
+
+    table,n_table = build_correction_table(cell_indices,max_hamming,allow_indel)
+    if logger:
+        logger.info("Built cell index correction table with {n} entries , caching to : {f}".format(
+            n=len(table)+len(n_table),f=cache_file))
+    ## Write to a temp file and rename , other samples might be building the same table
+    temp = cache_file + ".{}.tmp.npz".format(os.getpid())
+    np.savez(temp,
+             codes=np.array(table.keys(),dtype=np.int64),values=np.array(table.values(),dtype=np.int32),
+             n_seqs=np.array(n_table.keys(),dtype=np.str_),n_values=np.array(n_table.values(),dtype=np.int32))
+    os.rename(temp,cache_file)
+    return (table,n_table)
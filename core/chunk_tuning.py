@@ -0,0 +1,103 @@
+'''
+Auto tuning of the chunks demultiplexed by demultiplex_cells.demux.
+
+The size of the chunk read from each fastq (buffer_size) and the number of chunks
+held at a time (the chunks processed in each batch , or the chunks in flight when
+streaming) start from the configured values , capped to the memory budget. They are
+tuned once the workers have processed the first chunks :
+1. the chunk size is scaled so that a worker spends about TARGET_CHUNK_SECONDS on
+   a chunk , which amortises the cost of handing a chunk to a worker and of writing
+   its records to every cell file , within MIN_CHUNK_SIZE and the memory budget
+2. when streaming , if the workers waited on the reader for input longer than the
+   reader waited for a free chunk , the chunks in flight are reduced to those needed
+   to keep the workers busy. The memory held by the others is released as they are
+   written out
+The pool and the shared memory ring are sized for the configured number of chunks ,
+hence the chunks held at a time are never increased.
+'''
+
+import math
+
+TARGET_CHUNK_SECONDS = 1.0
+MIN_CHUNK_SIZE = 1024**2
+## The memory held for each chunk , in multiples of the chunk size : the R1 and R2 chunks ,
+## their copy in the worker and the cell fastq records sent back
+MEMORY_PER_CHUNK = 5
+
+class ChunkTuner(object):
+    ''' Tune the chunk size and the chunks held at a time on the first chunks of a run
+    '''
+    def __init__(self,buffer_size,in_flight,memory_budget,trial_chunks,streams,pool,logger):
+        ''' Class constructor
+        :param int buffer_size: the configured size in bytes of a chunk of each fastq
+        :param int in_flight: the configured number of chunks held at a time
+        :param int memory_budget: the memory in bytes the chunks may hold
+        :param int trial_chunks: the number of chunks processed before tuning
+        :param tuple streams: the R1 and R2 readers , see fastq_io.open_reader
+        :param WorkerPool pool: the demux pool , see executor
+        :param object logger: the logger
+        '''
+        self.memory_budget = memory_budget
+        self.trial_chunks = trial_chunks
+        self.streams = streams
+        self.pool = pool
+        self.logger = logger
+        self.in_flight = max(1,min(in_flight,memory_budget/(MEMORY_PER_CHUNK*MIN_CHUNK_SIZE)))
+        self.max_chunk_size = max(MIN_CHUNK_SIZE,memory_budget/(MEMORY_PER_CHUNK*self.in_flight)/MIN_CHUNK_SIZE*MIN_CHUNK_SIZE)
+        self.chunk_size = min(buffer_size,self.max_chunk_size)
+        self.chunks_read = 0
+        self.slots_to_retire = 0
+        self.tuned = False
+        self.start = (pool.tasks,pool.busy,self.read_seconds())
+        logger.info("Auto tuning : memory budget {m} MB ; starting with buffer size {b:.1f} MB , {c} chunks at a time ; tuned after {n} chunks".format(
+            m=memory_budget/1024**2,b=self.chunk_size/float(1024**2),c=self.in_flight,n=trial_chunks))
+
+    def read_seconds(self):
+        ''' The seconds spent reading the fastqs so far
+        :rtype float
+        '''
+        return sum(stream.seconds for stream in self.streams)
+
+    def next_chunk_size(self):
+        ''' The size in bytes of the next chunk read from each fastq
+        :rtype int
+        '''
+        self.chunks_read += 1
+        return self.chunk_size
+
+    def retire_slot(self):
+        ''' Streaming only , whether to drop the slot of a chunk written out rather than reuse it
+        :rtype bool
+        '''
+        if self.slots_to_retire > 0:
+            self.slots_to_retire -= 1
+            return True
+        return False
+
+    def update(self,reader_stall=0.0,input_stall=0.0):
+        ''' Tune once the workers have processed enough chunks , called for each chunk processed
+        :param float reader_stall: streaming only , seconds the reader waited for a free chunk so far
+        :param float input_stall: streaming only , seconds the workers waited for a chunk to be read so far
+        '''
+        tasks = self.pool.tasks - self.start[0]
+        if self.tuned or tasks < self.trial_chunks:
+            return
+        self.tuned = True
+        process = (self.pool.busy - self.start[1])/tasks
+        read = (self.read_seconds() - self.start[2])/max(1,self.chunks_read)
+        chunk_size,in_flight = self.chunk_size,self.in_flight
+        if process > 0:
+            scaled = int(chunk_size*TARGET_CHUNK_SECONDS/process)
+            self.chunk_size = max(MIN_CHUNK_SIZE,min(self.max_chunk_size,scaled/MIN_CHUNK_SIZE*MIN_CHUNK_SIZE))
+        if input_stall > reader_stall and read > 0:
+            ## the workers the reader keeps busy , a chunk being read and a chunk being written
+            needed = min(self.pool.cores,int(math.ceil(process/read))) + 2
+            if needed < in_flight:
+                self.in_flight = needed
+                self.slots_to_retire = in_flight - needed
+        self.logger.info(("Auto tuning over {n} chunks : {p:.2f} s per chunk in a worker , {r:.2f} s reading ; "
+                          "reader waited {rs:.1f} s for a free chunk , workers waited {ws:.1f} s for input").format(
+                              n=tasks,p=process,r=read,rs=reader_stall,ws=input_stall))
+        self.logger.info("Auto tuning : buffer size {b0:.1f} -> {b:.1f} MB ; chunks at a time {c0} -> {c} ; memory {m:.0f} MB".format(
+            b0=chunk_size/float(1024**2),b=self.chunk_size/float(1024**2),c0=in_flight,c=self.in_flight,
+            m=MEMORY_PER_CHUNK*self.chunk_size*self.in_flight/float(1024**2)))
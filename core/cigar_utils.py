@@ -0,0 +1,75 @@
+'''
+CIGAR helpers shared by find_primer and find_gene , working on the (operation , length)
+tuples of pysam's AlignedSegment.cigartuples in O(number of operations) , without
+expanding the CIGAR to a base per character. A CIGAR string is parsed into the same
+tuples , see as_cigartuples.
+
+The operations counted are those the CIGAR string parsing of find_primer and find_gene
+used to match : '=' , which STAR does not write , was skipped and is still skipped.
+'''
+
+import re
+
+## pysam's operation codes , in the order of the CIGAR characters
+CIGAR_CHARS = "MIDNSHP=XB"
+MATCH,INSERTION,DELETION,SKIP,SOFT_CLIP,HARD_CLIP,PAD,EQUAL,DIFF,BACK = range(len(CIGAR_CHARS))
+CIGAR_PATTERN = re.compile(r'([0-9]+)([A-Z])')
+## The operations walked along the read by endogenous_seq_match (all but N , D , H and P)
+QUERY_WALK_OPS = frozenset([MATCH,INSERTION,SOFT_CLIP,DIFF,BACK])
+## The operations counted for the end of a read (all but I , S , H and P)
+REFERENCE_OPS = frozenset([MATCH,DELETION,SKIP,DIFF,BACK])
+REFERENCE_OPS_NO_SKIP = frozenset([MATCH,DELETION,DIFF,BACK])
+
+def as_cigartuples(cigar):
+    ''' The (operation , length) tuples of a CIGAR
+    :param object cigar: pysam cigartuples , or a CIGAR string such as 10S80M1D200N20M ,
+                         None for an unmapped read
+    :rtype list
+    '''
+    if cigar is None:
+        return []
+    if isinstance(cigar,basestring):
+        return [(CIGAR_CHARS.index(op),int(length)) for length,op in CIGAR_PATTERN.findall(cigar)
+                if op in CIGAR_CHARS]
+    return cigar
+
+def walk_length(cigartuples,ops=QUERY_WALK_OPS):
+    ''' The number of bases of some operations
+    :param list cigartuples: (operation , length) tuples
+    :param frozenset ops: the operations counted
+    :rtype int
+    '''
+    return sum(length for op,length in cigartuples if op in ops)
+
+def count_in_window(cigartuples,start,stop,count_op=MATCH,walk_ops=QUERY_WALK_OPS):
+    ''' The number of bases of an operation in a window of the walk along some operations ,
+    i.e. expanded_cigar[start:stop].count(count_op) with expanded_cigar the list of the
+    operation of each base of walk_ops
+    :param list cigartuples: (operation , length) tuples
+    :param int start: the start of the window , from 0
+    :param int stop: the end of the window , excluded
+    :param int count_op: the operation counted
+    :param frozenset walk_ops: the operations walked
+    :rtype int
+    '''
+    count = 0
+    pos = 0
+    for op,length in cigartuples:
+        if op not in walk_ops:
+            continue
+        end = pos + length
+        if op == count_op and end > start and pos < stop:
+            count += min(end,stop) - max(pos,start)
+        pos = end
+        if pos >= stop:
+            break
+    return count
+
+def reference_end(pos,cigartuples,skip_introns=False):
+    ''' The end of a read on the reference
+    :param int pos: the start of the read on the reference
+    :param list cigartuples: (operation , length) tuples
+    :param bool skip_introns: whether N (spliced introns) does not count
+    :rtype int
+    '''
+    return pos + walk_length(cigartuples,REFERENCE_OPS_NO_SKIP if skip_introns else REFERENCE_OPS)
@@ -1,7 +1,11 @@
 import glob
 import os
 import sys
+import resource
+from itertools import izip_longest
 from collections import defaultdict,OrderedDict
+## Modules from this project
+from count_order import is_count_row_order
 
         
 def float_to_string(val):
@@ -11,6 +15,52 @@ def float_to_string(val):
     '''
     return ('%.2f' % val).rstrip('0').rstrip('.')
 
+def raise_open_files_limit(nfiles):
+    ''' Raise the soft limit of open files , if needed to open nfiles at once
+    :param int nfiles: the number of files to be opened together
+    '''
+    needed = nfiles + 64 ## headroom for the files already open
+    soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or needed <= soft:
+        return
+    if hard != resource.RLIM_INFINITY and needed > hard:
+        raise Exception("Can not merge {n} count files at once , the open files limit is {hard}".format(n=nfiles,hard=hard))
+    resource.setrlimit(resource.RLIMIT_NOFILE,(needed,hard))
+
+def iterate_count_rows(files_to_merge,wts):
+    ''' Merge count files line by line , every file having a row for every gene/primer
+    in count file order (see count_order) , as count_umi writes them. Only a line
+    of each file is held in memory at a time
+
+    :param list files_to_merge: the count files of the cells
+    :param bool wts: whether the rows are genes (True) or primers (False)
+    :returns an iterator of (tab separated annotation , list of the count of each file as str)
+    :rtype generator
+    '''
+    if not files_to_merge:
+        return
+    with open(files_to_merge[0],'r') as IN:
+        rows = [tuple(line.rstrip('\n').split('\t')[:-1]) for line in IN]
+    if not is_count_row_order(rows,wts):
+        raise Exception("Count file not in count file order , count the cell again : {}".format(files_to_merge[0]))
+    raise_open_files_limit(len(files_to_merge))
+    handles = [open(f,'r') for f in files_to_merge]
+    try:
+        for lines in izip_longest(*handles):
+            if None in lines:
+                raise Exception("Count files with different numbers of genes/primers : {}".format(
+                    files_to_merge[lines.index(None)]))
+            fields = [line.rstrip('\n').rsplit('\t',1) for line in lines]
+            annotation = fields[0][0]
+            for f,(other,count) in zip(files_to_merge,fields):
+                if other != annotation:
+                    raise Exception("Count files with different genes/primers : {f} has {a} instead of {b}".format(
+                        f=f,a=other,b=annotation))
+            yield (annotation,[count for other,count in fields])
+    finally:
+        for IN in handles:
+            IN.close()
+
 def merge_count_files(basedir,out_file,sample_name,wts,ncells,files_to_merge):
     ''' Merge count files from different cells
 
@@ -21,22 +71,14 @@ def merge_count_files(basedir,out_file,sample_name,wts,ncells,files_to_merge):
     :param int ncells: the number of cell indices
     :param list files_to_merge: which files to merge
     '''
-    i = 0
-    MT = defaultdict(lambda:defaultdict(int))
     cells = range(1,ncells+1)
     cell_header = '\t'.join(sample_name+'_Cell'+str(cell) for cell in cells)
-    for f in files_to_merge:
+    ## Column of each cell among the files , None for a cell without a count file
+    column = {}
+    for i,f in enumerate(files_to_merge):
         cell = os.path.dirname(f).split('/')[-1].split('_')[0].strip('Cell')
-        with open(f,'r') as IN:
-            for line in IN:
-                if wts:
-                    k1,k2,k3,k4,k5,k6,mt = line.rstrip('\n').split('\t')
-                    key = (k1,k2,k3,k4,k5,k6)
-                else:
-                    k1,k2,k3,k4,k5,k6,k7,mt = line.rstrip('\n').split('\t')
-                    key = (k1,k2,k3,k4,k5,k6,k7)
-                MT[key][cell] = mt
-    last_key = cell
+        column[cell] = i
+    picks = [column.get(str(cell_num)) for cell_num in cells]
 
     if wts:
         header = "gene id\tgene\tstrand\tchrom\tloc 5' GRCH38\tloc 3' GRCH38\t{cells}\n"
@@ -44,14 +86,8 @@ def merge_count_files(basedir,out_file,sample_name,wts,ncells,files_to_merge):
         header = "gene id\tgene\tstrand\tchrom\tloc 5' GRCH38\tloc 3' GRCH38\tprimer seq\t{cells}\n"
     with open(out_file,'w') as OUT:
         OUT.write(header.format(cells = cell_header))
-        for key in MT:
-            out = '\t'.join(key)
-            for cell in cells:
-                if str(cell) not in MT[key]:
-                    out = out + '\t0'
-                else:
-                    out = out + '\t'+MT[key][str(cell)]
-            OUT.write(out+'\n')
+        for annotation,counts in iterate_count_rows(files_to_merge,wts):
+            OUT.write(annotation+'\t'+'\t'.join('0' if i is None else counts[i] for i in picks)+'\n')
 
 def merge_metric_files(basedir,temp_metric_file,metric_file,metric_file_cell,sample_name,wts,ncells,editdistance,files_to_merge):
     ''' Merge the metrics from primer/gene finding
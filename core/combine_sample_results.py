@@ -3,7 +3,11 @@ import glob
 import os
 import natsort
 from collections import defaultdict,OrderedDict
-from combine_cell_results import float_to_string
+from combine_cell_results import float_to_string,iterate_count_rows
+from sparse_counts import MatrixMarketWriter,DENSE_HEADER_GENE,DENSE_HEADER_PRIMER
+
+## Output formats for the combined count files
+COUNT_OUTPUT_FORMATS = ["dense","sparse","both"]
 
 class MyOrderedDict(OrderedDict):
     def __missing__(self,key):
@@ -14,7 +18,8 @@ def clean_for_clustering(combined_cell_metrics_file,combined_umi_counts_file):
     ''' Clean the header line in the output file for clustering analysis
 
     :param: str combined_cell_metrics: the path to the combined metrics file
-    :param: str combined_cell_metrics: the path to the combined umi counts file
+    :param: str combined_cell_metrics: the path to the combined umi counts file , None for sparse
+                                       counts , whose features file already has the clean header
     ''' 
     clean_cells = []
     clean_header_metrics = ["reads_total","reads_used_aligned_to_genome","reads_used_aligned_to_ERCC","UMIs","detected_genes"]
@@ -33,6 +38,8 @@ def clean_for_clustering(combined_cell_metrics_file,combined_umi_counts_file):
                 cell = contents[0]
                 print >> OUT,line
 
+    if combined_umi_counts_file is None:
+        return
     with open(combined_umi_counts_file,'r') as IN,open(combined_umi_counts_file+'.clean','w') as OUT:
         i = 0
         for line in IN:
@@ -48,39 +55,6 @@ def clean_for_clustering(combined_cell_metrics_file,combined_umi_counts_file):
             else:                
                 print >> OUT,line
            
-def sort_by_cell(outputfile,wts):
-    ''' Sort the output count files by Sample_Cells
-
-    :param: str outputfile: path to the output file
-    :param: bool wts: whether the file corresponds to a primer/gene file
-    '''
-    temp=outputfile+'.sorted'
-    with open(outputfile,'r') as IN,open(temp,'w') as OUT:
-        i=0
-        for line in IN:
-            contents=line.strip('\n').split('\t')
-            if i == 0: #header
-                contents = line.strip('\n').split('\t')
-                if wts:
-                    anno_header = '\t'.join(contents[0:6])
-                    cells = contents[6:]
-                else:
-                    anno_header = '\t'.join(contents[0:7])
-                    cells = contents[7:]                    
-                    
-                sorted_cells = '\t'.join(natsort.natsorted(cells))
-                OUT.write(anno_header+'\t'+sorted_cells+'\n')
-                i=1
-                continue
-            if wts:
-                anno = '\t'.join(contents[0:6])
-                sorted_vals = [x for _,x in natsort.natsorted(zip(cells,contents[6:]))]
-            else:
-                anno = '\t'.join(contents[0:7])
-                sorted_vals = [x for _,x in natsort.natsorted(zip(cells,contents[7:]))]               
-            OUT.write(anno+'\t'+'\t'.join(sorted_vals)+'\n')
-    os.system('mv {temp} {outputfile}'.format(temp=temp,outputfile=outputfile))
-
 def read_cell_file(cfile,metric_dict,is_lowinput):
     ''' Read a cell metrics file and return the parsed metrics as a dict
 
@@ -173,7 +147,7 @@ def combine_sample_metrics(files_to_merge,outfile,is_lowinput,cells_dropped,outp
                     found=True
                     dropped_metrics[new_metric][sample_index]+= int(val)
                     reads_total = int(val)
-                else:
+                elif metric == 'after_qc_reads':
                     after_qc = int(val)
         dropped_metrics['reads dropped, less than 25 bp'][sample_index]+= reads_total - after_qc
         
@@ -268,7 +242,15 @@ def combine_cell_metrics(files_to_merge,outfile,is_lowinput,cells_to_restrict):
             
     return return_metrics
 
-def combine_count_files(files_to_merge,outfile,wts,cells_to_restrict=[]):
+def max_count(count_file):
+    ''' The largest UMI count of a cell count file
+    :param str count_file: the count file
+    :rtype int
+    '''
+    with open(count_file,'r') as IN:
+        return max([int(line.rsplit('\t',1)[1]) for line in IN] or [0])
+
+def combine_count_files(files_to_merge,outfile,wts,cells_to_restrict=[],output_format="dense"):
     ''' Function to combine cells from different samples into 1 file
     The directory strucuture of a typical run loooks like :
             <run_dir>
@@ -281,73 +263,63 @@ def combine_count_files(files_to_merge,outfile,wts,cells_to_restrict=[]):
                     --- cell1
                       --- cell1_Sample2
 
+    The cell count files are already in count file order (see count_order) , so they
+    are merged line by line into the output , a row at a time , with the cells in
+    natural sort order. For wts a first pass finds the cells to keep
+
     :param list files_to_merge: full path to the files to merge
     :param str outfile: The combined outputfile to write to
     :param bool wts: Whether this was whole transcriptome sequencing 
     :param list cells_to_restrict: Restrict cells to only this set when writing the primer count file
                                    This list is based on the criteria mentioned below
+    :param str output_format: dense (a tsv with a column per cell) , sparse (Matrix Market ,
+                              see sparse_counts) or both
     
     :return The cells written to the file , any cell with < 5 UMIs for each gene is not written 
             cells which were dropped
             sum of UMI count over all cells
     :rtype tuple of (list,list,int) 
     ''' 
-    i = 0
-    UMI = defaultdict(lambda:defaultdict(int))
-    header_cells = set()
-    cells_dropped = set()
-    ## Iterate over the files to merge
+    assert output_format in COUNT_OUTPUT_FORMATS, "Incorrect count output format specification"
+    cell_keys = []
     for f in files_to_merge:
         cell = os.path.dirname(f).split('/')[-1].split('_')[0].strip('Cell')
         sample_name = os.path.dirname(f).split('/')[-2]
-        check_counts = []
-        with open(f,'r') as IN:
-            cell_key = sample_name+'_'+str(cell)
-            for line in IN:
-                if wts:
-                    k1,k2,k3,k4,k5,k6,umi = line.rstrip('\n').split('\t')
-                    key = (k1,k2,k3,k4,k5,k6)
-                else:
-                    k1,k2,k3,k4,k5,k6,k7,umi = line.rstrip('\n').split('\t')
-                    key = (k1,k2,k3,k4,k5,k6,k7)
-                ## Hash the umi counts by annotation and cells
-                UMI[key][cell_key] = umi
-                check_counts.append(int(umi))
-                
-            if not wts:
-                if cell_key in cells_to_restrict:
-                    header_cells.add(cell_key)
-                else:
-                    cells_dropped.add(cell_key)
-            else:
-                if any(e >= 5 for e in check_counts): ## Check to make sure the cell has atleast 5 UMI count for any 1 gene
-                    header_cells.add(cell_key)
-                else:
-                    cells_dropped.add(cell_key)
-    ## Create header
-    if wts:
-        header = "gene id\tgene\tstrand\tchrom\tloc 5'\tloc 3'\t{cells}\n"
+        cell_keys.append(sample_name+'_'+str(cell))
+    if wts: ## Check to make sure the cell has atleast 5 UMI count for any 1 gene
+        header_cells = set(key for key,f in zip(cell_keys,files_to_merge) if max_count(f) >= 5)
     else:
-        header = "gene id\tgene\tstrand\tchrom\tloc 5'\tloc 3'\tprimer seq\t{cells}\n"
-    temp = '\t'.join(list(header_cells))
-    head = header.format(cells=temp)
-    ## Print output
+        header_cells = set(key for key in cell_keys if key in cells_to_restrict)
+    cells_dropped = set(cell_keys) - header_cells
+    ## Order the cells , the column of each among the files to merge
+    cells = natsort.natsorted(header_cells)
+    column = dict((key,i) for i,key in enumerate(cell_keys))
+    picks = [column[key] for key in cells]
+
     total_UMIs = 0
-    with open(outfile,'w') as OUT:
-        OUT.write(head)
-        for key in UMI:
-            umi_for_gene = 0
-            out = '\t'.join(key)
-            for cell in header_cells:
-                if cell not in UMI[key]:
-                    raise Exception("Cell not hashed for Gene/Primer : {cell}-{k}".format(cell=cell,k=key))
-                else:
-                    out = out + '\t{}'.format(UMI[key][cell])                    
-                    total_UMIs+=int(UMI[key][cell])
-                    umi_for_gene+=int(UMI[key][cell])
-            if umi_for_gene > 0 or not wts: ## Do not write genes with no UMIs for any cell (only in wts)
-                OUT.write(out+'\n')
-    ## Sort the count file
-    sort_by_cell(outfile,wts)
+    OUT = None
+    sparse = None
+    try:
+        if output_format != "sparse":
+            OUT = open(outfile,'w')
+            OUT.write((DENSE_HEADER_GENE if wts else DENSE_HEADER_PRIMER).format(cells='\t'.join(cells)))
+        if output_format != "dense":
+            sparse = MatrixMarketWriter(outfile,cells,wts)
+        for annotation,counts in iterate_count_rows(files_to_merge,wts):
+            counts = [counts[i] for i in picks]
+            umis = [int(count) for count in counts]
+            row_UMIs = sum(umis)
+            if wts and row_UMIs == 0: ## Drop genes with no UMIs for any cell
+                continue
+            total_UMIs+=row_UMIs
+            if OUT:
+                OUT.write(annotation+'\t'+'\t'.join(counts)+'\n')
+            if sparse:
+                sparse.add_row(annotation,umis)
+    finally:
+        if OUT:
+            OUT.close()
+        if sparse:
+            sparse.close()
 
     return (header_cells,cells_dropped,total_UMIs)
@@ -0,0 +1,127 @@
+'''
+The order of the rows of the UMI count files , the same as sorting the combined
+count file with sort --ignore-case -V on chrom , 5' and 3' for genes , or on
+strand , chrom and 5' for primers , and then on the whole row.
+
+count_umi writes the count file of every cell in this order , so that the count
+files of the cells and samples are merged line by line , without sorting ,
+by combine_cell_results and combine_sample_results.
+
+The version comparison of two fields is a port of gnulib filevercmp. Sorting a
+whole gene annotation with it is slow in Python , so count_row_order first ranks
+the distinct values of each field once , numeric fields by their value , and
+then sorts the rows on the ranks.
+'''
+
+import re
+from functools import cmp_to_key
+
+## Trailing file suffixes ignored in a first comparison by sort -V , e.g. .tar.gz
+VERSION_SUFFIX = re.compile(r'(?:\.[A-Za-z~][A-Za-z0-9~]*)*$')
+
+def version_char_order(text,i):
+    ''' The weight of a character when comparing non digit runs in sort -V
+    :param str text: the string
+    :param int i: the position of the character , the end of the string weighs -1
+    :rtype int
+    '''
+    if i >= len(text):
+        return -1
+    c = text[i]
+    if c.isdigit():
+        return 0
+    if c.isalpha():
+        return ord(c)
+    if c == '~':
+        return -2
+    return ord(c) + 256
+
+def version_run_compare(a,b):
+    ''' Compare two strings as alternating runs of non digits , character by
+    character , and of digits , as numbers (gnulib verrevcmp)
+    :param str a: the first string
+    :param str b: the second string
+    :rtype int
+    '''
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            diff = version_char_order(a,i) - version_char_order(b,j)
+            if diff:
+                return diff
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        start_a,start_b = i,j
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        digits_a,digits_b = a[start_a:i],b[start_b:j]
+        if digits_a != digits_b:
+            return cmp((len(digits_a),digits_a),(len(digits_b),digits_b))
+    return 0
+
+def version_compare(a,b):
+    ''' Compare two fields as sort --ignore-case -V does (gnulib filevercmp)
+    :param str a: the first field
+    :param str b: the second field
+    :rtype int
+    '''
+    a,b = a.upper(),b.upper()
+    if a == b:
+        return 0
+    for special in ["",".",".."]:
+        if a == special:
+            return -1
+        if b == special:
+            return 1
+    if a.startswith('.') != b.startswith('.'):
+        return -1 if a.startswith('.') else 1
+    ## compare without file suffixes such as .tar.gz first , then the whole fields
+    prefix_a = a[:VERSION_SUFFIX.search(a,1).start()]
+    prefix_b = b[:VERSION_SUFFIX.search(b,1).start()]
+    return version_run_compare(prefix_a,prefix_b) or version_run_compare(a,b)
+
+def version_ranks(values):
+    ''' Rank the distinct values of a field in sort -V order , values comparing
+    equal (e.g. 7 and 007) share a rank
+    :param iterable values: the values of the field
+    :returns value -> rank
+    :rtype dict
+    '''
+    distinct = set(values)
+    if all(value.isdigit() for value in distinct):
+        ## plain numbers compare by their value , no need for version_compare
+        return dict((value,int(value)) for value in distinct)
+    ordered = sorted(distinct,key=cmp_to_key(version_compare))
+    ranks = {}
+    rank = 0
+    for i,value in enumerate(ordered):
+        if i and version_compare(ordered[i-1],value):
+            rank += 1
+        ranks[value] = rank
+    return ranks
+
+def count_row_order(rows,wts):
+    ''' Sort the annotation of count file rows in count file order
+    :param list rows: the annotation tuple of each row , as strings
+    :param bool wts: whether the rows are genes (True) or primers (False)
+    :returns the positions of the rows in count file order
+    :rtype list
+    '''
+    fields = range(3,6) if wts else range(2,5)
+    ranks = [version_ranks([row[f] for row in rows]) for f in fields]
+    keys = [tuple(r[row[f]] for r,f in zip(ranks,fields)) + ('\t'.join(row),) for row in rows]
+    return sorted(range(len(rows)),key=keys.__getitem__)
+
+def is_count_row_order(rows,wts):
+    ''' Whether rows are in count file order
+    :param list rows: the annotation tuple of each row , as strings
+    :param bool wts: whether the rows are genes (True) or primers (False)
+    :rtype bool
+    '''
+    return count_row_order(rows,wts) == range(len(rows))
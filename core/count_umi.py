@@ -1,155 +1,481 @@
 import itertools
 import logging
-import sys
-from guppy import hpy
+import os
+import numpy as np
 import pysam
-from pathos.multiprocessing import ProcessingPool as Pool
-import regex
+from array import array
 from intervaltree import IntervalTree
-from collections import defaultdict,OrderedDict
-from functools import partial
-from Bio.Seq import Seq
+from collections import defaultdict,OrderedDict,namedtuple
 
 ## Modules from this project
 from find_primer import find_primer
-from find_gene import find_gene
-from demultiplex_cells import write_metrics
-from create_annotation_tables import create_gene_tree
+from primer_match import PrimerMatcher
+from read_trace import parse_trace_spec
+from demultiplex_cells import write_metrics,peak_rss
+from gene_index import assign_genes,UNMAPPED,UNKNOWN,UNKNOWN_CHROM
+from umi_dedup import METHODS
+from umi_counter import UmiCounter
+from count_order import count_row_order
+from executor import get_pool
+from profiling import stage
 
-def grouper(iterable,n=750000):
+## Default size of the read columns held in memory when counting UMIs
+COUNT_CHUNK_BYTES = 256*1024**2
+
+## The gene index , or the primer tree for targeted , set once in each worker
+## process by the pool initializer rather than pickled with every map call
+GENE_INDEX = None
+PRIMER_TREE = None
+PRIMER_CODES = {}
+## The primers read from each primer file in this process , see read_primers
+PRIMERS = {}
+## The read tracer of a worker process and its trace spec , see worker_tracer
+WORKER_TRACER = (None,None)
+
+def init_worker(gene_index):
+    ''' Pool initializer , keep the gene index in the worker process
+    :param GeneIndex gene_index: the gene index , inherited when the pool forks
+    '''
+    global GENE_INDEX
+    GENE_INDEX = gene_index
+
+def init_primer_worker(primer_tree,primer_codes):
+    ''' Pool initializer , keep the primer tree in the worker process
+    :param dict primer_tree: chrom -> IntervalTree of primers , inherited when the pool forks
+    :param dict primer_codes: see primer_codes
+    '''
+    global PRIMER_TREE,PRIMER_CODES
+    PRIMER_TREE = primer_tree
+    PRIMER_CODES = primer_codes
+
+## The find_primer outcomes of the reads not matching a primer , coded -1 , -2 , ...
+PRIMER_OUTCOMES = ['Unmapped','Unknown_Chrom','Unknown_Regex','Unknown_Loci']
+
+def primer_codes(primer_info):
+    ''' The code of each find_primer result , the index of the primer in primer_info ,
+    or a negative code for the outcomes in PRIMER_OUTCOMES
+    :param dict primer_info: primer -> annotation , from read_primers
+    :rtype dict
+    '''
+    codes = dict((outcome,-1-i) for i,outcome in enumerate(PRIMER_OUTCOMES))
+    codes.update((primer,i) for i,primer in enumerate(primer_info))
+    return codes
+
+def counting_pool(cores,gene_index=None,primer_bed=None):
+    ''' The pool of workers of the counting functions , shared by all the bams counted
+    in this process , see executor.get_pool
+    :param int cores: the number of workers
+    :param GeneIndex gene_index: the gene index for WTS
+    :param str primer_bed: the primer file for targeted
+    :rtype WorkerPool
+    '''
+    if gene_index is not None:
+        return get_pool("count_wts",cores,init_worker,(gene_index,),key=id(gene_index))
+    primer_info,primer_tree = read_primers(primer_bed)
+    return get_pool("count_targeted",cores,init_primer_worker,(primer_tree,primer_codes(primer_info)),
+                    key=os.path.abspath(primer_bed))
+
+def worker_tracer(trace):
+    ''' Worker side , the read tracer for a trace spec , kept across the slices of reads
+    :param str trace: the trace spec , see read_trace
+    :rtype ReadTracer
+    '''
+    global WORKER_TRACER
+    if WORKER_TRACER[0] != trace:
+        WORKER_TRACER = (trace,parse_trace_spec(trace))
+    return WORKER_TRACER[1]
+
+def find_primers_worker(args):
+    ''' find_primer with the worker's primer tree , for a slice of a chunk of reads ,
+    the traces of the reads are appended to the log file once per slice
+    :param tuple args: (log file , trace spec , ReadColumns from read_slice)
+    :returns (the primer code of each read , see primer_codes ,
+              whether the endogenous sequence of each read matched)
+    :rtype tuple of numpy arrays
+    '''
+    logfile,trace,reads = args
+    tracer = worker_tracer(trace)
+    codes = np.empty(len(reads.tid),dtype=np.int32)
+    endogenous = np.zeros(len(reads.tid),dtype=bool)
+    for i,read in enumerate(read_tuples(reads)):
+        primer,umi,count,nh = find_primer(PRIMER_TREE,read,tracer)
+        codes[i] = PRIMER_CODES[primer]
+        endogenous[i] = count > 0
+    if tracer is not None:
+        tracer.flush(logfile)
+    return (codes,endogenous)
+
+def assign_genes_worker(columns):
+    ''' assign_genes with the worker's gene index
+    :param tuple columns: (ref_names,tid,pos,end,is_reverse) for a slice of a chunk
+    :rtype tuple
     '''
-    Returns n chunks of an iterable
+    return assign_genes(GENE_INDEX,*columns)
 
-    :param iterator iterable: The iterator to chop up
-    :param int n: the chunks to group the iterator into
-    :yields: iterator , i.e. the n1, n2, ... n chunks of the iterable
+def assign_chunk(p,chunk,cores):
+    ''' Assign genes to a chunk of reads , split in a slice per core
+    :param object p: the pool of workers , with the gene index
+    :param BamColumns chunk: a chunk from iterate_bam_columns
+    :param int cores: the number of cores to use
+    :returns (gene id or UNMAPPED/UNKNOWN/UNKNOWN_CHROM for each read ,
+              whether each read is on an ERCC)
+    :rtype tuple of numpy arrays
     '''
-    it = iter(iterable)
-    while True:
-        chunk = tuple(itertools.islice(it,n))
-        if not chunk:
-            return
-        yield chunk
-
-def iterate_bam_chunks(tagged_bam,chunks=750000):
+    columns = [np.array_split(col,cores) for col in (chunk.tid,chunk.pos,chunk.end,chunk.is_reverse)]
+    slices = [(chunk.ref_names,t,b,e,r) for t,b,e,r in zip(*columns)]
+    results = p.map(assign_genes_worker,slices)
+    return (np.concatenate([codes for codes,ercc in results]),
+            np.concatenate([ercc for codes,ercc in results]))
+
+## The columns of a chunk of reads from iterate_bam_columns , cells are
+## indices into cell_names and tid indices into ref_names
+BamColumns = namedtuple('BamColumns',['ref_names','tid','pos','end','is_reverse','nh','umis','cells','cell_names'])
+## Bytes per read of the fixed width columns , tid + pos + end + is_reverse + nh + cell
+BYTES_PER_READ = 4 + 8 + 8 + 1 + 4 + 4
+
+def iterate_bam_columns(tagged_bam,chunk_bytes=COUNT_CHUNK_BYTES,cell_tag=None,umi_tag=None):
     '''
-    Iterate over a bam file in chunks (i.e. the number of reads returned
-    at a time)
+    Iterate over a bam file in chunks of columns , holding only the read fields needed
+    to assign genes and count UMIs. The columns are preallocated once and reused ,
+    each chunk is only valid until the next one is requested
 
     :param str tagged_bam: the input bam file with UMI tags
-    :param int chunks: the number of reads to process at a time
-    :yields: a list of tuples
+    :param int chunk_bytes: the approximate size in bytes of the columns of a chunk
+    :param str cell_tag: the tag holding the cell index (CB , or RG for a sample aligned
+                         from the cell fastqs) , None for a single cell bam
+    :param str umi_tag: the tag holding the UMI (UB) , None if the UMI is the suffix of the read name
+    :yields: BamColumns
     '''
     IN = pysam.AlignmentFile(tagged_bam,'rb')
-    chroms = IN.header['SQ']
-    for reads in grouper(IN.fetch(until_eof=True),chunks):
-        to_yield = []
-        for read in reads:
-            if read.flag == 4: ## Unmapped
-                chromosome = '*'
-            else:
-                chromosome = chroms[read.tid]['SN']
-            umi = read.qname.split(":")[-1]
-            to_yield.append((read.qname,read.seq, read.is_reverse, read.alen,chromosome,
-                             read.pos, read.cigarstring, umi,
-                             read.get_tag('NH')))
-        yield to_yield
-
-def count_umis_wts(gene_tree,tagged_bam,outfile,metricfile,logfile,cores=3):
+    ref_names = list(IN.references)
+    umi_width = 16
+    nmax = max(1,chunk_bytes//(BYTES_PER_READ+umi_width))
+    tid = np.empty(nmax,dtype=np.int32)
+    pos = np.zeros(nmax,dtype=np.int64)
+    end = np.zeros(nmax,dtype=np.int64)
+    is_reverse = np.empty(nmax,dtype=bool)
+    nh = np.empty(nmax,dtype=np.int32)
+    umis = np.empty(nmax,dtype='S%i'%umi_width)
+    cells = np.zeros(nmax,dtype=np.int32)
+    cell_ids = {}
+    cell_names = []
+    n = 0
+    for read in IN.fetch(until_eof=True):
+        if read.flag == 4: ## Unmapped
+            tid[n] = -1
+        else:
+            tid[n] = read.reference_id
+            pos[n] = read.reference_start
+            end[n] = read.reference_end
+        is_reverse[n] = read.is_reverse
+        nh[n] = read.get_tag('NH')
+        if umi_tag:
+            umi = read.get_tag(umi_tag)
+        else:
+            umi = read.query_name.split(":")[-1]
+        if len(umi) > umi_width: ## widen the column rather than truncate
+            umi_width = len(umi)
+            umis = umis.astype('S%i'%umi_width)
+        umis[n] = umi
+        if cell_tag:
+            cell = read.get_tag(cell_tag)
+            if cell not in cell_ids:
+                cell_ids[cell] = len(cell_names)
+                cell_names.append(cell)
+            cells[n] = cell_ids[cell]
+        n += 1
+        if n == nmax:
+            yield BamColumns(ref_names,tid,pos,end,is_reverse,nh,umis,cells,cell_names)
+            n = 0
+    if n > 0:
+        yield BamColumns(ref_names,tid[:n],pos[:n],end[:n],is_reverse[:n],nh[:n],umis[:n],cells[:n],cell_names)
+    IN.close()
+
+## The columns of a chunk of reads from iterate_bam_reads , for targeted counting. The
+## sequence , the CIGAR (as BAM packs it , length << 4 | operation) and the name of the
+## reads are concatenated in a buffer each , the read i ends at <buffer>_ends[i] ; the
+## names are only kept when tracing reads
+ReadColumns = namedtuple('ReadColumns',['ref_names','tid','pos','alen','is_reverse','nh','umis','cells','cell_names',
+                                        'seqs','seq_ends','cigars','cigar_ends','names','name_ends'])
+## Bytes per read of the fixed width columns , tid + pos + alen + is_reverse + nh + cell + 3 buffer ends
+BYTES_PER_TARGETED_READ = 4 + 8 + 4 + 1 + 4 + 4 + 3*8
+## Bytes of sequence , CIGAR and name per read the buffers are sized for ,
+## a chunk ends early when its reads are longer
+BUFFER_BYTES_PER_READ = 256
+
+def iterate_bam_reads(tagged_bam,chunk_bytes=COUNT_CHUNK_BYTES,cell_tag=None,umi_tag=None,names=False):
+    '''
+    Iterate over a bam file in chunks of columns and sequence buffers , holding only the
+    read fields needed to find the primers and count UMIs. A chunk ends when its columns
+    or its buffers are full , so that it takes about chunk_bytes whatever the read length.
+    The columns are preallocated once and reused , each chunk is only valid until the
+    next one is requested
+
+    :param str tagged_bam: the input bam file with UMI tags
+    :param int chunk_bytes: the approximate size in bytes of the columns and buffers of a chunk
+    :param str cell_tag: the tag holding the cell index (CB , or RG for a sample aligned
+                         from the cell fastqs) , None for a single cell bam
+    :param str umi_tag: the tag holding the UMI (UB) , None if the UMI is the suffix of the read name
+    :param bool names: whether to keep the read names , for tracing reads
+    :yields: ReadColumns
+    '''
+    IN = pysam.AlignmentFile(tagged_bam,'rb')
+    ref_names = list(IN.references)
+    umi_width = 16
+    nmax = max(1,chunk_bytes//(BYTES_PER_TARGETED_READ+umi_width+BUFFER_BYTES_PER_READ))
+    buffer_bytes = nmax*BUFFER_BYTES_PER_READ
+    tid = np.empty(nmax,dtype=np.int32)
+    pos = np.zeros(nmax,dtype=np.int64)
+    alen = np.zeros(nmax,dtype=np.int32)
+    is_reverse = np.empty(nmax,dtype=bool)
+    nh = np.empty(nmax,dtype=np.int32)
+    umis = np.empty(nmax,dtype='S%i'%umi_width)
+    cells = np.zeros(nmax,dtype=np.int32)
+    seq_ends = np.empty(nmax,dtype=np.int64)
+    cigar_ends = np.empty(nmax,dtype=np.int64)
+    name_ends = np.zeros(nmax,dtype=np.int64)
+    seqs,cigars,read_names = bytearray(),array('I'),bytearray()
+    cell_ids = {}
+    cell_names = []
+    n = 0
+    for read in IN.fetch(until_eof=True):
+        if read.flag == 4: ## Unmapped
+            tid[n] = -1
+        else:
+            tid[n] = read.reference_id
+            pos[n] = read.reference_start
+            alen[n] = read.reference_length
+            cigars.extend([length << 4 | op for op,length in read.cigartuples])
+        cigar_ends[n] = len(cigars)
+        seqs.extend(read.query_sequence or '')
+        seq_ends[n] = len(seqs)
+        if names:
+            read_names.extend(read.query_name)
+            name_ends[n] = len(read_names)
+        is_reverse[n] = read.is_reverse
+        nh[n] = read.get_tag('NH')
+        if umi_tag:
+            umi = read.get_tag(umi_tag)
+        else:
+            umi = read.query_name.split(":")[-1]
+        if len(umi) > umi_width: ## widen the column rather than truncate
+            umi_width = len(umi)
+            umis = umis.astype('S%i'%umi_width)
+        umis[n] = umi
+        if cell_tag:
+            cell = read.get_tag(cell_tag)
+            if cell not in cell_ids:
+                cell_ids[cell] = len(cell_names)
+                cell_names.append(cell)
+            cells[n] = cell_ids[cell]
+        n += 1
+        if n == nmax or len(seqs) + 4*len(cigars) + len(read_names) >= buffer_bytes:
+            yield ReadColumns(ref_names,tid[:n],pos[:n],alen[:n],is_reverse[:n],nh[:n],umis[:n],cells[:n],cell_names,
+                              seqs,seq_ends[:n],cigars,cigar_ends[:n],read_names,name_ends[:n])
+            seqs,cigars,read_names = bytearray(),array('I'),bytearray()
+            n = 0
+    if n > 0:
+        yield ReadColumns(ref_names,tid[:n],pos[:n],alen[:n],is_reverse[:n],nh[:n],umis[:n],cells[:n],cell_names,
+                          seqs,seq_ends[:n],cigars,cigar_ends[:n],read_names,name_ends[:n])
+    IN.close()
+
+def read_slice(chunk,start,stop):
+    ''' A slice of a chunk of reads , with its own part of the buffers , to hand to a worker
+    :param ReadColumns chunk: a chunk from iterate_bam_reads
+    :param int start: the first read
+    :param int stop: the read after the last one
+    :returns the buffers as strings and their ends from the start of the slice
+    :rtype ReadColumns
+    '''
+    def buffer_slice(buf,ends):
+        first = int(ends[start-1]) if start > 0 else 0
+        last = int(ends[stop-1]) if stop > start else first
+        return (buf[first:last],ends[start:stop]-first)
+    seqs,seq_ends = buffer_slice(chunk.seqs,chunk.seq_ends)
+    cigars,cigar_ends = buffer_slice(chunk.cigars,chunk.cigar_ends)
+    names,name_ends = buffer_slice(chunk.names,chunk.name_ends)
+    return ReadColumns(chunk.ref_names,chunk.tid[start:stop],chunk.pos[start:stop],chunk.alen[start:stop],
+                       chunk.is_reverse[start:stop],chunk.nh[start:stop],chunk.umis[start:stop],chunk.cells[start:stop],
+                       chunk.cell_names,str(seqs),seq_ends,cigars.tostring(),cigar_ends,str(names),name_ends)
+
+def read_tuples(reads):
+    ''' The read tuples find_primer and find_gene take , for a slice of reads
+    :param ReadColumns reads: from read_slice
+    :yields (name , sequence , is_reverse , aligned length , chromosome , position , cigartuples , UMI , NH) ,
+            the name is None when the names were not kept
+    '''
+    cigars = array('I',reads.cigars).tolist()
+    seq_start = cigar_start = name_start = 0
+    for tid,pos,alen,is_reverse,nh,umi,seq_end,cigar_end,name_end in itertools.izip(
+            reads.tid.tolist(),reads.pos.tolist(),reads.alen.tolist(),reads.is_reverse.tolist(),reads.nh.tolist(),
+            reads.umis.tolist(),reads.seq_ends.tolist(),reads.cigar_ends.tolist(),reads.name_ends.tolist()):
+        chromosome = reads.ref_names[tid] if tid >= 0 else '*'
+        cigar = [(c & 15,c >> 4) for c in cigars[cigar_start:cigar_end]]
+        name = reads.names[name_start:name_end] if name_end > name_start else None
+        yield (name,reads.seqs[seq_start:seq_end],is_reverse,alen,chromosome,pos,cigar,umi,nh)
+        seq_start,cigar_start,name_start = seq_end,cigar_end,name_end
+
+def count_umis_wts(gene_index,tagged_bam,outfile,metricfile,logfile,cores=3,chunk_bytes=COUNT_CHUNK_BYTES,umi_method="unique",pool=None):
     ''' Count UMIs for each gene in the input the tagged_bam file
 
-    :param object gene_tree : an IntervalTree data structure
+    :param GeneIndex gene_index : the gene interval index
     :param str tagged_bam: a UMI tagged bam file
     :param str outfile: the output file
     :param str metricfile: file to write the metrics stats
     :param str logfile: the log file to write to
     :param int cores: the number of cores to use
+    :param int chunk_bytes: the size in bytes of the read columns held in memory at a time
+    :param str umi_method: how to collapse UMIs into molecules , see umi_dedup.METHODS
+    :param WorkerPool pool: the workers to use , None for counting_pool(cores,gene_index=gene_index)
     '''
+    count_umis_wts_by_cell(gene_index,tagged_bam,{None:(outfile,metricfile)},logfile,cores,
+                           chunk_bytes=chunk_bytes,umi_method=umi_method,pool=pool)
+
+def count_umis_wts_by_cell(gene_index,tagged_bam,outputs,logfile,cores=3,cell_tag="CB",umi_tag="UB",
+                           chunk_bytes=COUNT_CHUNK_BYTES,umi_method="unique",pool=None):
+    ''' Count UMIs for each gene and cell in the input tagged_bam file
+
+    :param GeneIndex gene_index : the gene interval index
+    :param str tagged_bam: a UMI tagged bam file , for a single cell or a whole sample with cell tags
+    :param dict outputs: cell index -> (output file , metric file) ; a single None key
+                         for a single cell bam with the UMI in the read name
+    :param str logfile: the log file to write to
+    :param int cores: the number of cores to use
+    :param str cell_tag: the tag holding the cell index for a whole sample , CB or RG
+    :param str umi_tag: the tag holding the UMI for a whole sample , None if the UMI is in the read name
+    :param int chunk_bytes: the size in bytes of the read columns held in memory at a time
+    :param str umi_method: how to collapse UMIs into molecules , see umi_dedup.METHODS
+    :param WorkerPool pool: the workers to use , None for counting_pool(cores,gene_index=gene_index)
+    '''
+    assert umi_method in METHODS, "Incorrect UMI collapsing method specification"
     ## Set up logging
     logger = logging.getLogger("count_umis")
     logger.setLevel(logging.DEBUG)
     LOG = logging.FileHandler(logfile)
     logger.addHandler(LOG)
-    ## Variable Initialization
-    found = 0
-    found_ercc = 0
-    miss_chr = 0
-    unmapped = 0
-    not_annotated = 0
-    multimapped = 0
-    multimapped_ercc = 0
-    ercc  = 0
-    total_UMIs = 0
-    ## Store umi counts for each gene
-    umi_counter = defaultdict(lambda:defaultdict(int))
+    use_tags = None not in outputs
+    if not use_tags:
+        cell_tag = umi_tag = None
+    ## Variable Initialization , the read counters for each cell
+    stats = defaultdict(lambda:defaultdict(int))
+    ## Store the reads of each cell , gene and umi
+    umi_counter = UmiCounter()
+    cell_names = [None]
     logger.info('Using {} cores'.format(cores))
-    p = Pool(cores)
-    func = partial(find_gene,gene_tree)
-    max_reads_in_mem = 10000000
+    p = pool or counting_pool(cores,gene_index=gene_index)
+    nreads = 0
+    lookup_seconds = 0.0
     
-    for reads in iterate_bam_chunks(tagged_bam,chunks=max_reads_in_mem):
-        logger.info('Reading {} reads in memory to find genes'.format(max_reads_in_mem))
-        find_gene_results = p.map(func,reads)
-        for info in find_gene_results:
-            gene_info,umi,count,nh = info
-            if count == 0:
-                if gene_info == 'Unknown_Chrom':
-                    miss_chr+=1
-                elif gene_info == 'Unmapped':
-                    unmapped+=1
-                elif gene_info == 'Unknown':
-                    not_annotated+=1
-                else: ## These are ERCC reads
-                    ercc+=1
-                    if nh>1:
-                        multimapped_ercc+=1
-                        multimapped+=1
-                    else:
-                        umi_counter[gene_info][umi]+=1
-                        found+=1
-                        found_ercc+=1
-            else:
-                if nh>1:
-                    multimapped+=1
-                else:
-                    umi_counter[gene_info][umi]+=1
-                    found+=1
-    p.close()
-    p.join()
-    ## Print output results
+    for chunk in iterate_bam_columns(tagged_bam,chunk_bytes,cell_tag=cell_tag,umi_tag=umi_tag):
+        logger.info('Read {} reads in memory to find genes'.format(len(chunk.tid)))
+        with stage("gene assignment",reads=len(chunk.tid)) as timer:
+            codes,ercc = assign_chunk(p,chunk,cores)
+        lookup_seconds += timer.wall
+        nreads += len(chunk.tid)
+        if use_tags:
+            cell_names = chunk.cell_names
+        wanted = np.array([cell in outputs for cell in cell_names],dtype=bool)
+        keep = wanted[chunk.cells]
+        mapped = keep & (codes >= 0)
+        multi = chunk.nh > 1
+        ercc &= mapped
+        found = mapped & ~multi
+        tally_reads(stats,cell_names,chunk.cells,[
+            ('miss_chr',keep & (codes == UNKNOWN_CHROM)),
+            ('unmapped',keep & (codes == UNMAPPED)),
+            ('not_annotated',keep & (codes == UNKNOWN)),
+            ('ercc',ercc),
+            ('multimapped_ercc',ercc & multi),
+            ('multimapped',mapped & multi),
+            ('found',found),
+            ('found_ercc',ercc & ~multi)])
+        umi_counter.add(chunk.cells[found],codes[found],chunk.umis[found])
+    if nreads > 0:
+        logger.info('Annotated {n} reads with genes in {t:.1f} s , {us:.1f} us per read'.format(
+            n=nreads,t=lookup_seconds,us=1e6*lookup_seconds/nreads))
+    logger.info('Counted {} distinct cell , gene and UMI combinations'.format(len(umi_counter)))
+    logger.info('Peak RSS : {:.1f} MB'.format(peak_rss()/float(1024**2)))
+    ## Print output results , for the cells with reads in the bam
+    cell_ids = dict((cell,i) for i,cell in enumerate(cell_names))
+    counted_cells = stats.keys() if use_tags else [None]
+    with stage("UMI collapse",cells=len(counted_cells)): ## and writing the count files
+        for cell in counted_cells:
+            outfile,metricfile = outputs[cell]
+            molecules = umi_counter.molecules(cell_ids[cell],umi_method)
+            write_gene_counts_wts(gene_index,molecules,stats[cell],outfile,metricfile,umi_method)
+    logger.info('Finished UMI counting and writing to disk')
+    logger.info(p.summary())
+    logger.removeHandler(LOG)
+    LOG.close()
+
+def tally_reads(stats,cell_names,cells,counters):
+    ''' Add the reads selected for each counter to the read counters of their cell
+    :param dict stats: cell -> counter -> reads
+    :param list cell_names: the cell of each cell id
+    :param numpy array cells: the cell id of each read
+    :param list counters: (counter name , boolean numpy array selecting the reads)
+    '''
+    for name,selected in counters:
+        for cell,n in enumerate(np.bincount(cells[selected],minlength=len(cell_names)).tolist()):
+            if n:
+                stats[cell_names[cell]][name]+=n
+
+def write_gene_counts_wts(gene_index,molecules,stats,outfile,metricfile,umi_method="unique"):
+    ''' Write the UMI counts and read metrics of a cell
+    :param GeneIndex gene_index : the gene interval index
+    :param dict molecules: gene id -> (molecules , distinct UMIs) , from UmiCounter.molecules
+    :param dict stats: the read counters
+    :param str outfile: the output file
+    :param str metricfile: file to write the metrics stats
+    :param str umi_method: how UMIs were collapsed into molecules , see umi_dedup.METHODS
+    '''
+    total_UMIs = 0
+    distinct_UMIs = 0
     ## Write gene counts
     detected_genes = set()
     with open(outfile,'w') as OUT:
-        for chrom in gene_tree:
-            for strand in gene_tree[chrom]:
-                for gene_info in gene_tree[chrom][strand]:
-                    ensembl_id,gene,strand,chrom,five_prime,three_prime = gene_info.data
-                    if gene_info.data in umi_counter:
-                        umi_count = len(umi_counter[gene_info.data])
-                        if not gene.startswith('ERCC'):
-                            detected_genes.add(gene_info.data)
-                    else:
-                        umi_count = 0
-                    total_UMIs+=umi_count
-                    OUT.write(ensembl_id+'\t'+gene+"\t"+strand+"\t"+chrom+"\t"+str(five_prime)+'\t'+str(three_prime)+"\t"+str(umi_count)+"\n")
+        for gene_id in gene_index.ids():
+            gene_info = gene_index.genes[gene_id]
+            ensembl_id,gene,strand,chrom,five_prime,three_prime = gene_info
+            if gene_id in molecules:
+                umi_count,distinct = molecules[gene_id]
+                distinct_UMIs+=distinct
+                if not gene.startswith('ERCC'):
+                    detected_genes.add(gene_info)
+            else:
+                umi_count = 0
+            total_UMIs+=umi_count
+            OUT.write(ensembl_id+'\t'+gene+"\t"+strand+"\t"+chrom+"\t"+str(five_prime)+'\t'+str(three_prime)+"\t"+str(umi_count)+"\n")
     ## Write metrics
     metric_dict = OrderedDict([
-        ('reads dropped, not mapped to genome',unmapped),
-        ('reads dropped, not annotated',not_annotated+miss_chr),
-        ('reads dropped, aligned to genome, multiple loci',multimapped-multimapped_ercc),
-        ('reads dropped, aligned to ERCC, multiple loci',multimapped_ercc),        
-        ('reads used, aligned to genome, unique loci',found-found_ercc),
-        ('reads used, aligned to ERCC, unique loci',found_ercc),
+        ('reads dropped, not mapped to genome',stats['unmapped']),
+        ('reads dropped, not annotated',stats['not_annotated']+stats['miss_chr']),
+        ('reads dropped, aligned to genome, multiple loci',stats['multimapped']-stats['multimapped_ercc']),
+        ('reads dropped, aligned to ERCC, multiple loci',stats['multimapped_ercc']),        
+        ('reads used, aligned to genome, unique loci',stats['found']-stats['found_ercc']),
+        ('reads used, aligned to ERCC, unique loci',stats['found_ercc']),
         ('total UMIs',total_UMIs),
         ('detected genes',len(detected_genes))
     ])
+    add_collapse_metrics(metric_dict,distinct_UMIs,total_UMIs,umi_method)
     write_metrics(metricfile,metric_dict,metric_dict.keys())
-    logger.info('Finished UMI counting and writing to disk')
 
-def count_umis(gene_hash,primer_bed,tagged_bam,outfile_primer,outfile_gene,metricfile,logfile,cores):
+def add_collapse_metrics(metric_dict,distinct_UMIs,total_UMIs,umi_method):
+    ''' Add the UMI collapsing metrics of a cell , when collapsing
+    :param dict metric_dict: the metrics of the cell
+    :param int distinct_UMIs: the number of distinct UMI sequences , summed over genes/primers
+    :param int total_UMIs: the number of molecules after collapsing
+    :param str umi_method: how the UMIs were collapsed
+    '''
+    if umi_method == "unique":
+        return
+    metric_dict['UMIs before collapsing'] = distinct_UMIs
+    metric_dict['UMIs merged by collapsing'] = distinct_UMIs - total_UMIs
+
+def count_umis(gene_hash,primer_bed,tagged_bam,outfile_primer,outfile_gene,metricfile,logfile,cores,chunk_bytes=COUNT_CHUNK_BYTES,
+               umi_method="unique",pool=None,trace=None):
     ''' Search for the design spe primers in the tagged bam
     and count molecular tags for each primer
-    To do : Make this function shorter
 
     :param dict gene_hash: a dict of lists for storing gene annotations
     :param str primer_bed: a tsv file <chrom><start><stop><primer_seq><strand><gene>
@@ -157,136 +483,202 @@ def count_umis(gene_hash,primer_bed,tagged_bam,outfile_primer,outfile_gene,metri
     :param str outfile_primer: the output file for counts on primer level
     :param str outfile_gene: the output file for counts on a gene level
     :param str metricfile: file to write primer finding stats
+    :param int chunk_bytes: the approximate size in bytes of the reads held in memory
+    :param str umi_method: how to collapse UMIs into molecules , see umi_dedup.METHODS
+    :param WorkerPool pool: the workers to use , None for counting_pool(cores,primer_bed=primer_bed)
+    :param str trace: the reads traced to the log file , see read_trace , None for the counts of each outcome only
+    '''
+    count_umis_by_cell(gene_hash,primer_bed,tagged_bam,{None:(outfile_primer,outfile_gene,metricfile)},logfile,cores,
+                       chunk_bytes=chunk_bytes,umi_method=umi_method,pool=pool,trace=trace)
+
+def count_umis_by_cell(gene_hash,primer_bed,tagged_bam,outputs,logfile,cores,cell_tag="CB",umi_tag="UB",chunk_bytes=COUNT_CHUNK_BYTES,
+                       umi_method="unique",pool=None,trace=None):
+    ''' Search for the design spe primers in the tagged bam
+    and count molecular tags for each primer and cell
+
+    :param dict gene_hash: a dict of lists for storing gene annotations
+    :param str primer_bed: a tsv file <chrom><start><stop><primer_seq><strand><gene>
+    :param str tagged_bam: a UMI tagged bam file , for a single cell or a whole sample with cell tags
+    :param dict outputs: cell index -> (primer level output file , gene level output file , metric file) ;
+                         a single None key for a single cell bam with the UMI in the read name
+    :param str logfile: the log file to write to
+    :param int cores: the number of cores to use
+    :param str cell_tag: the tag holding the cell index for a whole sample , CB or RG
+    :param str umi_tag: the tag holding the UMI for a whole sample , None if the UMI is in the read name
+    :param int chunk_bytes: the approximate size in bytes of the reads held in memory
+    :param str umi_method: how to collapse UMIs into molecules , see umi_dedup.METHODS
+    :param WorkerPool pool: the workers to use , None for counting_pool(cores,primer_bed=primer_bed)
+    :param str trace: the reads traced to the log file , see read_trace , None for the counts of each outcome only
     '''
+    assert umi_method in METHODS, "Incorrect UMI collapsing method specification"
     ## Set up logging
     logger = logging.getLogger("count_umis")
     logger.setLevel(logging.DEBUG)
     LOG = logging.FileHandler(logfile)
     logger.addHandler(LOG)
-    ## Variable Initialization
+    use_tags = None not in outputs
+    if not use_tags:
+        cell_tag = umi_tag = None
+    ## read counters for each cell , and reads of each (cell , primer , UMI) and (cell , gene , UMI)
+    stats = defaultdict(lambda:defaultdict(int))
+    primer_counter = UmiCounter()
+    gene_counter = UmiCounter()
+    primer_info,primer_tree = read_primers(primer_bed)
+    ## the primers in the order of their codes , their gene and whether it is an ERCC
+    code_of = primer_codes(primer_info)
+    primers = sorted(primer_info,key=code_of.get)
+    gene_ids = {}
+    primer_genes = np.array([gene_ids.setdefault(primer_info[primer][2],len(gene_ids)) for primer in primers],dtype=np.int32)
+    genes = sorted(gene_ids,key=gene_ids.get)
+    primer_ercc = np.array([primer_info[primer][2].startswith('ERCC-') for primer in primers],dtype=bool)
+    cell_names = [None]
+
+    ## Iterate over the bam in chunks and process the results in parallel
+    ## The chunking here is mainly to stay within memory bound for very large bam files
+    p = pool or counting_pool(cores,primer_bed=primer_bed)
+    for chunk in iterate_bam_reads(tagged_bam,chunk_bytes,cell_tag=cell_tag,umi_tag=umi_tag,names=trace is not None):
+        nreads = len(chunk.tid)
+        ## about 4 slices per worker , as the chunksize of a plain map
+        size = max(1,-(-nreads//(4*p.cores)))
+        slices = [(logfile,trace,read_slice(chunk,i,min(i+size,nreads))) for i in xrange(0,nreads,size)]
+        with stage("primer and gene assignment",reads=nreads):
+            results = p.map(find_primers_worker,slices)
+        codes = np.concatenate([c for c,e in results])
+        endogenous = np.concatenate([e for c,e in results])
+        if use_tags:
+            cell_names = chunk.cell_names
+        wanted = np.array([cell in outputs for cell in cell_names],dtype=bool)
+        keep = wanted[chunk.cells]
+        matched = keep & (codes >= 0)
+        ercc = np.zeros(nreads,dtype=bool)
+        ercc[matched] = primer_ercc[codes[matched]]
+        ## find_primer reports no alignments for an unmapped read
+        multi = keep & (chunk.nh > 1) & (codes != code_of['Unmapped'])
+        used = matched & endogenous
+        tally_reads(stats,cell_names,chunk.cells,[
+            ('multimapped',multi),
+            ('primer_offtarget',keep & (codes == code_of['Unknown_Chrom'])),
+            ('unmapped',keep & (codes == code_of['Unmapped'])),
+            ('primer_mismatch',keep & (codes == code_of['Unknown_Regex'])),
+            ('primer_miss',keep & (codes == code_of['Unknown_Loci'])),
+            ('endo_seq_miss',matched & ~endogenous),
+            ('endo_seq_miss_ercc',ercc & ~endogenous),
+            ('multimapped_used',used & multi),
+            ('ercc_used_multimapped',used & ercc & multi),
+            ('num_reads_used_unique',used & ~multi),
+            ('ercc_used_unique',used & ercc & ~multi)])
+        primer_counter.add(chunk.cells[used],codes[used],chunk.umis[used])
+        gene_counter.add(chunk.cells[used],primer_genes[codes[used]],chunk.umis[used])
+    ## Print output results , for the cells with reads in the bam
+    cell_ids = dict((cell,i) for i,cell in enumerate(cell_names))
+    counted_cells = stats.keys() if use_tags else [None]
+    with stage("UMI collapse",cells=len(counted_cells)): ## and writing the count files
+        for cell in counted_cells:
+            outfile_primer,outfile_gene,metricfile = outputs[cell]
+            primer_molecules = dict((primers[code],molecules) for code,molecules in
+                                    primer_counter.molecules(cell_ids[cell],umi_method).iteritems())
+            gene_molecules = dict((genes[code],molecules) for code,molecules in
+                                  gene_counter.molecules(cell_ids[cell],umi_method).iteritems())
+            write_primer_counts(primer_info,primer_molecules,gene_molecules,stats[cell],
+                                outfile_primer,outfile_gene,metricfile,umi_method)
+    ## the outcome of the reads , over all cells
+    outcomes = defaultdict(int)
+    for counts in stats.itervalues():
+        for outcome,n in counts.iteritems():
+            outcomes[outcome]+=n
+    logger.info("Read outcomes : {}".format(" , ".join("{k} {n}".format(k=k,n=outcomes[k]) for k in sorted(outcomes))))
+    logger.info(p.summary())
+    logger.removeHandler(LOG)
+    LOG.close()
+
+def read_primers(primer_bed):
+    ''' Read the primer file and create an interval tree data structure , once per primer file in this process
+    :param str primer_bed: a tsv file <chrom><start><stop><primer_seq><strand><gene>
+    :returns (primer seq -> [ensembl_id,seq,gene,strand,chrom,five_prime,three_prime] ,
+              chrom -> IntervalTree of [PrimerMatcher,seq,gene] for each primer)
+    :rtype tuple
+    '''
+    key = os.path.abspath(primer_bed)
+    if key in PRIMERS:
+        return PRIMERS[key]
     primer_info = defaultdict(list)
     primer_tree = defaultdict(lambda:IntervalTree())
-    umi_counter = defaultdict(lambda:defaultdict(int))
-    umi_counter_gene = defaultdict(lambda:defaultdict(int))
-    patterns = defaultdict(lambda:defaultdict(list))
-    ercc_used_unique=0
-    ercc_used_multimapped=0
-    multimapped = 0
-    multimapped_used = 0
-    primer_miss = 0
-    primer_offtarget =0
-    primer_mismatch = 0
-    unmapped = 0
-    endo_seq_miss=0
-    endo_seq_miss_ercc=0
-    num_reads_used_unique = 0    
-    total_UMIs = 0
-    ## Read the primer file and create an interval tree data structure
     with open(primer_bed) as IN:
         for line in IN:
             chrom,five_prime,three_prime,seq,strand,gene,ensembl_id = line.strip('\n').split('\t')
-            sequence = Seq(seq)
-            revcomp_seq = sequence.reverse_complement().tostring()
             if gene.startswith('ERCC-'): ## Update chrom
                 chrom = gene
             if strand == '0':
                 strand = '1'
                 start = int(five_prime)
 		stop = int(three_prime) + 1  ## Incrementing by 1 since interval tree assumes stop coordinate to be non-inclusive
-                expression = regex.compile(r'^(%s){d<=2,i<=2,s<=2,1d+1i+1s<=3}[ACGTN]*$'%seq)
-                primer_tree[chrom].addi(int(start),int(stop),[expression,seq])
+                primer_tree[chrom].addi(int(start),int(stop),[PrimerMatcher(seq,False),seq,gene])
             else:
                 strand = '-1'
                 start = int(three_prime)
                 stop = int(five_prime) + 1
-                expression = regex.compile(r'^[ACGTN]*(%s){d<=2,i<=2,s<=2,1d+1i+1s<=3}$'%revcomp_seq)
-                primer_tree[chrom].addi(int(start),int(stop),[expression,seq])
+                primer_tree[chrom].addi(int(start),int(stop),[PrimerMatcher(seq,True),seq,gene])
             primer_info[seq] = [ensembl_id,seq,gene,strand,chrom,five_prime,three_prime]
+    PRIMERS[key] = (primer_info,primer_tree)
+    return PRIMERS[key]
 
-    ## Iterate over the bam in chunks and process the results in parallel
-    ## The chunking here is mainly to stay within memory bound for very large bam files
-    p = Pool(cores)
-    i = 1
-    func = partial(find_primer,primer_tree)
-    for chunks in iterate_bam_chunks(tagged_bam,chunks=10000000):
-        find_primer_results = p.map(func,chunks)
-        for info in find_primer_results:
-            primer,umi,count,nh = info
-            if nh>1:
-                multimapped+=1
-            if count == 0:
-                if primer == 'Unknown_Chrom':
-                    primer_offtarget+=1
-                elif primer == 'Unmapped':
-                    unmapped+=1
-                elif primer == 'Unknown_Regex':
-                    primer_mismatch+=1
-                elif primer == 'Unknown_Loci':
-                    primer_miss+=1
-                else:
-                    gene = primer_info[primer][2]
-                    if gene.startswith('ERCC-'):
-                        endo_seq_miss_ercc+=1
-                    endo_seq_miss+=1
-            else:
-                gene = primer_info[primer][2]
-                if nh > 1:
-                    if gene.startswith('ERCC-'):                        
-                        ercc_used_multimapped+=1
-                    multimapped_used+=1
-                else:
-                    num_reads_used_unique+=1
-                    if gene.startswith('ERCC-'):
-                        ercc_used_unique+=1
-                umi_counter[primer][umi]+=1
-                umi_counter_gene[gene][umi]+=1
-        i+=1
-    p.close()
-    p.join()
-    ## Print output results
+def write_primer_counts(primer_info,primer_molecules,gene_molecules,stats,outfile_primer,outfile_gene,metricfile,umi_method="unique"):
+    ''' Write the UMI counts and read metrics of a cell
+    :param dict primer_info: primer -> annotation
+    :param dict primer_molecules: primer -> (molecules , distinct UMIs) , from UmiCounter.molecules
+    :param dict gene_molecules: gene -> (molecules , distinct UMIs)
+    :param dict stats: the read counters
+    :param str outfile_primer: the output file for counts on primer level
+    :param str outfile_gene: the output file for counts on a gene level
+    :param str metricfile: file to write primer finding stats
+    :param str umi_method: how to collapse UMIs into molecules , see umi_dedup.METHODS
+    '''
+    total_UMIs = 0
+    distinct_UMIs = 0
     seen = []
     detected_genes=0
-    with open(outfile_primer,'w') as OUT1,open(outfile_gene,'w') as OUT2 :
-        for primer in primer_info:
-            ensembl_id,seq,gene,strand,chrom,five_prime,three_prime = primer_info[primer]
-            if primer in umi_counter:
-                umi_count = len(umi_counter[primer])
+    primer_rows = []
+    gene_rows = []
+    for primer in primer_info:
+        ensembl_id,seq,gene,strand,chrom,five_prime,three_prime = primer_info[primer]
+        if primer in primer_molecules:
+            umi_count = primer_molecules[primer][0]
+        else:
+            umi_count = 0
+        primer_rows.append(((ensembl_id,gene,strand,str(chrom),str(five_prime),str(three_prime),seq),umi_count))
+        if gene not in seen: ## Genes will be repeated for multiple primers, since results are already accumulated , only write once for a gene
+            if gene in gene_molecules:
+                umi_count_gene,distinct = gene_molecules[gene]
+                distinct_UMIs+=distinct
             else:
-                umi_count = 0
-            OUT1.write(ensembl_id+"\t"+gene+"\t"+strand+"\t"+str(chrom)+"\t"+str(five_prime)+"\t"+str(three_prime)+"\t"+seq+"\t"+str(umi_count)+"\n")
-            if gene not in seen: ## Genes will be repeated for multiple primers, since results are already accumulated , only write once for a gene
-                if gene in umi_counter_gene:
-                    umi_count_gene = len(umi_counter_gene[gene])
-                else:
-                    umi_count_gene = 0
-                total_UMIs+=umi_count_gene                
-                OUT2.write(ensembl_id+"\t"+gene+"\t"+strand+"\t"+str(chrom)+"\t"+str(five_prime)+"\t"+str(three_prime)+"\t"+str(umi_count_gene)+"\n")
-                if not gene.startswith('ERCC') and umi_count_gene > 0:
-                    detected_genes+=1
-                seen.append(gene)
-                
-    primers_found = len(umi_counter)    
+                umi_count_gene = 0
+            total_UMIs+=umi_count_gene
+            gene_rows.append(((ensembl_id,gene,strand,str(chrom),str(five_prime),str(three_prime)),umi_count_gene))
+            if not gene.startswith('ERCC') and umi_count_gene > 0:
+                detected_genes+=1
+            seen.append(gene)
+    ## Write the rows in count file order , so that the files of all cells merge without sorting
+    for outfile,rows,wts in [(outfile_primer,primer_rows,False),(outfile_gene,gene_rows,True)]:
+        with open(outfile,'w') as OUT:
+            for i in count_row_order([row[0] for row in rows],wts):
+                annotation,umi_count = rows[i]
+                OUT.write('\t'.join(annotation)+'\t'+str(umi_count)+'\n')
+
     ## Write metrics
-    num_reads_mapped_ercc = endo_seq_miss_ercc + ercc_used_unique + ercc_used_multimapped
-    num_reads_mapped_genome = num_reads_used_unique + multimapped_used + endo_seq_miss + \
-                              primer_mismatch + primer_miss + \
-                              primer_offtarget + endo_seq_miss_ercc - \
-                              num_reads_mapped_ercc
-    
-    num_reads_used_genome_unique = num_reads_used_unique - ercc_used_unique
-    num_reads_used_genome_multimapped = multimapped_used - ercc_used_multimapped
+    num_reads_used_genome_unique = stats['num_reads_used_unique'] - stats['ercc_used_unique']
+    num_reads_used_genome_multimapped = stats['multimapped_used'] - stats['ercc_used_multimapped']
 
     metric_dict = OrderedDict([
-        ('reads dropped, not mapped to genome',unmapped),
-        ('reads dropped, off target',primer_offtarget+primer_miss),
-        ('reads dropped, primer not identified at read start',primer_mismatch),
-        ('reads dropped, less than 25 bp endogenous seq after primer',endo_seq_miss),
+        ('reads dropped, not mapped to genome',stats['unmapped']),
+        ('reads dropped, off target',stats['primer_offtarget']+stats['primer_miss']),
+        ('reads dropped, primer not identified at read start',stats['primer_mismatch']),
+        ('reads dropped, less than 25 bp endogenous seq after primer',stats['endo_seq_miss']),
         ('reads used, aligned to genome, multiple loci',num_reads_used_genome_multimapped),
         ('reads used, aligned to genome, unique loci',num_reads_used_genome_unique),
-        ('reads used, aligned to ERCC, multiple loci',ercc_used_multimapped),
-        ('reads used, aligned to ERCC, unique loci',ercc_used_unique),        
+        ('reads used, aligned to ERCC, multiple loci',stats['ercc_used_multimapped']),
+        ('reads used, aligned to ERCC, unique loci',stats['ercc_used_unique']),        
         ('detected genes',detected_genes),
         ('total UMIs',total_UMIs)
         ])
-    
+    add_collapse_metrics(metric_dict,distinct_UMIs,total_UMIs,umi_method)
     write_metrics(metricfile,metric_dict,metric_dict.keys())
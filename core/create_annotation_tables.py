@@ -2,8 +2,11 @@ import sqlite3
 import os
 import io
 import gzip
+import time
 from intervaltree import IntervalTree
 from collections import defaultdict
+## Modules from this project
+from gene_index import GeneIndex
 
 
 def open_by_magic(filename):
@@ -74,16 +77,16 @@ def create_gene_hash(annotation_gtf,ercc_bed):
 
     return gene_info
 
-def create_gene_tree(annotation_gtf,ercc_bed,species,merge_coordinates=False):
+def read_gene_intervals(annotation_gtf,ercc_bed,species,merge_coordinates=False):
     '''
     :param str annotation_gtf : a gtf file for identifying genic regions
     :param str ercc_bed: a bed file for storing information about ERCC regions
     :param str species: species name (qiagen's internal alias)
     
-    :return An interval tree with annotation gene and ercc annotation information
-    :rtype object : IntervalTree data structure
+    :return (number of genes , list of (start,end,gene information)) , end is exclusive
+    :rtype tuple
     '''
-    gene_tree = defaultdict(lambda:defaultdict(IntervalTree))
+    intervals = []
     genes = defaultdict(list)
     valid_chromosomes = ["chr"+str(i) for i in range(0,23)]    
     valid_chromosomes.extend(["chrX","chrY","chrM","chrMT"])
@@ -158,7 +161,7 @@ def create_gene_tree(annotation_gtf,ercc_bed,species,merge_coordinates=False):
                 raise Exception("Duplicate ERCC names !")
             genes[chrom].append((int(start),int(end),chrom,strand,chrom,"_"+chrom+"_"))
     
-    ## Build a gene tree to store gene info
+    ## Gene info for each interval
     for gene in genes:
         for info in genes[gene]:
             start,end,chrom,strand,gene,ensembl_id = info
@@ -170,7 +173,40 @@ def create_gene_tree(annotation_gtf,ercc_bed,species,merge_coordinates=False):
                 five_prime = end
                 three_prime = start
             new_info = (ensembl_id,gene,strand,chrom,five_prime,three_prime)
-            gene_tree[chrom][strand].addi(start,end+1,new_info)
+            intervals.append((start,end+1,new_info))
+
+    return (len(genes),intervals)
 
-    print "Interval tree created with {ngenes} genes".format(ngenes=len(genes))
+def create_gene_tree(annotation_gtf,ercc_bed,species,merge_coordinates=False):
+    '''
+    :param str annotation_gtf : a gtf file for identifying genic regions
+    :param str ercc_bed: a bed file for storing information about ERCC regions
+    :param str species: species name (qiagen's internal alias)
+    
+    :return An interval tree with annotation gene and ercc annotation information
+    :rtype object : IntervalTree data structure
+    '''
+    gene_tree = defaultdict(lambda:defaultdict(IntervalTree))
+    ngenes,intervals = read_gene_intervals(annotation_gtf,ercc_bed,species,merge_coordinates)
+    for start,end,info in intervals:
+        strand,chrom = info[2],info[3]
+        gene_tree[chrom][strand].addi(start,end,info)
+
+    print "Interval tree created with {ngenes} genes".format(ngenes=ngenes)
     return gene_tree
+
+def create_gene_index(annotation_gtf,ercc_bed,species,merge_coordinates=False):
+    '''
+    :param str annotation_gtf : a gtf file for identifying genic regions
+    :param str ercc_bed: a bed file for storing information about ERCC regions
+    :param str species: species name (qiagen's internal alias)
+    
+    :return A sorted interval index with the same gene and ercc annotation information as create_gene_tree
+    :rtype object : GeneIndex
+    '''
+    start = time.time()
+    ngenes,intervals = read_gene_intervals(annotation_gtf,ercc_bed,species,merge_coordinates)
+    gene_index = GeneIndex(set(intervals)) ## identical intervals are stored once , as in the IntervalTree
+    print "Gene index created with {ngenes} genes , {n} intervals in {t:.1f} s".format(
+        ngenes=ngenes,n=len(gene_index),t=time.time()-start)
+    return gene_index
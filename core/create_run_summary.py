@@ -7,6 +7,7 @@ import glob
 import gzip
 import subprocess
 from combine_cell_results import float_to_string
+from sparse_counts import read_matrix_market
 
 def read_sample_metrics(sample_metrics_file):
     '''
@@ -47,6 +48,8 @@ def read_cell_metrics(cell_metrics_file):
 def calc_stats_gene_count(combined_gene_count_file):
     '''
     '''
+    if combined_gene_count_file.endswith('.mtx'):
+        return calc_stats_sparse_gene_count(combined_gene_count_file)
     cell_metrics = defaultdict(lambda:defaultdict(int))
     temp = defaultdict(int)
     
@@ -76,6 +79,37 @@ def calc_stats_gene_count(combined_gene_count_file):
 
     return (cell_metrics, temp['num_genes'], temp['num_ercc'], temp['umis_genes'], temp['umis_ercc'])
 
+def calc_stats_sparse_gene_count(combined_gene_count_mtx):
+    ''' calc_stats_gene_count for the sparse combined gene counts
+    :param str combined_gene_count_mtx: the .mtx file written by sparse_counts.MatrixMarketWriter
+    '''
+    cell_metrics = defaultdict(lambda:defaultdict(int))
+    temp = defaultdict(int)
+    features,cells,entries = read_matrix_market(combined_gene_count_mtx)
+    seen = set()
+    for row,col,count in entries:
+        if count == 0:
+            continue
+        if features[row][1].startswith('ERCC-'):
+            met1 = 'num_ercc'
+            met2 = 'umis_ercc'
+        else:
+            met1 = 'num_genes'
+            met2 = 'umis_genes'
+        if row not in seen:
+            seen.add(row)
+            temp[met1] += 1
+            ## every cell gets the metrics , as in the dense file
+            for cell in cells:
+                cell_metrics[cell][met2] += 0
+                cell_metrics[cell]['umis'] += 0
+        temp[met2] += count
+        cell_metrics[cells[col]][met1] += 1
+        cell_metrics[cells[col]][met2] += count
+        cell_metrics[cells[col]]['umis'] += count
+
+    return (cell_metrics, temp['num_genes'], temp['num_ercc'], temp['umis_genes'], temp['umis_ercc'])
+
 def calc_median_cell_metrics(cell_metrics,metric,cells_to_drop=[],drop_outlier_cells = False):
     ''' Calculate median across all cells for a given metric
     :param dict cell_metrics: dictionary of metrics for each cell
@@ -147,7 +181,7 @@ def get_cells_demultiplexed(run_id):
     '''
     '''
     counter=0
-    search_path = os.path.join("/home/qiauser/{run_id}/primary_analysis/*/*/*.fastq".format(run_id=run_id))
+    search_path = os.path.join("/home/qiauser/{run_id}/primary_analysis/*/*/*.fastq*".format(run_id=run_id))
     for fastq in glob.glob(search_path):
         if not is_file_empty(fastq):
             counter+=1
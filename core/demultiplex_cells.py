@@ -5,20 +5,31 @@ import sys
 import collections
 import os
 import errno
-import re
-import edlib
-
-import regex
-from pathos import multiprocessing
-
-import pyximport
-pyximport.install(reload_support=True)
-from _utils import two_fastq_heads
+import threading
+import Queue
+import cPickle
+import resource
+import time
+
+try:
+    from _utils import two_fastq_heads,process_reads_chunk,locate_vector
+except ImportError: ## _utils not built with setup.py build_ext , compile it on import (development)
+    import pyximport
+    pyximport.install(reload_support=True)
+    from _utils import two_fastq_heads,process_reads_chunk,locate_vector
+from fastq_io import open_reader,open_writer,close_writer,compress_block,summarize_throughput,COMPRESSION_TYPES
+from fastq_io import bam_header,sample_bam_path,cell_fastq_path,read_cell_index_file,OUTPUT_TYPES
+from cell_index_correction import load_correction_table,CORRECTION_NAMES
+from shared_ring import SharedRing,attach
+from executor import get_pool
+from chunk_tuning import ChunkTuner
+from profiling import record
 
 # Metric names
 # 1. Per cell level
 CELL_READS_TOTAL = "reads total"
 CELL_AFTER_QC    = "after_qc_reads" # for now any read >= 25 b.p after polyA trim
+CELL_CORRECTED   = "reads cell id {c}" # one metric for each cell_index_correction.CORRECTION_NAMES
 # 2. Sample Index level
 OVERALL_TOTAL                         =  "reads total"
 OVERALL_DROPPED_ALL_N                 =  "reads dropped, all NNNNNN sequence"
@@ -26,16 +37,27 @@ OVERALL_DROPPED_CELLID_NOT_EXTRACTED  =  "reads dropped, cell id not extracted"
 OVERALL_DROPPED_CELLID_MISMATCH       =  "reads dropped, cell id not matching a used oligo within edit distance {e} bp"
 OVERALL_DROPPED_LT_25BP               =  "reads dropped, less than 25 bp"
 
+## Key of the per sample BAM in the output file handles , when demultiplexing to BAM
+SAMPLE_BAM = "sample_bam"
+
+## The cell index correction tables , (table,n_table,slot_cells)
+## set once in each worker process by init_worker rather than pickled with every chunk
+CORRECTION = None
+
 
-def open_fh(fname1,fname2,read=True):
+def open_fh(fname1,fname2,read=True,threads=0,logger=None):
     ''' Return appropriate file handles
     :param str fname1: R1 fastq file name
     :param str fname2: R2 fastq file name
     :param bool read: rb/wb mode
+    :param int threads: read mode only , number of pigz threads for decompressing each file
+    :param object logger: read mode only , the logger
     :rtype tuple
     :returns tuple of file handles
     '''
-    mode = "rb" if read else "wb"
+    if read:
+        return (open_reader(fname1,threads,logger),open_reader(fname2,threads,logger))
+    mode = "wb"
     if fname1.endswith(".gz"):
         return (gzip.open(fname1,mode),gzip.open(fname2,mode))
     else:
@@ -49,13 +71,15 @@ def close_fh(fh1,fh2):
     fh1.close()
     fh2.close()
     
-def iterate_fastq(f,f2,ncpu,buffer_size=4*4*1024**2):
+def iterate_fastq(f,f2,ncpu,buffer_size=4*4*1024**2,chunk_size=None):
     ''' Copied from cutadapt, 
     added logic to yield a list of buffers equal to the number of CPUs
     :param file_handle f:  R1 fastq
     :param file_handle f2: R2 fastq
     :param int ncpu: length of buffer list 
     :param int buffer_size: size in bytes of each element of buffer list
+    :param function chunk_size: returns the size in bytes of the next element , to change it while
+                                reading , see chunk_tuning ; None for buffer_size
 
     :yields list of length ncpu
     '''
@@ -71,9 +95,15 @@ def iterate_fastq(f,f2,ncpu,buffer_size=4*4*1024**2):
 
     to_yield = []
     nchunks = 0
+    size = buffer_size
     while True:
-        bufend1 = f.readinto(memoryview(buf1)[start1:]) + start1
-        bufend2 = f2.readinto(memoryview(buf2)[start2:]) + start2
+        if chunk_size is not None:
+            size = chunk_size()
+            if size > len(buf1): ## grow the buffers , the partial records carried over stay at the start
+                buf1.extend(bytearray(size-len(buf1)))
+                buf2.extend(bytearray(size-len(buf2)))
+        bufend1 = f.readinto(memoryview(buf1)[start1:size]) + start1
+        bufend2 = f2.readinto(memoryview(buf2)[start2:size]) + start2
         if start1 == bufend1 and start2 == bufend2:
             break
 
@@ -102,50 +132,229 @@ def iterate_fastq(f,f2,ncpu,buffer_size=4*4*1024**2):
     if len(to_yield) > 0:
         yield to_yield
 
-def mutate(x):
-    ''' Returns all possible single base substitutions of a dna string
-    including N , to represent sequencing error
-    :param str x: the dna nucleotide sequence to mutate
-    :yields the possible mutated strings
+def read_ahead(tasks,slots,read_queue,counters,errors):
+    ''' Producer for the streaming demux , read chunks from the fastq files
+    into a bounded queue. A chunk slot is acquired before each chunk is queued so
+    that only a fixed number of chunks are in flight across all stages
+    :param iterator tasks: the chunks (or shared ring slots) to process , see chunk_tasks
+    :param threading.Semaphore slots: released once a chunk has been written
+    :param Queue.Queue read_queue: the read-ahead queue , None marks the end
+    :param dict counters: stage counters , updated with the chunks read and the seconds waiting for a slot
+    :param list errors: exceptions raised while reading are appended here
     '''
-    substitions = ['A','C','G','T','N']
-    for i in xrange(len(x)):
-        for b in substitions:
-            temp = list(x)
-            if temp[i] != b:
-                temp[i] = b
-                yield "".join(temp)
-
-def read_cell_index_file(cell_index_file,cell_indices_used):
+    try:
+        for task in tasks:
+            waited = time.time()
+            slots.acquire()
+            counters["reader_stall"] += time.time() - waited
+            counters["read"] += 1
+            read_queue.put(task)
+    except Exception:
+        errors.append(sys.exc_info())
+    finally:
+        read_queue.put(None)
+
+class ShardedWriter(object):
+    ''' Write the per cell fastq blocks on dedicated threads. The cells are
+    partitioned into shards and each shard is owned by one thread, hence the
+    blocks for a cell are always written in chunk order
     '''
-    Read the file containing the cell indices and
-    return cell indices used and cell indices different by 1 b.p
-
-    :param str cell_index_file: the cell index file
-    :param str cell_indices_used: comma delimeted cell ids used in the experiment
-    :return: tuple of dicts
-    :rtype: (dict,dict)
-    :raises: Exception for duplicate cell index
-    '''                
-    d = collections.OrderedDict()
-    mismatch_d = {}
-    i=1
-    used_indices = set(cell_indices_used.split(','))
-    with open(cell_index_file,'r') as IN:
-        for line in IN:
-            key = line.rstrip('\n')
-            if key in d:
-                raise Exception('Duplicate cell index encountered !')
-            if 'C'+str(i) in used_indices or cell_indices_used == 'all':            
-                d[key] = i            
-                # all possible single base mutations
-                for m_key in mutate(key):
-                    if m_key in mismatch_d:
-                        raise Exception("Duplicate mutated cell index encountered !")
-                    mismatch_d[m_key] = key
-            i+=1                
-    return (d,mismatch_d)
-        
+    def __init__(self,file_handles,nthreads,on_chunk_written):
+        ''' Class constructor
+        :param dict file_handles: cell index -> output file handle
+        :param int nthreads: number of writer threads/shards
+        :param function on_chunk_written: called with the chunk's token once all its blocks are written
+        '''
+        self.file_handles = file_handles
+        self.on_chunk_written = on_chunk_written
+        self.shard = {}
+        for i,cell_index in enumerate(sorted(file_handles)):
+            self.shard[cell_index] = i % nthreads
+        self.queues = [Queue.Queue() for i in range(nthreads)]
+        self.errors = []
+        self.threads = []
+        for q in self.queues:
+            t = threading.Thread(target=self._write,args=(q,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _write(self,q):
+        ''' Writer thread , consume (blocks,countdown) items until None
+        '''
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            blocks,countdown = item
+            try:
+                for cell_index,block in blocks:
+                    self.file_handles[cell_index].write(block)
+            except Exception:
+                self.errors.append(sys.exc_info())
+            countdown()
+
+    def submit(self,out_blocks,token=None):
+        ''' Dispatch the blocks of one chunk to the shard writers
+        :param dict out_blocks: cell index -> fastq records
+        :param object token: passed on to on_chunk_written , i.e. the shared ring slot
+        '''
+        per_shard = collections.defaultdict(list)
+        for cell_index,block in out_blocks.items():
+            per_shard[self.shard[cell_index]].append((cell_index,block))
+        if not per_shard:
+            self.on_chunk_written(token)
+            return
+        remaining = [len(per_shard)]
+        lock = threading.Lock()
+        def countdown():
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                self.on_chunk_written(token)
+        for i,blocks in per_shard.items():
+            self.queues[i].put((blocks,countdown))
+
+    def close(self):
+        ''' Wait for all pending writes , re-raise any error from the writers
+        '''
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        if self.errors:
+            exc_type,exc_value,tb = self.errors[0]
+            raise exc_type,exc_value,tb
+
+def demux_streaming(p,func,tasks,ring,file_handles,chunks_in_flight,writer_threads,logger,tuner=None):
+    ''' Pipelined demultiplexing , reading , processing in the worker pool and
+    writing of the per cell fastqs all run concurrently. Results are delivered
+    in chunk order , hence the output is identical to the batch mode
+    :param object p: the worker pool
+    :param function func: the function to apply to each chunk , see process_chunk
+    :param iterator tasks: the chunks to process , see chunk_tasks
+    :param SharedRing ring: the shared memory ring holding the chunks , None if the chunks are pickled
+    :param dict file_handles: cell index -> output file handle
+    :param int chunks_in_flight: max number of chunks held in memory across all stages
+    :param int writer_threads: number of writer threads
+    :param object logger: the logger
+    :param ChunkTuner tuner: tunes the chunk size and the chunks in flight , None to keep them
+    :yields (metrics,transport stats) for each chunk
+    '''
+    slots = threading.Semaphore(tuner.in_flight if tuner else chunks_in_flight)
+    read_queue = Queue.Queue(maxsize=chunks_in_flight)
+    counters = {"read":0,"processed":0,"written":0,"reader_stall":0.0,"input_stall":0.0}
+    errors = []
+    lock = threading.Lock()
+
+    def on_chunk_written(token):
+        with lock:
+            counters["written"] += 1
+            retired = tuner is not None and tuner.retire_slot()
+        if token is not None:
+            ring.release(token)
+        if not retired: ## the chunks in flight were reduced by the tuner
+            slots.release()
+
+    def next_chunk():
+        waited = time.time()
+        task = read_queue.get()
+        counters["input_stall"] += time.time() - waited
+        return task
+
+    reader = threading.Thread(target=read_ahead,args=(tasks,slots,read_queue,counters,errors))
+    reader.daemon = True
+    reader.start()
+    writer = ShardedWriter(file_handles,writer_threads,on_chunk_written)
+
+    for token,out_blocks_r1,metrics,stats in p.imap(func,iter(next_chunk,None)):
+        counters["processed"] += 1
+        if tuner is not None:
+            tuner.update(counters["reader_stall"],counters["input_stall"])
+        writer.submit(chunk_blocks(ring,token,out_blocks_r1),token)
+        queued_read = read_queue.qsize()
+        logger.info("Chunks queued , read-ahead : {r} ; processing : {p} ; writing : {w}".format(
+            r=queued_read,p=counters["read"] - queued_read - counters["processed"],
+            w=counters["processed"] - counters["written"]))
+        yield (metrics,stats)
+
+    reader.join()
+    writer.close()
+    logger.info("Streaming stalls , reader waiting for a free chunk : {r:.1f} s ; workers waiting for input : {w:.1f} s".format(
+        r=counters["reader_stall"],w=counters["input_stall"]))
+    if errors:
+        exc_type,exc_value,tb = errors[0]
+        raise exc_type,exc_value,tb
+
+def demux_batch(p,func,tasks,ring,ncpu,file_handles,tuner=None):
+    ''' Process ncpu chunks at a time in the worker pool and write the
+    per cell fastqs before reading the next batch
+    :param object p: the worker pool
+    :param function func: the function to apply to each chunk , see process_chunk
+    :param iterator tasks: the chunks to process , see chunk_tasks
+    :param SharedRing ring: the shared memory ring holding the chunks , None if the chunks are pickled
+    :param int ncpu: number of chunks to process at a time
+    :param dict file_handles: cell index -> output file handle
+    :param ChunkTuner tuner: tunes the chunk size and the chunks in a batch , None to keep them
+    :yields (metrics,transport stats) for each chunk
+    '''
+    batch = []
+    for task in tasks:
+        batch.append(task)
+        if len(batch) < (tuner.in_flight if tuner else ncpu):
+            continue
+        for res in write_batch(p,func,batch,ring,file_handles):
+            yield res
+        batch = []
+        if tuner is not None:
+            tuner.update()
+    for res in write_batch(p,func,batch,ring,file_handles):
+        yield res
+
+def write_batch(p,func,batch,ring,file_handles):
+    ''' Helper function for demux_batch , process a batch of chunks and write the results
+    :yields (metrics,transport stats) for each chunk
+    '''
+    if not batch:
+        return
+    res = p.map(func,batch)
+    for token,out_blocks_r1,metrics,stats in res:
+        for cell_index,block in chunk_blocks(ring,token,out_blocks_r1).items(): # cells with atleast 1 read passing qc
+            file_handles[cell_index].write(block)
+        if token is not None:
+            ring.release(token)
+        yield (metrics,stats)
+
+def chunk_tasks(f,f2,buffer_size,ring,tuner=None):
+    ''' The chunks to send to the worker pool
+    :param file_handle f:  R1 fastq
+    :param file_handle f2: R2 fastq
+    :param int buffer_size: size in bytes of each chunk
+    :param SharedRing ring: the shared memory ring , None to pickle the chunks
+    :param ChunkTuner tuner: sets the size of each chunk , None for buffer_size
+    :yields (R1 chunk,R2 chunk) or (slot,R1 chunk length,R2 chunk length) with a ring
+    '''
+    chunk_size = tuner.next_chunk_size if tuner else None
+    if ring is not None:
+        for task in ring.chunks(f,f2,chunk_size):
+            yield task
+    else:
+        for chunks in iterate_fastq(f,f2,1,tuner.chunk_size if tuner else buffer_size,chunk_size):
+            for chunk in chunks:
+                yield chunk
+
+def chunk_blocks(ring,token,out_blocks):
+    ''' Main process side , the per cell blocks returned by process_chunk
+    :param SharedRing ring: the shared memory ring , None if the chunks are pickled
+    :param object token: the ring slot , None if the blocks were pickled
+    :param object out_blocks: cell index -> fastq records , or their placements in the slot's arena
+    :rtype dict
+    '''
+    if token is None or isinstance(out_blocks,dict):
+        return out_blocks
+    return ring.out_blocks(token,out_blocks)
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -155,170 +364,81 @@ def mkdir_p(path):
         else:
             raise exc
 
-def id_cell_umi_nextseq(r2_seq,cell_index_len,umi_len):
-    ''' Identify cell id and umi region for nextseq reads
+def init_worker(correction):
+    ''' Pool initializer , store the cell index correction tables in the worker
+    :param tuple correction: (table,n_table,slot_cells) , see cell_index_correction
     '''
-    if len(r2_seq) >= cell_index_len + umi_len - 1: # allow 1 base offset
-        cellid = r2_seq[0:cell_index_len]
-        umi    = r2_seq[cell_index_len:cell_index_len+umi_len]
-        return (cellid,umi)
-    else:
-        return (None,None)
-
-def id_cell_umi(r2_seq,cell_index_len,umi_len,vector,error):
-    ''' Identify cell id and umi region for MiSeq/HiSeq reads
-    '''
-    found = False
-    alignment = edlib.align(vector,r2_seq,mode="SHW")    
-    if alignment["editDistance"] <= error:   
-    
-        vector_end_pos = alignment["locations"][-1][1] # 0-based position on r2
-        temp = r2_seq[vector_end_pos + 1:]
-
-        if len(temp) >= cell_index_len + umi_len - 1: # allow 1 base offset
-            found = True
+    global CORRECTION
+    CORRECTION = correction
 
-            cellid = temp[0:cell_index_len]
-            umi    = temp[cell_index_len:cell_index_len+umi_len]       
-
-    if found:
-        return (cellid,umi)
-    else:
-        return (None,None)
-    
-    
 def process_reads(args,buffer_):
     ''' Process R1,R2 fastq files , identify and trim synthetic oligos and polyA tail
+    The per read work is done by the compiled kernel _utils.process_reads_chunk
+    :param tuple args: the demultiplexing params , see demux
+    :param tuple buffer_: (R1 chunk, R2 chunk) as yielded by iterate_fastq
+    :returns (cell index -> newline terminated fastq records for the cell , metrics)
+             for BAM output , the only key is SAMPLE_BAM with the BGZF compressed records of all cells
+    :rtype tuple
     '''
-    cell_indices,cell_indices_mismatch,editdist,wts,cell_index_len,umi_len,vector,error,instrument = args
+    wts,cell_index_len,umi_len,vector,error,instrument,compression,output = args
+    correction_table,correction_n_table,slot_cells = CORRECTION
     
     # unpack input byte string                                 
     buff_r1,buff_r2 = buffer_
-    r1_lines        = buff_r1.split(b"\n")
-    r2_lines        = buff_r2.split(b"\n")
-
-    # init counters
-    num_reads                               = 0
-    reads_dropped_all_N                     = 0
-    reads_dropped_cellid_not_extracted      = 0
-    reads_dropped_cellid_not_matching_oligo = 0
-    reads_dropped_lt_25bp                   = 0
-
-    out_lines_r1 = collections.defaultdict(list)
-    cell_metrics = collections.defaultdict(
-        lambda:collections.defaultdict(int))
-    
-    i = 1
-    for line in zip(r1_lines,r2_lines):
-        
-        if line[0] == "": # last element is empty because of the split("\n") above
-            continue
-        if i % 4 == 1: # header
-            r1_readid,r2_readid = line
-        elif i % 4 == 2: # seq
-            r1_seq,r2_seq = line
-        elif i % 4 == 3: # placeholder
-            pass
-        elif i % 4 == 0: # qual
-            num_reads += 1
-            r1_qual,r2_qual = line
-
-            # have R1 and R2 ready to process now
-            temp_r1_readid = r1_readid.split(" ")[0]
-            temp_r2_readid = r2_readid.split(" ")[0]
-            if temp_r1_readid != temp_r2_readid:
-                raise UserWarning("demultiplex_cells:R1,R2 read ids are not in sync : R1:{r1} ; R2:{r2}".format(r1=temp_r1_readid,r2=temp_r2_readid))
-            elif len(r1_qual) != len(r1_seq) or len(r2_qual) != len(r2_seq):
-                raise UserWarning("demultiplex_cells:Read has different length qual and seq strings {}}".format(temp_r1_readid))
-
-            # extract cell id , umi region from R2
-            stop = False
-            if instrument.upper() == "NEXTSEQ":
-                cellid,umi = id_cell_umi_nextseq(r2_seq,cell_index_len,umi_len)
-            else:
-                cellid,umi = id_cell_umi(r2_seq,cell_index_len,umi_len,vector,error)
-                
-            if cellid:
-                if cellid not in cell_indices:                    
-                    stop = True
-                    if editdist == 1:
-                        if cellid in cell_indices_mismatch: # if within 1 edit distance recover                        
-                            cellid = cell_indices_mismatch[cellid]
-                            stop = False
-                        else:
-                            reads_dropped_cellid_not_matching_oligo += 1
-                    else:
-                        reads_dropped_cellid_not_matching_oligo += 1 
-            else:
-                stop = True                
-                if len(set(r2_seq)) == 1 and r2_seq[0] == 'N':
-                    reads_dropped_all_N += 1
-                else:
-                    reads_dropped_cellid_not_extracted += 1
-
-            if stop:
-                i+=1                
-                continue
-
-            new_read_id = temp_r1_readid + b":{}".format(umi)
-
-            # polyA trim
-            polyA_pattern = _REGEX_["r1_polyA"]
-            match = polyA_pattern.match(r1_seq)
-            if match:
-                tail = match.group(2)
-                trimming_index  = match.start(2)                
-                r1_trimmed_seq  = match.group(1)
-                r1_trimmed_qual = r1_qual[0:trimming_index]
-            else:
-                r1_trimmed_seq  = r1_seq
-                r1_trimmed_qual = r1_qual
-
-            # store per cell level metrics
-            cell_metrics[cellid][CELL_READS_TOTAL]+=1
-            if len(r1_trimmed_seq) < 25:
-                reads_dropped_lt_25bp+=1
-                stop = True
-            else:
-                cell_metrics[cellid][CELL_AFTER_QC]+=1
-                
-            if stop:
-                i+=1
-                continue
-
-            trimmed_r1_lines = b"\n".join([new_read_id,r1_trimmed_seq,b"+",r1_trimmed_qual])
-            out_lines_r1[cellid].append(trimmed_r1_lines)
-            
-        i+=1
-
-    metrics = (cell_metrics, num_reads, reads_dropped_all_N, reads_dropped_cellid_not_extracted, reads_dropped_cellid_not_matching_oligo, reads_dropped_lt_25bp)
-    return (out_lines_r1,metrics)
-
-def compile_regex(wts,instrument,multiplex_len,vector,error):
-    ''' Setup regular expressions for cell id umi identification and polyA trim
-    :param bool wts : Whether this is a polyA wts experiment
-    :param str instrument : MiSeq/HiSeq or NextSeq
-    :param int multiplex_len : CellID + UMI length
-    :param str vector : Vector sequence
-    :param int error : Indel/SNPs to tolerate on vector sequence    
+    is_nextseq = instrument.upper() == "NEXTSEQ"
+    vector_offsets = None if is_nextseq else locate_vector(buff_r2,vector,error)
+    res = process_reads_chunk(buff_r1,buff_r2,correction_table,correction_n_table,slot_cells,wts,
+                              cell_index_len,umi_len,vector_offsets,is_nextseq,output == "bam")
+    out_blocks_r1 = res[0]
+    if output == "bam":
+        records = b"".join(out_blocks_r1[cellid] for cellid in sorted(out_blocks_r1))
+        out_blocks_r1 = {SAMPLE_BAM:compress_block(records,"bgzf")} if records else {}
+    elif compression != "none":
+        for cellid in out_blocks_r1:
+            out_blocks_r1[cellid] = compress_block(out_blocks_r1[cellid],compression)
+    cell_metrics = {}
+    for cellid,counts in res[1].items():
+        cell_metrics[cellid] = {CELL_READS_TOTAL:counts[0],CELL_AFTER_QC:counts[1]}
+        for name,count in zip(CORRECTION_NAMES,counts[2:]):
+            cell_metrics[cellid][CELL_CORRECTED.format(c=name)] = count
+
+    metrics = (cell_metrics,) + res[2:]
+    return (out_blocks_r1,metrics)
+
+def process_chunk(args,layout,task):
+    ''' Worker side entry point , process a chunk either pickled or in a shared memory slot
+    :param tuple args: the demultiplexing params , see demux
+    :param tuple layout: SharedRing.layout , None if the chunks are pickled
+    :param tuple task: as yielded by chunk_tasks
+    :returns (slot or None , out blocks or their placements in the slot's arena , metrics ,
+              (bytes pickled for the task , bytes pickled for the result , peak rss of the worker))
+    :rtype tuple
     '''
-    # regex used for trimming
-    if wts:
-        r1_polyA = re.compile(r'^([ACGTN]*?[CGTN])([A]{9,}[ACGNT]*$)')
-    else:
-        r1_polyA = re.compile(r'^([ACGTN]{42,}[CGTN])([A]{8,}[ACGNT]{1,}$)')
-
-    # deprecated not used anymore; kept here for reference
-    if instrument.upper() == 'NEXTSEQ':
-        r2_structure = regex.compile(r'(([ACGTN]{%i})[ACGTN]*)'%(multiplex_len))
-        match_group = 2
+    if layout is None:
+        token = None
+        out_blocks_r1,metrics = process_reads(args,task)
     else:
-        match_group = 3
-        r2_structure = regex.compile(r'((%s){e<=%i}([ACGNT]{%i,%i})[ACGTN]*)'%(
-            vector,error,multiplex_len-1,multiplex_len+1))
+        token,len1,len2 = task
+        ring = attach(layout)
+        buf1,buf2 = ring.inputs(token)
+        out_blocks_r1,metrics = process_reads(args,(buf1[:len1],buf2[:len2]))
+        placements = ring.place_blocks(token,out_blocks_r1)
+        if placements is not None: # otherwise the blocks are too large for the arena and are pickled
+            out_blocks_r1 = placements
+    res = (token,out_blocks_r1,metrics)
+    return res + ((pickled_size(task),pickled_size(res),peak_rss()),)
+
+def pickled_size(obj):
+    ''' Bytes needed to pickle an object
+    :rtype int
+    '''
+    return len(cPickle.dumps(obj,cPickle.HIGHEST_PROTOCOL))
 
-    global _REGEX_
-    _REGEX_ = {"r1_polyA":r1_polyA,"r2_structure":(r2_structure,match_group)}
+def peak_rss():
+    ''' Peak resident set size of this process in bytes
+    :rtype int
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
 
 def write_metrics(metric_file,metric_dict,metrics):
     ''' Write Metrics
@@ -336,7 +456,9 @@ def write_metrics(metric_file,metric_dict,metrics):
     
 def demux(r1,r2,cell_index_file,base_dir,out_metric_file,cell_indices_used,vector,
           instrument,wts,return_demux_rate,cell_index_len,umi_len,editdist,error,ncpu,buffer_size,
-          logfile):
+          logfile,mode="batch",chunks_in_flight=8,writer_threads=4,compression="none",decompress_threads=0,
+          cell_index_indel=0,cell_index_cache_dir=None,shared_memory=False,output="fastq",
+          autotune=False,memory_budget=1024,autotune_chunks=8):
     ''' Demultiplex and write fastq files for each cell
     :param str r1: R1 fastq file
     :param str r2: R2 fastq file
@@ -350,11 +472,25 @@ def demux(r1,r2,cell_index_file,base_dir,out_metric_file,cell_indices_used,vecto
     :param bool return_demux_rate : Return reads_after_demux/total_reads if requested
     :param int cell_index_len : Cell Index oligo length
     :param int umi_len : UMI oligo length
-    :param int editdist : 0/1 ; Whether to allow 1 editdistance mismatch to cell indices specified
+    :param int editdist : 0/1/2 ; Max hamming distance to correct the cell indices specified
     :param int error : Number of Indels/SNPs to tolerate in vector sequence
     :param int ncpu: Number of CPUs to use
     :param int buffer_size : Read these many MegaBytes(MB) from fastq file to memory for each read pair for each cpu
     :param str logfile : file for logging
+    :param str mode : batch/streaming ; streaming overlaps reading , processing and writing
+    :param int chunks_in_flight : streaming mode only , max number of chunks held in memory
+    :param int writer_threads : streaming mode only , number of threads writing the cell fastqs
+    :param str compression : none/gzip/bgzf ; compression of the cell fastqs , done in the worker processes
+    :param int decompress_threads : number of pigz threads for decompressing each input fastq , 0 to use the gzip module
+    :param int cell_index_indel : 0/1 ; Whether to also correct a single insertion/deletion in the cell indices
+    :param str cell_index_cache_dir : directory to cache the cell index correction table , defaults to base_dir
+    :param bool shared_memory : hand the chunks to the workers through a shared memory ring instead of pickling them
+    :param str output : fastq/bam ; one fastq per cell , or one unaligned BAM per sample with the
+                        cell index and UMI in the CB and UB tags
+    :param bool autotune : tune buffer_size and the chunks processed at a time (ncpu , or chunks_in_flight when
+                           streaming) on the first chunks , see chunk_tuning
+    :param int memory_budget : auto tuning only , MegaBytes(MB) the chunks may hold
+    :param int autotune_chunks : auto tuning only , number of chunks processed before tuning
     '''
     ## Set up logging
     logger = logging.getLogger("demultiplex_cells")
@@ -370,11 +506,26 @@ def demux(r1,r2,cell_index_file,base_dir,out_metric_file,cell_indices_used,vecto
     error              = int(error)
     ncpu               = int(ncpu)
     buffer_size        = int(buffer_size)*1024**2
+    chunks_in_flight   = int(chunks_in_flight)
+    writer_threads     = int(writer_threads)
+    decompress_threads = int(decompress_threads)
+    cell_index_indel   = bool(int(cell_index_indel))
+    shared_memory      = bool(int(shared_memory))
+    autotune           = bool(int(autotune))
+    memory_budget      = int(memory_budget)*1024**2
+    autotune_chunks    = int(autotune_chunks)
+    if cell_index_cache_dir is None:
+        cell_index_cache_dir = base_dir
 
     FASTQS = {}
     METRICS = {}
     
     assert instrument.upper() in ["NEXTSEQ","MISEQ/HISEQ"], "Incorrect instrument specification"
+    assert mode in ["batch","streaming"], "Incorrect demux mode specification"
+    assert compression in COMPRESSION_TYPES, "Incorrect compression specification"
+    assert output in OUTPUT_TYPES, "Incorrect output specification"
+    if output == "bam":
+        compression = "bgzf"
 
     logger.info("Running Demux with args : \n")
     logger.info("WTS : {}".format(wts))
@@ -382,35 +533,64 @@ def demux(r1,r2,cell_index_file,base_dir,out_metric_file,cell_indices_used,vecto
     logger.info("Cell Index Length : {}".format(cell_index_len))
     logger.info("UMI Length: {}".format(umi_len))
     logger.info("EditDist Allowed: {}".format(editdist))
+    logger.info("Cell Index Indel Correction: {}".format(cell_index_indel))
     logger.info("Errors Tolerated in Vector: {}".format(error))
     logger.info("Num CPUs used: {}".format(ncpu))
     logger.info("Buffer size {} MB".format(buffer_size/1024*1024))
+    logger.info("Demux mode : {}".format(mode))
+    if mode == "streaming":
+        logger.info("Chunks in flight : {}".format(chunks_in_flight))
+        logger.info("Writer threads : {}".format(writer_threads))
+    logger.info("Output : {}".format(output))
+    logger.info("Output compression : {}".format(compression))
+    logger.info("Decompression threads : {}".format(decompress_threads))
+    logger.info("Shared memory chunks : {}".format(shared_memory))
+    logger.info("Auto tuning : {}".format(autotune))
     logger.info("---"*10)
     logger.info("\n")
     
-    multiplex_len = cell_index_len + umi_len
-    compile_regex(wts,instrument,multiplex_len,vector,error)
-    cell_indices,cell_indices_mismatch = read_cell_index_file(cell_index_file,cell_indices_used)
+    cell_indices = read_cell_index_file(cell_index_file,cell_indices_used)
+    slot_cells = cell_indices.keys()
+    mkdir_p(cell_index_cache_dir)
+    correction_table,correction_n_table = load_correction_table(cell_index_file,slot_cells,editdist,cell_index_indel,
+                                                                cell_index_cache_dir,logger)
    
     for cell_index,cell_num in cell_indices.items():
         path = os.path.join(base_dir,'Cell'+str(cell_num)+'_'+cell_index)
         mkdir_p(path)
         
     for cell_index,cell_num in cell_indices.items():
-        fastq=os.path.join(base_dir,'Cell'+str(cell_num)+'_'+cell_index+
-                                         '/cell_'+str(cell_num)+'_R1.fastq')
         metric=os.path.join(base_dir,'Cell'+str(cell_num)+'_'+cell_index+
                                          '/cell_'+str(cell_num)+'_demultiplex_stats.txt')
-        FASTQS[cell_index] = open(fastq,'w')
         METRICS[cell_index] = metric
+        if output == "fastq":
+            fastq=cell_fastq_path(base_dir,cell_num,cell_index,compression)
+            FASTQS[cell_index] = open_writer(fastq)
+    if output == "bam":
+        FASTQS[SAMPLE_BAM] = open_writer(sample_bam_path(base_dir))
+        FASTQS[SAMPLE_BAM].write(compress_block(bam_header(os.path.basename(os.path.normpath(base_dir)),cell_indices),"bgzf"))
 
     
-    f,f2 = open_fh(r1,r2)
+    f,f2 = open_fh(r1,r2,threads=decompress_threads,logger=logger)
     
-    p = multiprocessing.Pool(ncpu)
-
-    args = (cell_indices,cell_indices_mismatch,editdist,wts,cell_index_len,umi_len,vector,error,instrument)
-    func = functools.partial(process_reads,args)
+    ## the workers are kept for the next sample demultiplexed by this process with the same cell indices
+    p = get_pool("demux",ncpu,init_worker,((correction_table,correction_n_table,slot_cells),),
+                 key=(os.path.abspath(cell_index_file),cell_indices_used,editdist,cell_index_indel))
+    pool_wall,pool_busy = p.wall,p.busy
+
+    tuner = None
+    if autotune:
+        tuner = ChunkTuner(buffer_size,chunks_in_flight if mode == "streaming" else ncpu,memory_budget,
+                           autotune_chunks,(f,f2),p,logger)
+        buffer_size = tuner.max_chunk_size ## the largest chunk the ring holds
+
+    args = (wts,cell_index_len,umi_len,vector,error,instrument,compression,output)
+    ring = None
+    if shared_memory:
+        ## the output arena has room for the umi added to each read header
+        ring = SharedRing(chunks_in_flight if mode == "streaming" else ncpu,buffer_size,buffer_size*5/4)
+        logger.info("Shared memory ring : {}".format(ring.path))
+    func = functools.partial(process_chunk,args,ring.layout if ring else None)
     
     nchunk                                   =  0
     total_reads                              =  0
@@ -418,14 +598,22 @@ def demux(r1,r2,cell_index_file,base_dir,out_metric_file,cell_indices_used,vecto
     reads_dropped_cellid_not_extracted       =  0
     reads_dropped_cellid_not_matching_oligo  =  0
     reads_dropped_lt_25bp                    =  0
+    reads_dropped_cellid_ambiguous           =  0
+    bytes_pickled_to_workers                 =  0
+    bytes_pickled_from_workers               =  0
+    worker_peak_rss                          =  0
 
     cell_metrics = collections.defaultdict(
         lambda:collections.defaultdict(int))    
     
-    for chunks in iterate_fastq(f,f2,ncpu,buffer_size):
-        res = p.map(func,chunks)
-        for trimmed_r1_lines,metrics in res:
-            
+    tasks = chunk_tasks(f,f2,buffer_size,ring,tuner)
+    if mode == "streaming":
+        results = demux_streaming(p,func,tasks,ring,FASTQS,chunks_in_flight,writer_threads,logger,tuner)
+    else:
+        results = demux_batch(p,func,tasks,ring,ncpu,FASTQS,tuner)
+
+    try:
+        for metrics,stats in results:
             # unpack return variables and update counters
             temp_cell_metrics = metrics[0]
             total_reads                             += metrics[1]
@@ -433,21 +621,28 @@ def demux(r1,r2,cell_index_file,base_dir,out_metric_file,cell_indices_used,vecto
             reads_dropped_cellid_not_extracted      += metrics[3]
             reads_dropped_cellid_not_matching_oligo += metrics[4]
             reads_dropped_lt_25bp                   += metrics[5]
-            
+            reads_dropped_cellid_ambiguous          += metrics[6]
+            bytes_pickled_to_workers                += stats[0]
+            bytes_pickled_from_workers              += stats[1]
+            worker_peak_rss                          = max(worker_peak_rss,stats[2])
+
             for cell_index in temp_cell_metrics: # accumulate cell specific
                 for metric in temp_cell_metrics[cell_index]:
                     cell_metrics[cell_index][metric] += temp_cell_metrics[cell_index][metric]
-                if trimmed_r1_lines[cell_index]:   # list has atleast 1 element
-                    out_r1 = b"\n".join(trimmed_r1_lines[cell_index])
-                    FASTQS[cell_index].write(out_r1)
-                    FASTQS[cell_index].write(b"\n")
-                
-        nchunk += 1
-        logger.info("Processed {} read fragments".format(total_reads))
+
+            nchunk += 1
+            logger.info("Processed {n} read fragments ; bytes pickled for this chunk , to workers : {i} ; from workers : {o}".format(
+                n=total_reads,i=stats[0],o=stats[1]))
+    finally:
+        if ring is not None:
+            ring.close()
+    if tuner is not None and not tuner.tuned:
+        logger.info("Auto tuning : {} chunks , too few to tune".format(nchunk))
 
     # write final metrics
     # 1. Per cell level
-    metrics_to_write = [CELL_READS_TOTAL, CELL_AFTER_QC]
+    metrics_to_write = [CELL_READS_TOTAL, CELL_AFTER_QC] + \
+                       [CELL_CORRECTED.format(c=name) for name in CORRECTION_NAMES]
     for cell_index,mfile in METRICS.items():
         write_metrics(mfile,cell_metrics[cell_index],metrics_to_write)
 
@@ -460,14 +655,35 @@ def demux(r1,r2,cell_index_file,base_dir,out_metric_file,cell_indices_used,vecto
                                            (OVERALL_DROPPED_CELLID_MISMATCH, reads_dropped_cellid_not_matching_oligo),
                                            (OVERALL_DROPPED_LT_25BP, reads_dropped_lt_25bp)])
     write_metrics(out_metric_file, metric_dict, metric_dict.keys())
+    logger.info("Reads dropped , cell id equally close to more than one cell index : {}".format(
+        reads_dropped_cellid_ambiguous))
 
     # close file handles
     for cell_index in FASTQS:
-        FASTQS[cell_index].close()
+        close_writer(FASTQS[cell_index],compression)
     close_fh(f,f2)
 
+    # log throughput for each stream
+    logger.info(f.summary())
+    logger.info(f2.summary())
+    logger.info(summarize_throughput("Cell fastqs" if output == "fastq" else "Sample BAM",sum(fh.nbytes for fh in FASTQS.values()),
+                                     sum(fh.seconds for fh in FASTQS.values())))
+    # the stages for the task profile , the reading , processing and writing overlap when streaming
+    record("demux read",f.seconds+f2.seconds,data_bytes=f.nbytes+f2.nbytes)
+    record("demux process",p.wall-pool_wall,worker_busy_s=round(p.busy-pool_busy,3),chunks=nchunk,reads=total_reads)
+    record("demux write",sum(fh.seconds for fh in FASTQS.values()),data_bytes=sum(fh.nbytes for fh in FASTQS.values()))
+    # log memory use and the data pickled between processes
+    if nchunk > 0:
+        logger.info("Bytes pickled per chunk , to workers : {i} ; from workers : {o}".format(
+            i=bytes_pickled_to_workers/nchunk,o=bytes_pickled_from_workers/nchunk))
+    logger.info("Peak RSS , main process : {m:.1f} MB ; workers : {w:.1f} MB".format(
+        m=peak_rss()/float(1024**2),w=worker_peak_rss/float(1024**2)))
+    logger.info(p.summary())
+
     logger.info("---"*10)
     logger.info("Demux Finished")
+    logger.removeHandler(LOG) ## the next sample demultiplexed by this process logs to its own file
+    LOG.close()
     if return_demux_rate:
         passed_reads = float(total_reads - reads_dropped_all_N - \
                              reads_dropped_cellid_not_extracted - \
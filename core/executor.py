@@ -0,0 +1,167 @@
+'''
+Worker pools shared by the stages of a pipeline process , so that the worker
+processes are spawned , and their read only state (the gene index , the primer
+tree , the cell index correction tables) set up by the pool initializer , once
+per process running luigi tasks rather than once per cell.
+
+A pool is looked up by name with get_pool. It is reused as long as the number of
+cores and the key of its initializer state are the same , and replaced otherwise.
+A pool created by another process , e.g. inherited by a luigi task process forked
+from the scheduler's worker , is never used nor closed , the child creates its own.
+
+How long a pool lives depends on how luigi runs the tasks :
+1. luigi --workers 1 runs every task in the luigi process itself , the pools are
+   reused by all the tasks and closed with shutdown when the process exits
+2. luigi --workers N , N > 1 , forks a process for each task , which exits with
+   os._exit without running shutdown. The pools only live for the task and are closed
+   by end_task . They are reused across the cells of a task with cells_per_task > 1
+end_task is called at the end of every task , see single_cell_rnaseq.py , it logs
+the usage of the pools in either case.
+
+Each pool keeps track of the seconds its workers spend on tasks , to report the
+utilisation and the idle time of the workers , see WorkerPool.summary.
+'''
+
+import atexit
+import os
+import time
+from multiprocessing import current_process
+import pathos.multiprocessing as multiprocessing
+
+## name -> WorkerPool
+POOLS = {}
+
+def timed_call(func_arg):
+    ''' Worker side , apply a function and time it
+    :param tuple func_arg: (function , argument)
+    :returns (seconds , result)
+    :rtype tuple
+    '''
+    func,arg = func_arg
+    start = time.time()
+    result = func(arg)
+    return (time.time() - start,result)
+
+class WorkerPool(object):
+    ''' A process pool with bookkeeping of the time its workers are busy
+    '''
+    def __init__(self,name,cores,initializer=None,initargs=(),key=None):
+        ''' Class constructor
+        :param str name: the name of the pool
+        :param int cores: the number of worker processes
+        :param function initializer: run once in each worker process with initargs
+        :param tuple initargs: the arguments of initializer
+        :param object key: identifies the state set up by initializer
+        '''
+        self.name = name
+        self.cores = cores
+        self.key = key
+        self.pid = os.getpid()
+        self.pool = multiprocessing.Pool(cores,initializer=initializer,initargs=initargs)
+        self.created = time.time()
+        self.closed = None
+        self.calls = 0
+        self.tasks = 0
+        self.busy = 0.0 ## worker seconds spent on tasks
+        self.wall = 0.0 ## seconds spent in map/imap calls
+
+    def map(self,func,items):
+        ''' Apply func to each item in the workers
+        :param function func: the function , picklable with dill
+        :param iterable items: the arguments
+        :rtype list
+        '''
+        start = time.time()
+        results = self.pool.map(timed_call,[(func,item) for item in items])
+        self.calls += 1
+        self.tasks += len(results)
+        self.busy += sum(seconds for seconds,result in results)
+        self.wall += time.time() - start
+        return [result for seconds,result in results]
+
+    def imap(self,func,items):
+        ''' Apply func to each item in the workers , the results are yielded in order
+        as they are ready
+        :param function func: the function , picklable with dill
+        :param iterable items: the arguments
+        :yields the result for each item
+        '''
+        start = time.time()
+        try:
+            for seconds,result in self.pool.imap(timed_call,((func,item) for item in items)):
+                self.tasks += 1
+                self.busy += seconds
+                yield result
+        finally:
+            self.calls += 1
+            self.wall += time.time() - start
+
+    def close(self):
+        ''' Wait for the workers to finish and stop them
+        '''
+        if self.closed is None:
+            self.pool.close()
+            self.pool.join()
+            self.closed = time.time()
+
+    def summary(self):
+        ''' Usage of the pool so far
+        :returns a line with the number of calls and tasks , the utilisation of the workers
+                 over the lifetime of the pool and during the calls , and the idle worker seconds
+        :rtype str
+        '''
+        lifetime = (self.closed or time.time()) - self.created
+        capacity = self.cores*lifetime
+        return ("Pool {name} : {cores} workers , {calls} calls , {tasks} tasks , busy {busy:.1f} s ; "
+                "utilisation {u:.1%} over {life:.1f} s , {uc:.1%} during calls ; idle {idle:.1f} worker s").format(
+                    name=self.name,cores=self.cores,calls=self.calls,tasks=self.tasks,busy=self.busy,
+                    u=self.busy/capacity if capacity else 0.0,life=lifetime,
+                    uc=self.busy/(self.cores*self.wall) if self.wall else 0.0,
+                    idle=max(0.0,capacity-self.busy))
+
+def get_pool(name,cores,initializer=None,initargs=(),key=None):
+    ''' The pool of this process with this name , created on first use
+    :param str name: the name of the pool
+    :param int cores: the number of worker processes
+    :param function initializer: run once in each worker process with initargs
+    :param tuple initargs: the arguments of initializer
+    :param object key: identifies the state set up by initializer , a pool with
+                       another key or number of cores is replaced
+    :rtype WorkerPool
+    '''
+    pool = POOLS.get(name)
+    if pool is not None and (pool.pid != os.getpid() or pool.closed or (pool.cores,pool.key) != (cores,key)):
+        if pool.pid == os.getpid():
+            pool.close()
+        pool = None
+    if pool is None:
+        pool = POOLS[name] = WorkerPool(name,cores,initializer,initargs,key)
+    return pool
+
+def log_pools(logger):
+    ''' Log the usage of the pools of this process
+    :param object logger: the logger
+    '''
+    for name in sorted(POOLS):
+        if POOLS[name].pid == os.getpid():
+            logger.info(POOLS[name].summary())
+
+def shutdown():
+    ''' Close the pools of this process
+    '''
+    for name,pool in POOLS.items():
+        if pool.pid == os.getpid():
+            pool.close()
+        del POOLS[name]
+
+def end_task(logger):
+    ''' At the end of a luigi task , in the process which ran it , log the usage of
+    the pools of this process. The pools are closed if the process was forked for
+    the task (luigi --workers > 1) , they are kept for the next task otherwise
+    :param object logger: the logger
+    '''
+    log_pools(logger)
+    if current_process().name != 'MainProcess':
+        shutdown()
+
+atexit.register(shutdown)
@@ -0,0 +1,219 @@
+'''
+I/O helpers for demultiplex_cells :
+1. Parallel decompression of the input fastqs through a pigz subprocess
+2. Compression of the per cell output blocks as gzip members or BGZF blocks,
+   done in the worker processes so that compression scales with the number of cpus
+3. Throughput accounting for each stream
+4. The header of the unaligned per sample BAM written when demultiplexing to BAM
+5. The cell index file , and the paths of the per cell outputs
+'''
+
+import collections
+import gzip
+import os
+import struct
+import subprocess
+import time
+import zlib
+from distutils.spawn import find_executable
+
+COMPRESSION_TYPES = ["none","gzip","bgzf"]
+OUTPUT_TYPES = ["fastq","bam"]
+# the max uncompressed payload of a BGZF block, same as htslib
+BGZF_BLOCK_SIZE = 0xff00
+# empty BGZF block marking the end of file
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+BGZF_LEVEL = 6
+GZIP_LEVEL = 1
+
+class ThroughputFile(object):
+    ''' Wrap a file handle and keep track of the bytes transferred and
+    the time spent doing so
+    '''
+    def __init__(self,fh,name,proc=None):
+        ''' Class constructor
+        :param file_handle fh: the file handle to wrap
+        :param str name: name of the stream used when logging
+        :param object proc: subprocess feeding fh , if any
+        '''
+        self.fh = fh
+        self.name = name
+        self.proc = proc
+        self.nbytes = 0
+        self.seconds = 0.0
+
+    def readinto(self,b):
+        start = time.time()
+        n = self.fh.readinto(b)
+        self.seconds += time.time() - start
+        self.nbytes += n
+        return n
+
+    def write(self,data):
+        start = time.time()
+        self.fh.write(data)
+        self.seconds += time.time() - start
+        self.nbytes += len(data)
+
+    def close(self):
+        self.fh.close()
+        if self.proc is not None:
+            self.proc.wait()
+            if self.proc.returncode:
+                raise subprocess.CalledProcessError(self.proc.returncode,"decompression of {}".format(self.name))
+
+    def summary(self):
+        ''' Return a printable throughput summary for this stream
+        '''
+        return summarize_throughput(self.name,self.nbytes,self.seconds)
+
+def summarize_throughput(name,nbytes,seconds):
+    ''' Helper function to format a throughput log line
+    :param str name: the stream name
+    :param int nbytes: bytes transferred
+    :param float seconds: time spent
+    :rtype str
+    '''
+    mb = nbytes/float(1024**2)
+    rate = mb/seconds if seconds > 0 else 0.0
+    return "{name} : {mb:.1f} MB in {s:.1f} s ({rate:.1f} MB/s)".format(name=name,mb=mb,s=seconds,rate=rate)
+
+def open_reader(fname,threads=0,logger=None):
+    ''' Open a fastq for reading , gzip files are decompressed by pigz
+    with the given number of threads if available , otherwise with the gzip module
+    :param str fname: the fastq file
+    :param int threads: pigz threads to use , 0 for the gzip module
+    :param object logger: the logger
+    :returns a ThroughputFile supporting readinto
+    '''
+    if not fname.endswith(".gz"):
+        return ThroughputFile(open(fname,"rb"),fname)
+    pigz = find_executable("pigz") if threads > 0 else None
+    if pigz is None:
+        if threads > 0 and logger:
+            logger.info("pigz not found, using single threaded gzip decompression for {}".format(fname))
+        return ThroughputFile(gzip.open(fname,"rb"),fname)
+    proc = subprocess.Popen([pigz,"-dc","-p",str(threads),fname],stdout=subprocess.PIPE,bufsize=-1)
+    return ThroughputFile(proc.stdout,fname,proc)
+
+def fastq_suffix(compression):
+    ''' Return the file suffix for per cell fastqs
+    :param str compression: none/gzip/bgzf
+    :rtype str
+    '''
+    return ".fastq" if compression == "none" else ".fastq.gz"
+
+def compress_gzip(data,level=GZIP_LEVEL):
+    ''' Compress data as a standalone gzip member ,
+    concatenated members form a valid gzip file
+    :param bytes data: the data to compress
+    :param int level: zlib compression level
+    :rtype bytes
+    '''
+    c = zlib.compressobj(level,zlib.DEFLATED,16+zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+def compress_bgzf(data,level=BGZF_LEVEL):
+    ''' Compress data as a series of BGZF blocks (without the EOF marker)
+    :param bytes data: the data to compress
+    :param int level: zlib compression level
+    :rtype bytes
+    '''
+    blocks = []
+    for start in xrange(0,len(data),BGZF_BLOCK_SIZE):
+        payload = data[start:start+BGZF_BLOCK_SIZE]
+        c = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS)
+        cdata = c.compress(payload) + c.flush()
+        # header(18) + cdata + crc32(4) + isize(4) , BSIZE is the total block size - 1
+        bsize = len(cdata) + 25
+        blocks.append(struct.pack("<4BI2BH2BHH",0x1f,0x8b,8,4,0,0,0xff,6,ord("B"),ord("C"),2,bsize))
+        blocks.append(cdata)
+        blocks.append(struct.pack("<II",zlib.crc32(payload) & 0xffffffff,len(payload)))
+    return b"".join(blocks)
+
+def compress_block(data,compression):
+    ''' Compress an output block with the requested scheme
+    :param bytes data: the data to compress
+    :param str compression: none/gzip/bgzf
+    :rtype bytes
+    '''
+    if compression == "gzip":
+        return compress_gzip(data)
+    elif compression == "bgzf":
+        return compress_bgzf(data)
+    return data
+
+def open_writer(fname):
+    ''' Open a per cell fastq for writing , the blocks written are expected to be
+    already compressed by compress_block
+    :param str fname: the output file
+    :returns a ThroughputFile
+    '''
+    return ThroughputFile(open(fname,"wb"),fname)
+
+def close_writer(fh,compression):
+    ''' Close a per cell fastq , adding the BGZF EOF marker if needed ,
+    cells without any reads still get a valid (empty) gzip file
+    :param ThroughputFile fh: the file handle
+    :param str compression: none/gzip/bgzf
+    '''
+    if compression == "bgzf":
+        fh.write(BGZF_EOF)
+    elif compression == "gzip" and fh.nbytes == 0:
+        fh.write(compress_gzip(b""))
+    fh.close()
+
+def bam_header(sample_name,cell_indices):
+    ''' Return the uncompressed header of an unaligned BAM without references
+    :param str sample_name: the sample name
+    :param dict cell_indices: cell index -> cell number , for the cells used
+    :rtype bytes
+    '''
+    lines = ["@HD\tVN:1.4\tSO:unsorted"]
+    for cell_index,cell_num in cell_indices.items():
+        lines.append("@CO\tCB:{cell_index}\tCell{cell_num}\tSM:{sample}".format(
+            cell_index=cell_index,cell_num=cell_num,sample=sample_name))
+    text = "\n".join(lines) + "\n"
+    return b"BAM\x01" + struct.pack("<i",len(text)) + text + struct.pack("<i",0)
+
+def read_cell_index_file(cell_index_file,cell_indices_used):
+    '''
+    Read the file containing the cell indices and
+    return the cell indices used
+
+    :param str cell_index_file: the cell index file
+    :param str cell_indices_used: comma delimeted cell ids used in the experiment
+    :return: cell index -> cell number , in file order
+    :rtype: OrderedDict
+    :raises: Exception for duplicate cell index
+    '''                
+    d = collections.OrderedDict()
+    i=1
+    used_indices = set(cell_indices_used.split(','))
+    with open(cell_index_file,'r') as IN:
+        for line in IN:
+            key = line.rstrip('\n')
+            if key in d:
+                raise Exception('Duplicate cell index encountered !')
+            if 'C'+str(i) in used_indices or cell_indices_used == 'all':            
+                d[key] = i            
+            i+=1                
+    return d
+        
+def cell_fastq_path(base_dir,cell_num,cell_index,compression="none"):
+    ''' Return the path of the demultiplexed fastq for a cell
+    :param str base_dir: Base output directory
+    :param int cell_num: the cell number
+    :param str cell_index: the cell index oligo
+    :param str compression: none/gzip/bgzf
+    :rtype str
+    '''
+    return os.path.join(base_dir,'Cell'+str(cell_num)+'_'+cell_index,
+                        'cell_'+str(cell_num)+'_R1'+fastq_suffix(compression))
+
+def sample_bam_path(base_dir):
+    ''' Return the path of the unaligned BAM for a sample
+    :param str base_dir: the sample output directory , named after the sample
+    :rtype str
+    '''
+    return os.path.join(base_dir,os.path.basename(os.path.normpath(base_dir))+'.unaligned.bam')
@@ -0,0 +1,277 @@
+'''
+A compact , read-only index of gene intervals for annotating reads in count_umi.
+
+For each chromosome and strand the intervals are kept in NumPy arrays sorted by start :
+1. starts : the 0-based start of each interval
+2. ends   : the end of each interval , exclusive
+3. max_ends : the running maximum of ends , so that all the intervals which can
+              still overlap a position are found with a single binary search
+4. ids    : the position of each interval's gene information in GeneIndex.genes
+
+The gene information tuples are the same as the data of the IntervalTree returned
+by create_annotation_tables.create_gene_tree , i.e.
+(ensembl_id,gene,strand,chrom,five_prime,three_prime)
+
+ids() and iteration follow the order of the rows of the count files (see
+count_order) , so that count_umi writes every cell's counts already sorted.
+
+The index is built once in the main process and inherited by the worker
+processes when the pool forks , instead of being pickled with every map call.
+
+assign_genes annotates a whole chunk of reads at once with the same rules as
+find_gene.find_gene , sweeping the read coordinates against the sorted
+intervals of each chromosome and strand with NumPy instead of querying the
+index read by read.
+'''
+
+import bisect
+import numpy as np
+## Modules from this project
+from count_order import count_row_order
+
+## codes returned by assign_genes for reads without a gene
+UNMAPPED      = -1
+UNKNOWN       = -2 # not annotated , or no gene passing the overlap criteria
+UNKNOWN_CHROM = -3 # on an ERCC but off its loci
+
+class GeneIndex(object):
+    ''' Sorted interval arrays for each chromosome and strand
+    '''
+    def __init__(self,intervals):
+        ''' Class constructor
+        :param list intervals: tuples of (start,end,gene information) , end is exclusive
+        '''
+        self.genes = []
+        by_strand = {}
+        for start,end,info in intervals:
+            chrom = info[3]
+            strand = info[2]
+            by_strand.setdefault((chrom,strand),[]).append((start,end,len(self.genes)))
+            self.genes.append(info)
+
+        ## the 5' and 3' fields of the gene information , for assign_genes
+        self.five_prime = np.array([info[4] for info in self.genes],dtype=np.int64)
+        self.three_prime = np.array([info[5] for info in self.genes],dtype=np.int64)
+        ## the gene ids in count file order
+        self.row_order = count_row_order([tuple(str(field) for field in info) for info in self.genes],True)
+
+        self.arrays = {}
+        for (chrom,strand),entries in by_strand.items():
+            entries.sort()
+            starts = np.array([e[0] for e in entries],dtype=np.int64)
+            ends = np.array([e[1] for e in entries],dtype=np.int64)
+            ids = np.array([e[2] for e in entries],dtype=np.int32)
+            max_ends = np.maximum.accumulate(ends)
+            self.arrays[(chrom,strand)] = (starts,max_ends,ends,ids)
+        self.index_lists()
+
+    def index_lists(self):
+        ''' Plain lists for the binary searches of single reads , bisect on a list
+        is faster than np.searchsorted for a single value
+        '''
+        self.lists = {}
+        self.chroms = set()
+        for (chrom,strand),(starts,max_ends,ends,ids) in self.arrays.items():
+            self.lists[(chrom,strand)] = (starts.tolist(),max_ends.tolist())
+            self.chroms.add(chrom)
+
+    def to_columns(self):
+        ''' The index as flat NumPy columns , which annotation_cache saves
+        :returns column name -> numpy array
+        :rtype dict
+        '''
+        keys = sorted(self.arrays)
+        columns = {}
+        for i,name in enumerate(["ensembl_ids","names","strands","chroms"]):
+            columns[name] = np.array([info[i] for info in self.genes],dtype=np.str_)
+        columns["five_prime"] = self.five_prime
+        columns["three_prime"] = self.three_prime
+        columns["row_order"] = np.array(self.row_order,dtype=np.int32)
+        columns["key_chroms"] = np.array([chrom for chrom,strand in keys],dtype=np.str_)
+        columns["key_strands"] = np.array([strand for chrom,strand in keys],dtype=np.str_)
+        columns["offsets"] = np.cumsum([0]+[len(self.arrays[key][0]) for key in keys]).astype(np.int64)
+        for j,name in enumerate(["starts","max_ends","ends","ids"]):
+            parts = [self.arrays[key][j] for key in keys]
+            columns[name] = np.concatenate(parts) if parts else np.empty(0,dtype=np.int32 if name == "ids" else np.int64)
+        return columns
+
+    @classmethod
+    def from_columns(cls,columns):
+        ''' Rebuild an index from to_columns , e.g. memory mapped from the annotation cache
+        :param dict columns: column name -> numpy array
+        :rtype GeneIndex
+        '''
+        index = cls.__new__(cls)
+        index.five_prime = columns["five_prime"]
+        index.three_prime = columns["three_prime"]
+        index.genes = zip(columns["ensembl_ids"].tolist(),columns["names"].tolist(),
+                          columns["strands"].tolist(),columns["chroms"].tolist(),
+                          index.five_prime.tolist(),index.three_prime.tolist())
+        index.row_order = columns["row_order"].tolist()
+        offsets = columns["offsets"].tolist()
+        index.arrays = {}
+        for i,key in enumerate(zip(columns["key_chroms"].tolist(),columns["key_strands"].tolist())):
+            lo,hi = offsets[i],offsets[i+1]
+            index.arrays[key] = tuple(columns[name][lo:hi] for name in ["starts","max_ends","ends","ids"])
+        index.index_lists()
+        return index
+
+    def __contains__(self,chrom):
+        return chrom in self.chroms
+
+    def __len__(self):
+        return len(self.genes)
+
+    def overlap(self,chrom,strand,begin,end):
+        ''' Return the gene information of the intervals overlapping [begin,end) ,
+        in the order of their start
+        :param str chrom: the chromosome
+        :param str strand: '1' or '-1'
+        :param int begin: the start of the query
+        :param int end: the end of the query , exclusive
+        :rtype list
+        '''
+        key = (chrom,strand)
+        if key not in self.arrays or begin >= end:
+            return []
+        starts,max_ends = self.lists[key]
+        ends,ids = self.arrays[key][2:]
+        hi = bisect.bisect_left(starts,end) # intervals starting before the query end
+        lo = bisect.bisect_right(max_ends,begin) # intervals before lo all end before the query
+        if lo >= hi:
+            return []
+        if hi - lo == 1:
+            return [self.genes[ids[lo]]] if ends[lo] > begin else []
+        hits = ids[lo:hi][ends[lo:hi] > begin]
+        return [self.genes[i] for i in hits]
+
+    def __iter__(self):
+        ''' Iterate over the gene information of all intervals , in count file order
+        '''
+        for i in self.ids():
+            yield self.genes[i]
+
+    def ids(self):
+        ''' Iterate over the gene ids of all intervals , in count file order
+        '''
+        return iter(self.row_order)
+
+def candidate_pairs(arrays,pos,end):
+    ''' All (read , interval) pairs overlapping , for reads on one chromosome and strand
+    :param tuple arrays: GeneIndex.arrays for the chromosome and strand
+    :param numpy array pos: the read starts
+    :param numpy array end: the read ends , exclusive
+    :returns (read of each pair , gene id of each pair) , in the order of the reads and
+             then of the interval starts , as returned by GeneIndex.overlap
+    :rtype tuple of numpy arrays
+    '''
+    starts,max_ends,ends,ids = arrays
+    hi = np.searchsorted(starts,end,side='left')
+    lo = np.searchsorted(max_ends,pos,side='right')
+    counts = np.where(end > pos,np.maximum(hi-lo,0),0)
+    total = counts.sum()
+    reads = np.repeat(np.arange(len(pos)),counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts)-counts,counts)
+    intervals = np.repeat(lo,counts) + offsets
+    keep = ends[intervals] > pos[reads]
+    return (reads[keep],ids[intervals[keep]])
+
+def first_per_read(reads,values,nreads,default):
+    ''' Pick the value of the first pair of each read
+    :param numpy array reads: the read of each pair , sorted
+    :param numpy array values: the value of each pair
+    :param int nreads: number of reads
+    :param int default: the value for reads without any pair
+    :rtype numpy array
+    '''
+    out = np.full(nreads,default,dtype=np.int32)
+    if len(reads) > 0:
+        first = np.ones(len(reads),dtype=bool)
+        first[1:] = reads[1:] != reads[:-1]
+        out[reads[first]] = values[first]
+    return out
+
+def pick_genes(gene_index,pos,end,reads,genes):
+    ''' Choose a gene for each read from its overlapping genes , same rules as find_gene :
+    1. a single hit is always used
+    2. otherwise the first hit overlapping the read by more than 0 bases is the default ,
+       which later hits replace if their 5' end is closer to the read start ,
+       or is as close and they overlap the read less
+    :param GeneIndex gene_index: the gene index
+    :param numpy array pos: the read starts
+    :param numpy array end: the read ends , exclusive
+    :param numpy array reads: the read of each (read , gene) pair , from candidate_pairs
+    :param numpy array genes: the gene id of each pair
+    :returns the gene id for each read , UNKNOWN if none
+    :rtype numpy array
+    '''
+    nreads = len(pos)
+    nhits = np.bincount(reads,minlength=nreads)
+    single = nhits[reads] == 1
+    out = first_per_read(reads[single],genes[single],nreads,UNKNOWN)
+
+    multi = ~single
+    reads = reads[multi]
+    genes = genes[multi]
+    if len(reads) == 0:
+        return out
+    read_pos = pos[reads]
+    read_end = end[reads]
+    five_prime = gene_index.five_prime[genes]
+    three_prime = gene_index.three_prime[genes]
+    gene_start = np.minimum(five_prime,three_prime)
+    gene_end = np.maximum(five_prime,three_prime)
+    overlap = np.maximum(0,np.minimum(read_end,gene_end) - np.maximum(read_pos,gene_start))
+    frac = overlap.astype(np.float64)/(read_end - read_pos)
+    diff = np.abs(five_prime - read_pos)
+    ## hits before the first one with a positive overlap are never picked
+    order = np.arange(len(reads))
+    first_ok = np.full(nreads,len(reads),dtype=np.int64)
+    ok = frac > 0
+    np.minimum.at(first_ok,reads[ok],order[ok])
+    valid = order >= first_ok[reads]
+    ## the smallest (diff , overlap) wins , ties go to the earlier hit
+    reads,genes,diff,frac,order = reads[valid],genes[valid],diff[valid],frac[valid],order[valid]
+    best = np.lexsort((order,frac,diff,reads))
+    picked = first_per_read(reads[best],genes[best],nreads,UNKNOWN)
+    has_multi = nhits > 1
+    out[has_multi] = picked[has_multi]
+    return out
+
+def assign_genes(gene_index,ref_names,tid,pos,end,is_reverse):
+    ''' Annotate a chunk of reads with genes , the vectorised equivalent of
+    calling find_gene on each read
+    :param GeneIndex gene_index: the gene index
+    :param list ref_names: the chromosome name of each tid
+    :param numpy array tid: the chromosome id of each read , -1 if unmapped
+    :param numpy array pos: the 0-based start of each read
+    :param numpy array end: the reference end of each read , exclusive
+    :param numpy array is_reverse: whether each read is on the reverse strand
+    :returns (gene id or UNMAPPED/UNKNOWN/UNKNOWN_CHROM for each read ,
+              whether each read is on an ERCC)
+    :rtype tuple of numpy arrays
+    '''
+    nreads = len(tid)
+    codes = np.full(nreads,UNKNOWN,dtype=np.int32)
+    ercc = np.zeros(nreads,dtype=bool)
+    codes[tid < 0] = UNMAPPED
+    for t in np.unique(tid[tid >= 0]):
+        chrom = ref_names[t]
+        on_chrom = np.flatnonzero(tid == t)
+        if 'ERCC' in chrom: ## strand is not used , the first hit is taken
+            ercc[on_chrom] = True
+            if (chrom,'1') not in gene_index.arrays:
+                codes[on_chrom] = UNKNOWN_CHROM
+                continue
+            reads,genes = candidate_pairs(gene_index.arrays[(chrom,'1')],pos[on_chrom],end[on_chrom])
+            codes[on_chrom] = first_per_read(reads,genes,len(on_chrom),UNKNOWN_CHROM)
+            continue
+        if chrom not in gene_index:
+            continue
+        for strand,reverse in [('1',False),('-1',True)]:
+            sel = on_chrom[is_reverse[on_chrom] == reverse]
+            if len(sel) == 0 or (chrom,strand) not in gene_index.arrays:
+                continue
+            reads,genes = candidate_pairs(gene_index.arrays[(chrom,strand)],pos[sel],end[sel])
+            codes[sel] = pick_genes(gene_index,pos[sel],end[sel],reads,genes)
+    return (codes,ercc)
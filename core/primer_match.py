@@ -0,0 +1,151 @@
+'''
+Approximate matching of the SPE primers to the reads , for targeted UMI counting.
+
+A read matches a primer as the regular expression count_umi used to compile for it :
+    ^(primer){d<=2,i<=2,s<=2,1d+1i+1s<=3}[ACGTN]*$              primer on the + strand
+    ^[ACGTN]*(revcomp primer){d<=2,i<=2,s<=2,1d+1i+1s<=3}$      primer on the - strand
+i.e. the start (or the end) of the read aligns to the primer with at most 3 edits ,
+at most 2 of each kind , and the rest of the read is made of ACGTN only.
+
+A primer on the - strand is matched as a + strand primer on the reversed read ,
+against its reversed reverse complement. Each read is checked with :
+1. an exact prefix match
+2. a seed filter : with at most 3 edits , one of 4 pieces of the primer is found
+   exactly in the read , within 2 bases of its place in the primer
+3. Myers' bit-parallel edit distance of the primer to the prefixes of the read ,
+   for the prefixes long enough to leave only ACGTN after them. A distance of at most
+   2 is a match , more than 3 is not
+4. at a distance of exactly 3 , reached only for the prefix of the primer's length , a
+   banded alignment with an insertion and a deletion , as 3 substitutions do not match
+'''
+
+from Bio.Seq import Seq
+
+MAX_EDITS = 3
+MAX_EDITS_PER_KIND = 2
+READ_BASES = "ACGTN"
+
+class PrimerMatcher(object):
+    ''' The precompiled matcher of a primer
+    '''
+    __slots__ = ['target','at_end','length','peq','full','seeds']
+
+    def __init__(self,seq,at_end):
+        ''' Class constructor
+        :param str seq: the primer sequence , as in the primer file
+        :param bool at_end: True for a primer on the - strand , whose reverse complement ends the read
+        '''
+        self.at_end = at_end
+        self.target = str(Seq(seq).reverse_complement())[::-1] if at_end else seq
+        self.length = len(self.target)
+        ## the positions of each base in the primer , as bits
+        self.peq = {}
+        for i,base in enumerate(self.target):
+            self.peq[base] = self.peq.get(base,0) | (1 << i)
+        self.full = (1 << self.length) - 1
+        ## MAX_EDITS + 1 non overlapping seeds , (start , seed)
+        self.seeds = []
+        if self.length > MAX_EDITS:
+            bounds = [self.length*i//(MAX_EDITS+1) for i in xrange(MAX_EDITS+2)]
+            self.seeds = [(start,self.target[start:stop]) for start,stop in zip(bounds,bounds[1:])]
+
+    def match(self,read):
+        ''' Whether the read matches the primer
+        :param str read: the read sequence
+        :rtype bool
+        '''
+        text = read[::-1] if self.at_end else read
+        m = self.length
+        ## the read after the primer must be ACGTN only
+        first_end = len(text.rstrip(READ_BASES))
+        if first_end > m + MAX_EDITS_PER_KIND:
+            return False
+        if text.startswith(self.target) and first_end <= m:
+            return True
+        for start,seed in self.seeds:
+            if text.find(seed,max(0,start-MAX_EDITS_PER_KIND),start+len(seed)+MAX_EDITS_PER_KIND) >= 0:
+                break
+        else:
+            if self.seeds:
+                return False
+        ## the prefixes of the read the primer can align to
+        first_end = max(first_end,m - MAX_EDITS_PER_KIND)
+        last_end = min(len(text),m + MAX_EDITS_PER_KIND)
+        if first_end > last_end:
+            return False
+        scores = self.distances(text,last_end)
+        best = min(scores[first_end:last_end+1])
+        if best < MAX_EDITS:
+            return True
+        if best > MAX_EDITS:
+            return False
+        ## 3 edits of a kind other than substitutions change the length by 3 , out of range
+        if any(scores[k] <= MAX_EDITS for k in xrange(first_end,last_end+1) if k != m):
+            return True
+        return self.match_with_indels(text)
+
+    def distances(self,text,last_end):
+        ''' Edit distance of the whole primer to each prefix of the read , Myers' algorithm
+        with the alignment anchored at the start of the read
+        :param str text: the read , reversed for a primer on the - strand
+        :param int last_end: the longest prefix
+        :returns the distance to text[:k] for k in 0..last_end
+        :rtype list
+        '''
+        m = self.length
+        full = self.full
+        high = 1 << (m - 1)
+        vp,vn = full,0
+        score = m
+        scores = [score]
+        for c in text[:last_end]:
+            eq = self.peq.get(c,0)
+            xv = eq | vn
+            xh = (((eq & vp) + vp) ^ vp) | eq
+            ph = vn | (~(xh | vp) & full)
+            mh = vp & xh
+            if ph & high:
+                score += 1
+            elif mh & high:
+                score -= 1
+            ph = ((ph << 1) | 1) & full ## the first row counts the read bases skipped , as insertions
+            mh = (mh << 1) & full
+            vp = mh | (~(xv | ph) & full)
+            vn = ph & xv
+            scores.append(score)
+        return scores
+
+    def match_with_indels(self,text):
+        ''' Whether the primer aligns to text[:length] with a deletion , an insertion and
+        a substitution , i.e. with 3 edits not all substitutions. Such alignments stay
+        within one base of the diagonal
+        :param str text: the read , reversed for a primer on the - strand
+        :rtype bool
+        '''
+        m = self.length
+        inf = MAX_EDITS + 1
+        ## (cost of the best alignment , cost of the best alignment with an indel) for
+        ## prefix lengths i-1 , i , i+1 of the read on row i
+        row = [(inf,inf),(0,inf),(1,1)]
+        for i in xrange(1,m+1):
+            base = self.target[i-1]
+            new_row = []
+            for offset in (-1,0,1):
+                j = i + offset
+                if j < 0 or j > m + 1 or j > len(text):
+                    new_row.append((inf,inf))
+                    continue
+                best,best_indel = inf,inf
+                if j > 0: ## read base j-1 against primer base i-1
+                    cost = 0 if text[j-1] == base else 1
+                    any_cost,indel_cost = row[offset+1]
+                    best,best_indel = any_cost + cost,indel_cost + cost
+                if offset < 1: ## primer base deleted
+                    any_cost,indel_cost = row[offset+2]
+                    best,best_indel = min(best,any_cost+1),min(best_indel,any_cost+1)
+                if offset > -1 and j > 0: ## read base inserted
+                    any_cost,indel_cost = new_row[offset]
+                    best,best_indel = min(best,any_cost+1),min(best_indel,any_cost+1)
+                new_row.append((min(best,inf),min(best_indel,inf)))
+            row = new_row
+        return row[1][1] <= MAX_EDITS
@@ -0,0 +1,301 @@
+'''
+Resource profiles of the pipeline tasks and of their stages , written as JSON.
+
+The profile of a luigi task is started and written by the START and SUCCESS event
+handlers of single_cell_rnaseq.py , in the process running the task , see start_task
+and finish_task. Within the task :
+1. with stage(name): ... measures a stage run by this process. A stage entered more
+   than once , e.g. for each chunk of reads , is accumulated. Outside of a task the
+   stage is measured but not recorded
+2. record(name,seconds) records a stage timed elsewhere , e.g. the reading and writing
+   threads or the workers of demultiplex_cells
+
+Each stage and task records :
+    wall_s , cpu_s            wall time , CPU time (user + system) of this process
+    children_cpu_s            CPU time of the child processes which exited meanwhile (STAR ,
+                              Rscript , pigz). The pool workers live across tasks , their busy
+                              time is recorded under pools
+    peak_rss_mb               peak resident memory of this process since the task started
+    children_peak_rss_mb      the largest child process which exited so far
+    bytes_read , bytes_written                   bytes read and written by this process , through
+                                                 files and pipes
+    children_bytes_read , children_bytes_written block I/O of the exited child processes
+and the counts given to stage or record , such as the number of reads.
+
+The profiles of all the tasks of a run are gathered in a run profile by write_run_profile.
+'''
+
+import datetime
+import glob
+import json
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+
+PROFILE_SUFFIX = '.profile.json'
+IO_FILE = '/proc/self/io'
+STATUS_FILE = '/proc/self/status'
+CLEAR_REFS_FILE = '/proc/self/clear_refs'
+BLOCK_BYTES = 512
+## The usage fields summed over the stages and the tasks
+SUMMED = ['wall_s','cpu_s','children_cpu_s','bytes_read','bytes_written','children_bytes_read','children_bytes_written']
+## The usage fields maximised
+PEAKS = ['peak_rss_mb','children_peak_rss_mb']
+
+## The profile of the task run by this process , see start_task
+PROFILE = None
+
+def read_proc_io():
+    ''' The bytes read and written by this process so far , 0 without /proc
+    :returns (bytes read , bytes written)
+    :rtype tuple
+    '''
+    try:
+        with open(IO_FILE) as IN:
+            fields = dict(line.split(':',1) for line in IN)
+        return (int(fields['rchar']),int(fields['wchar']))
+    except (IOError,KeyError,ValueError):
+        return (0,0)
+
+def peak_rss_kb():
+    ''' The peak resident memory of this process in kB , since it started or
+    since the last reset_peak_rss
+    :rtype int
+    '''
+    try:
+        with open(STATUS_FILE) as IN:
+            for line in IN:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_peak_rss():
+    ''' Reset the peak resident memory of this process to the current one , so that
+    a task run after another by this process reports its own peak. Linux only ,
+    without it the peak of the process is reported
+    '''
+    try:
+        with open(CLEAR_REFS_FILE,'w') as OUT:
+            OUT.write('5')
+    except IOError:
+        pass
+
+def usage():
+    ''' A snapshot of the resources used so far by this process and its exited children
+    :rtype dict
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    bytes_read,bytes_written = read_proc_io()
+    return {'time':time.time(),
+            'cpu':own.ru_utime + own.ru_stime,
+            'children_cpu':children.ru_utime + children.ru_stime,
+            'bytes_read':bytes_read,
+            'bytes_written':bytes_written,
+            'children_bytes_read':children.ru_inblock*BLOCK_BYTES,
+            'children_bytes_written':children.ru_oublock*BLOCK_BYTES,
+            'children_peak_rss_kb':children.ru_maxrss}
+
+def usage_delta(start,end):
+    ''' The resources used between two snapshots
+    :param dict start: the usage() at the start
+    :param dict end: the usage() at the end
+    :rtype OrderedDict
+    '''
+    return OrderedDict([
+        ('wall_s',round(end['time'] - start['time'],3)),
+        ('cpu_s',round(end['cpu'] - start['cpu'],3)),
+        ('children_cpu_s',round(end['children_cpu'] - start['children_cpu'],3)),
+        ('peak_rss_mb',round(peak_rss_kb()/1024.0,1)),
+        ('children_peak_rss_mb',round(end['children_peak_rss_kb']/1024.0,1)),
+        ('bytes_read',end['bytes_read'] - start['bytes_read']),
+        ('bytes_written',end['bytes_written'] - start['bytes_written']),
+        ('children_bytes_read',end['children_bytes_read'] - start['children_bytes_read']),
+        ('children_bytes_written',end['children_bytes_written'] - start['children_bytes_written'])])
+
+def accumulate(total,fields):
+    ''' Add the usage and the counts of a stage or a task to a total , in place
+    :param OrderedDict total: the total
+    :param dict fields: the usage and counts added
+    '''
+    for key,value in fields.items():
+        if key in PEAKS:
+            total[key] = max(total.get(key,0),value)
+        elif isinstance(value,float):
+            total[key] = round(total.get(key,0) + value,3)
+        elif isinstance(value,(int,long)) and not isinstance(value,bool):
+            total[key] = total.get(key,0) + value
+
+class TaskProfile(object):
+    ''' The usage of a task and of its stages
+    '''
+    def __init__(self,name,params=None):
+        ''' Class constructor
+        :param str name: the task family
+        :param dict params: the task parameters
+        '''
+        self.name = name
+        self.params = params or {}
+        self.pid = os.getpid()
+        self.stages = OrderedDict()
+        self.pools = pool_usage()
+        reset_peak_rss()
+        self.start = usage()
+
+    def add(self,name,fields):
+        ''' Add the usage and counts of a stage
+        :param str name: the stage name
+        :param dict fields: the usage and counts
+        '''
+        total = self.stages.setdefault(name,OrderedDict([('calls',0)]))
+        total['calls'] += 1
+        accumulate(total,fields)
+
+    def as_dict(self):
+        ''' The profile of the task so far
+        :rtype OrderedDict
+        '''
+        profile = OrderedDict([('task',self.name),('params',self.params),('pid',self.pid),
+                               ('started',datetime.datetime.fromtimestamp(self.start['time']).isoformat()),
+                               ('start',round(self.start['time'],3))])
+        profile.update(usage_delta(self.start,usage()))
+        profile['stages'] = self.stages
+        ## the work of the pools of this process during the task
+        pools = OrderedDict()
+        for name,(cores,calls,tasks,busy,wall) in sorted(pool_usage().items()):
+            calls0,tasks0,busy0,wall0 = self.pools.get(name,(cores,0,0,0.0,0.0))[1:]
+            if calls < calls0: ## the pool was replaced during the task
+                calls0,tasks0,busy0,wall0 = 0,0,0.0,0.0
+            if calls > calls0:
+                pools[name] = OrderedDict([('cores',cores),('calls',calls-calls0),('tasks',tasks-tasks0),
+                                           ('busy_s',round(busy-busy0,3)),('wall_s',round(wall-wall0,3))])
+        profile['pools'] = pools
+        return profile
+
+class StageTimer(object):
+    ''' Measure a stage of the task run by this process , see stage
+    '''
+    def __init__(self,name,**counts):
+        ''' Class constructor
+        :param str name: the stage name
+        :param counts: counts recorded with the stage , e.g. reads=1000
+        '''
+        self.name = name
+        self.counts = counts
+        self.wall = 0.0
+
+    def __enter__(self):
+        self.start = usage()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        fields = usage_delta(self.start,usage())
+        self.wall = fields['wall_s']
+        if PROFILE is not None and PROFILE.pid == os.getpid():
+            fields.update(sorted(self.counts.items()))
+            PROFILE.add(self.name,fields)
+        return False
+
+def stage(name,**counts):
+    ''' Measure a stage of the task run by this process
+        with stage("UMI collapse",cells=n) as timer:
+            ...
+        logger.info("... in {:.1f} s".format(timer.wall))
+    :param str name: the stage name
+    :param counts: counts recorded with the stage , e.g. reads=1000
+    :rtype StageTimer
+    '''
+    return StageTimer(name,**counts)
+
+def record(name,seconds,**counts):
+    ''' Record a stage timed elsewhere , by other threads or processes , in the profile
+    of the task run by this process
+    :param str name: the stage name
+    :param float seconds: the time spent on the stage
+    :param counts: counts recorded with the stage , e.g. data_bytes=1024
+    '''
+    if PROFILE is not None and PROFILE.pid == os.getpid():
+        fields = OrderedDict([('wall_s',round(seconds,3))])
+        fields.update(sorted(counts.items()))
+        PROFILE.add(name,fields)
+
+def pool_usage():
+    ''' The work done so far by the worker pools of this process , see executor
+    :returns pool name -> (cores , calls , tasks , busy seconds , seconds in calls)
+    :rtype dict
+    '''
+    executor = sys.modules.get('executor') ## no pools unless the stages imported it
+    if executor is None:
+        return {}
+    return dict((name,(pool.cores,pool.calls,pool.tasks,pool.busy,pool.wall))
+                for name,pool in executor.POOLS.items() if pool.pid == os.getpid())
+
+def start_task(name,params=None):
+    ''' Start the profile of the task run by this process
+    :param str name: the task family
+    :param dict params: the task parameters
+    '''
+    global PROFILE
+    PROFILE = TaskProfile(name,params)
+
+def finish_task(profile_file):
+    ''' Write the profile of the task run by this process
+    :param str profile_file: the output JSON file
+    '''
+    global PROFILE
+    if PROFILE is None or PROFILE.pid != os.getpid():
+        return
+    with open(profile_file,'w') as OUT:
+        json.dump(PROFILE.as_dict(),OUT,indent=1)
+    PROFILE = None
+
+def profile_file(verification_file):
+    ''' The profile of a task , next to its verification file
+    :param str verification_file: the verification file of the task
+    :rtype str
+    '''
+    return verification_file.replace('.verification.txt',PROFILE_SUFFIX)
+
+def write_run_profile(run_dir,outfile,settings=None):
+    ''' Gather the profiles of the tasks of a run
+    :param str run_dir: the run directory
+    :param str outfile: the output JSON file
+    :param dict settings: the pipeline settings to keep with the profile , e.g. num_cores
+    :returns the run profile
+    :rtype OrderedDict
+    '''
+    files = []
+    for pattern in ['targets','primary_analysis/targets','primary_analysis/*/targets']:
+        files.extend(glob.glob(os.path.join(run_dir,pattern,'*'+PROFILE_SUFFIX)))
+    tasks = []
+    for task_file in files:
+        with open(task_file) as IN:
+            tasks.append(json.load(IN,object_pairs_hook=OrderedDict))
+    tasks.sort(key=lambda task:task['start'])
+    ## totals for each task family and each stage , over the run
+    families = OrderedDict()
+    stages = OrderedDict()
+    for task in tasks:
+        total = families.setdefault(task['task'],OrderedDict([('tasks',0)]))
+        total['tasks'] += 1
+        accumulate(total,OrderedDict((key,task[key]) for key in SUMMED+PEAKS))
+        for name,fields in task['stages'].items():
+            accumulate(stages.setdefault(name,OrderedDict()),fields)
+    if tasks:
+        wall = max(task['start'] + task['wall_s'] for task in tasks) - tasks[0]['start']
+    else:
+        wall = 0.0
+    profile = OrderedDict([('run',os.path.basename(os.path.normpath(run_dir))),
+                           ('written',datetime.datetime.now().isoformat()),
+                           ('wall_s',round(wall,3)),
+                           ('settings',settings or {}),
+                           ('task_families',families),
+                           ('stages',stages),
+                           ('tasks',tasks)])
+    with open(outfile,'w') as OUT:
+        json.dump(profile,OUT,indent=1)
+    return profile
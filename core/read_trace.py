@@ -0,0 +1,83 @@
+'''
+Sampled per read traces of the read annotation (find_primer , find_gene) , replacing
+the logger.info call made for each read. By default nothing is traced and only the
+counts of each outcome are logged by count_umi. A trace spec turns tracing on :
+
+    all                   : every read
+    every=1000            : about 1 read in 1000 , picked by a hash of the read id ,
+                            so the same reads are picked in every process and run
+    reads=id1,id2         : these reads
+    names=KRAS,ACGTACGT   : the reads annotated to these genes (id or name) or primers
+    every=1000;names=KRAS : any of the above
+
+The traces are buffered by each worker and appended to the log file in one write
+per slice of reads , see ReadTracer.flush.
+'''
+
+import zlib
+
+def parse_trace_spec(spec):
+    ''' The tracer for a trace spec
+    :param str spec: the trace spec , empty or None for no tracing
+    :returns the tracer , None when not tracing
+    :rtype ReadTracer
+    '''
+    if not spec:
+        return None
+    every,reads,names = 0,(),()
+    for field in spec.split(';'):
+        field = field.strip()
+        if field == 'all':
+            every = 1
+            continue
+        key,sep,value = field.partition('=')
+        if key == 'every':
+            every = int(value)
+        elif key == 'reads':
+            reads = value.split(',')
+        elif key == 'names':
+            names = value.split(',')
+        else:
+            raise ValueError("Unknown read trace field : {}".format(field))
+    return ReadTracer(every,reads,names)
+
+class ReadTracer(object):
+    ''' Pick the reads to trace and buffer their traces
+    '''
+    def __init__(self,every=0,reads=(),names=()):
+        ''' Class constructor
+        :param int every: trace about 1 read in every , 0 for none
+        :param list reads: the ids of the reads to trace
+        :param list names: the genes (id or name) or primers whose reads are traced
+        '''
+        self.every = every
+        self.reads = frozenset(reads)
+        self.names = frozenset(names)
+        self.lines = []
+
+    def wants(self,read_id,names=()):
+        ''' Whether to trace a read
+        :param str read_id: the read id
+        :param tuple names: the genes or primers the read is annotated to
+        :rtype bool
+        '''
+        if self.every == 1 or read_id in self.reads:
+            return True
+        if self.names and not self.names.isdisjoint(names):
+            return True
+        return self.every > 1 and (zlib.crc32(read_id) & 0xffffffff) % self.every == 0
+
+    def add(self,line):
+        ''' Buffer the trace of a read
+        :param str line: the trace , without newline
+        '''
+        self.lines.append(line)
+
+    def flush(self,logfile):
+        ''' Append the buffered traces to the log file
+        :param str logfile: the log file
+        '''
+        if self.lines:
+            with open(logfile,'a') as OUT:
+                OUT.write('\n'.join(self.lines)+'\n')
+            self.lines = []
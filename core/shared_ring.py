@@ -0,0 +1,194 @@
+'''
+A ring of chunk buffers in shared memory for demultiplex_cells.
+
+The ring is a single file in /dev/shm mapped by the main process and
+by each worker. Every slot of the ring holds :
+1. the R1 chunk
+2. the R2 chunk
+3. an output arena the worker fills with the (compressed) fastq records
+   for each cell
+
+The main process reads the input fastqs straight into a free slot and
+only the slot number and the chunk lengths are sent to the worker. The
+worker sends back the offset and length of each cell's records in the
+arena, which the main process writes out without copying. A slot is
+released once its records have been written.
+'''
+
+import mmap
+import os
+import tempfile
+import Queue
+import numpy as np
+
+try:
+    from _utils import two_fastq_heads_view
+except ImportError: ## _utils not built with setup.py build_ext , compile it on import (development)
+    import pyximport
+    pyximport.install(reload_support=True)
+    from _utils import two_fastq_heads_view
+
+SHM_DIR = "/dev/shm"
+
+class SharedRing(object):
+    ''' Fixed size slots in a shared memory mapped file
+    '''
+    def __init__(self,nslots,input_size,arena_size,path=None):
+        ''' Class constructor , create the ring or attach to an existing one
+        :param int nslots: number of slots
+        :param int input_size: size in bytes of the R1 and R2 regions of a slot
+        :param int arena_size: size in bytes of the output region of a slot
+        :param str path: the file backing an existing ring , None to create a new one
+        '''
+        self.nslots = nslots
+        self.input_size = input_size
+        self.arena_size = arena_size
+        self.slot_size = 2*input_size + arena_size
+        self.owner = path is None
+        size = nslots*self.slot_size
+        if self.owner:
+            shm_dir = SHM_DIR if os.path.isdir(SHM_DIR) else None
+            fd,path = tempfile.mkstemp(prefix="demux_ring.",dir=shm_dir)
+            os.ftruncate(fd,size)
+        else:
+            fd = os.open(path,os.O_RDWR)
+        self.path = path
+        self.mm = mmap.mmap(fd,size)
+        os.close(fd)
+        self.data = np.frombuffer(self.mm,dtype=np.uint8)
+        self.free = Queue.Queue()
+        for slot in range(nslots):
+            self.free.put(slot)
+
+    @property
+    def layout(self):
+        ''' Everything a worker needs to attach to this ring
+        '''
+        return (self.nslots,self.input_size,self.arena_size,self.path)
+
+    def inputs(self,slot):
+        ''' Return the R1 and R2 regions of a slot
+        :param int slot: the slot number
+        :rtype tuple of numpy arrays
+        '''
+        start = slot*self.slot_size
+        return (self.data[start:start+self.input_size],
+                self.data[start+self.input_size:start+2*self.input_size])
+
+    def arena(self,slot):
+        ''' Return the output region of a slot
+        :param int slot: the slot number
+        :rtype numpy array
+        '''
+        start = slot*self.slot_size + 2*self.input_size
+        return self.data[start:start+self.arena_size]
+
+    def acquire(self):
+        ''' Wait for a free slot
+        :rtype int
+        '''
+        return self.free.get()
+
+    def release(self,slot):
+        ''' Return a slot to the ring once its output has been written
+        :param int slot: the slot number
+        '''
+        self.free.put(slot)
+
+    def chunks(self,f,f2,chunk_size=None):
+        ''' Same as demultiplex_cells.iterate_fastq with one chunk at a time ,
+        reading straight into a free slot. The partial record at the end of a
+        chunk is carried over to the next slot
+        :param file_handle f:  R1 fastq
+        :param file_handle f2: R2 fastq
+        :param function chunk_size: returns the size in bytes of the next chunk , at most
+                                    input_size , see chunk_tuning ; None for input_size
+        :yields (slot,R1 chunk length,R2 chunk length)
+        '''
+        carry1 = b''
+        carry2 = b''
+        while True:
+            slot = self.acquire()
+            buf1,buf2 = self.inputs(slot)
+            start1 = len(carry1)
+            start2 = len(carry2)
+            buf1[0:start1] = np.frombuffer(carry1,dtype=np.uint8)
+            buf2[0:start2] = np.frombuffer(carry2,dtype=np.uint8)
+            if carry1 == b'' and carry2 == b'':
+                # Read one byte to make sure we are processing FASTQ
+                start1 = f.readinto(memoryview(buf1)[0:1])
+                start2 = f2.readinto(memoryview(buf2)[0:1])
+                if (start1 == 1 and buf1[0] != ord('@')) or (start2 == 1 and buf2[0] != ord('@')):
+                    raise Exception('Paired-end data must be in FASTQ format when using multiple cores')
+            size = min(chunk_size(),self.input_size) if chunk_size else self.input_size
+            bufend1 = f.readinto(memoryview(buf1)[start1:size]) + start1
+            bufend2 = f2.readinto(memoryview(buf2)[start2:size]) + start2
+            if start1 == bufend1 and start2 == bufend2:
+                break
+
+            end1,end2 = two_fastq_heads_view(buf1,buf2,bufend1,bufend2)
+            carry1 = buf1[end1:bufend1].tobytes()
+            carry2 = buf2[end2:bufend2].tobytes()
+            if end1 > 0 or end2 > 0:
+                yield (slot,end1,end2)
+            else:
+                self.release(slot)
+
+        if start1 > 0 or start2 > 0: # the remaining bytes are already at the start of the slot
+            yield (slot,start1,start2)
+        else:
+            self.release(slot)
+
+    def place_blocks(self,slot,out_blocks):
+        ''' Worker side , copy the per cell blocks of a chunk into the slot's arena
+        :param int slot: the slot number
+        :param dict out_blocks: cell index -> fastq records
+        :returns list of (cell index,offset,length) , None if the blocks do not fit in the arena
+        :rtype list
+        '''
+        if sum(len(block) for block in out_blocks.values()) > self.arena_size:
+            return None
+        arena = self.arena(slot)
+        placements = []
+        offset = 0
+        for cell_index,block in out_blocks.items():
+            arena[offset:offset+len(block)] = np.frombuffer(block,dtype=np.uint8)
+            placements.append((cell_index,offset,len(block)))
+            offset += len(block)
+        return placements
+
+    def out_blocks(self,slot,placements):
+        ''' Main process side , views of the per cell blocks in the slot's arena
+        :param int slot: the slot number
+        :param list placements: as returned by place_blocks
+        :returns cell index -> numpy array , valid until the slot is released
+        :rtype dict
+        '''
+        arena = self.arena(slot)
+        return dict((cell_index,arena[offset:offset+length]) for cell_index,offset,length in placements)
+
+    def close(self):
+        ''' Unmap the ring , the owner also removes the backing file
+        '''
+        self.data = None
+        self.mm.close()
+        if self.owner:
+            os.unlink(self.path)
+
+## Rings attached by this (worker) process , path -> SharedRing
+_ATTACHED = {}
+
+def attach(layout):
+    ''' Attach to a ring created by another process , once per process. A ring only
+    lives for the demux call which created it , the workers of the pool are reused
+    by the next demux call , hence the rings of the earlier calls are unmapped here ,
+    or their memory is held until the worker exits although the owner unlinked them
+    :param tuple layout: SharedRing.layout
+    :rtype SharedRing
+    '''
+    nslots,input_size,arena_size,path = layout
+    for stale in [other for other in _ATTACHED if other != path]:
+        _ATTACHED.pop(stale).close()
+    if path not in _ATTACHED:
+        _ATTACHED[path] = SharedRing(nslots,input_size,arena_size,path)
+    return _ATTACHED[path]
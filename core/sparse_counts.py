@@ -0,0 +1,134 @@
+'''
+Sparse output of the combined UMI counts , in the Matrix Market coordinate
+format read by R's Matrix::readMM , with the annotation of the rows and the
+names of the columns in two tab separated side files :
+
+    <prefix>.mtx          : the non zero counts , a row (gene/primer) at a time
+    <prefix>.features.txt : the annotation of each row , with a header line
+    <prefix>.cells.txt    : the sample_cell name of each column , one per line
+
+where <prefix> is the dense count file path without its .txt extension.
+The dense tab separated file , with a column per cell , can be exported from
+the sparse files with export_dense.
+'''
+
+import os
+
+MTX_HEADER = "%%MatrixMarket matrix coordinate integer general"
+## Annotation columns of the features file , as used by the secondary analysis R code
+FEATURE_COLUMNS_GENE = ["gene_id","gene","strand","chrom","loc_5prime_grch38","loc_3prime_grch38"]
+FEATURE_COLUMNS_PRIMER = FEATURE_COLUMNS_GENE + ["primer_seq"]
+## Header of the dense count files
+DENSE_HEADER_GENE = "gene id\tgene\tstrand\tchrom\tloc 5'\tloc 3'\t{cells}\n"
+DENSE_HEADER_PRIMER = "gene id\tgene\tstrand\tchrom\tloc 5'\tloc 3'\tprimer seq\t{cells}\n"
+
+def sparse_files(count_file):
+    ''' The sparse files for a dense count file path
+    :param str count_file: the path of the dense count file
+    :returns (matrix file , features file , cells file)
+    :rtype tuple
+    '''
+    prefix = os.path.splitext(count_file)[0]
+    return (prefix+'.mtx',prefix+'.features.txt',prefix+'.cells.txt')
+
+## Room left on the size line of a matrix written row by row , filled in once all rows are known
+SIZE_LINE_WIDTH = 40
+
+class MatrixMarketWriter(object):
+    ''' Write the sparse counts of a combined count file a row at a time , so that
+    the counts are never all held in memory. The entries are ordered by row , and the
+    size line , unknown until the last row , is padded and rewritten on close
+    '''
+    def __init__(self,count_file,cells,wts):
+        ''' Class constructor
+        :param str count_file: the path of the dense count file , see sparse_files
+        :param list cells: the name of each column , in output order
+        :param bool wts: whether the rows are genes (True) or primers (False)
+        '''
+        mtx_file,features_file,cells_file = sparse_files(count_file)
+        with open(cells_file,'w') as OUT:
+            for cell in cells:
+                OUT.write(cell+'\n')
+        self.ncells = len(cells)
+        self.rows = 0
+        self.nonzero = 0
+        self.features = open(features_file,'w')
+        self.features.write('\t'.join(FEATURE_COLUMNS_GENE if wts else FEATURE_COLUMNS_PRIMER)+'\n')
+        self.mtx = open(mtx_file,'w')
+        self.mtx.write(MTX_HEADER+'\n')
+        self.size_offset = self.mtx.tell()
+        self.mtx.write(' '*SIZE_LINE_WIDTH+'\n')
+
+    def add_row(self,annotation,counts):
+        ''' Add a row
+        :param str annotation: the tab separated annotation of the row
+        :param list counts: the count of each column , as int
+        '''
+        self.rows+=1
+        self.features.write(annotation+'\n')
+        for j,count in enumerate(counts):
+            if count:
+                self.nonzero+=1
+                self.mtx.write('{i} {j} {v}\n'.format(i=self.rows,j=j+1,v=count))
+
+    def close(self):
+        ''' Write the size line and close the files
+        '''
+        self.features.close()
+        self.mtx.seek(self.size_offset)
+        self.mtx.write('{rows} {cols} {nnz}'.format(rows=self.rows,cols=self.ncells,nnz=self.nonzero).ljust(SIZE_LINE_WIDTH))
+        self.mtx.close()
+
+def read_matrix_market(count_file):
+    ''' Read the sparse counts written by MatrixMarketWriter
+    :param str count_file: the path of the dense count file , or of the .mtx file
+    :returns (annotation tuple of each row , name of each column ,
+              list of (row , column , count) for the non zero counts , 0-based)
+    :rtype tuple
+    '''
+    if count_file.endswith('.mtx'):
+        count_file = count_file[:-4]+'.txt'
+    mtx_file,features_file,cells_file = sparse_files(count_file)
+    with open(features_file,'r') as IN:
+        IN.readline() ## Header
+        features = [tuple(line.rstrip('\n').split('\t')) for line in IN]
+    with open(cells_file,'r') as IN:
+        cells = [line.rstrip('\n') for line in IN]
+    entries = []
+    with open(mtx_file,'r') as IN:
+        for line in IN:
+            if line.startswith('%'):
+                continue
+            nrows,ncols,nnz = line.split()
+            break
+        for line in IN:
+            i,j,v = line.split()
+            entries.append((int(i)-1,int(j)-1,int(v)))
+    assert (int(nrows),int(ncols),int(nnz)) == (len(features),len(cells),len(entries)),\
+        "Inconsistent sparse count files for {}".format(mtx_file)
+    return (features,cells,entries)
+
+def write_dense(count_file,features,cells,counts,wts):
+    ''' Write a dense count file , a row per gene/primer and a column per cell
+    :param str count_file: the output file
+    :param list features: the annotation tuple of each row , in output order
+    :param list cells: the name of each column , in output order
+    :param list counts: for each row , a dict of cell -> non zero count
+    :param bool wts: whether the rows are genes (True) or primers (False)
+    '''
+    header = DENSE_HEADER_GENE if wts else DENSE_HEADER_PRIMER
+    with open(count_file,'w') as OUT:
+        OUT.write(header.format(cells='\t'.join(cells)))
+        for feature,row in zip(features,counts):
+            OUT.write('\t'.join(feature)+'\t'+'\t'.join(str(row.get(cell,0)) for cell in cells)+'\n')
+
+def export_dense(count_file,wts):
+    ''' Write the dense count file from the sparse files written by MatrixMarketWriter
+    :param str count_file: the path of the dense count file to write
+    :param bool wts: whether the rows are genes (True) or primers (False)
+    '''
+    features,cells,entries = read_matrix_market(count_file)
+    counts = [{} for feature in features]
+    for row,col,count in entries:
+        counts[row][cells[col]] = count
+    write_dense(count_file,features,cells,counts,wts)
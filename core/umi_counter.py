@@ -0,0 +1,167 @@
+'''
+A compact counter of the reads of each (cell , gene , UMI) , used by count_umi
+instead of nested dicts keyed by gene tuples and UMI strings.
+
+The counter is four parallel NumPy columns , sorted by cell , gene and UMI ,
+with a row per distinct molecule :
+1. cells : the cell id , an index into the cell names of the bam being counted
+2. genes : the gene id , an index into GeneIndex.genes
+3. umis  : the UMI packed 2 bits per base below a sentinel bit , as umi_dedup.pack_umi ,
+           or a negative id for a UMI which can not be packed (has an N , or is longer
+           than MAX_UMI_LENGTH) ; those are kept in a small side table
+4. reads : the number of reads of the molecule , used by the UMI collapsing methods
+
+A chunk of reads is packed and sorted with NumPy , then merged into the counter
+by summing the reads of equal rows , so the counter grows with the number of
+molecules and not with the number of reads. Two counters (e.g. from different
+chunks or processes) are merged the same way. When the cell , gene and UMI fit
+together in 63 bits the rows are sorted on a single int64 key , which is several
+times faster than sorting on the three columns.
+'''
+
+import numpy as np
+## Modules from this project
+from umi_dedup import collapse
+
+## The sentinel bit of the longest UMI must fit in an int64
+MAX_UMI_LENGTH = 31
+
+## byte -> 2-bit base code , PAD for the null padding of numpy strings , OTHER for any other byte
+PAD   = 4
+OTHER = 5
+BASE_LUT = np.full(256,OTHER,dtype=np.uint8)
+for i,b in enumerate("ACGT"):
+    BASE_LUT[ord(b)] = i
+BASE_LUT[0] = PAD
+
+def bits(values):
+    ''' Number of bits needed for the largest of non negative values
+    :param numpy array values: the values
+    :rtype int
+    '''
+    return int(values.max()).bit_length() if len(values) else 0
+
+def sort_order(cells,genes,umis,unpacked):
+    ''' The order sorting the rows by cell , gene and UMI
+    :param numpy array cells: the cell id of each row
+    :param numpy array genes: the gene id of each row
+    :param numpy array umis: the packed UMI of each row
+    :param int unpacked: the number of unpacked UMIs , whose negative codes are >= -unpacked
+    :rtype numpy array
+    '''
+    umi_keys = umis + unpacked
+    umi_bits = bits(umi_keys)
+    gene_bits = bits(genes)
+    if bits(cells) + gene_bits + umi_bits > 63:
+        return np.lexsort((umis,genes,cells))
+    keys = (cells.astype(np.int64) << (gene_bits + umi_bits)) | (genes.astype(np.int64) << umi_bits) | umi_keys
+    return np.argsort(keys)
+
+class UmiCounter(object):
+    ''' Read counts of the distinct (cell , gene , UMI)
+    '''
+    def __init__(self):
+        ''' Class constructor , an empty counter
+        '''
+        self.cells = np.empty(0,dtype=np.int32)
+        self.genes = np.empty(0,dtype=np.int32)
+        self.umis = np.empty(0,dtype=np.int64)
+        self.reads = np.empty(0,dtype=np.int32)
+        ## UMI sequence -> negative code , for the UMIs which can not be packed
+        self.unpacked = {}
+
+    def __len__(self):
+        return len(self.umis)
+
+    def pack(self,umis):
+        ''' Pack an array of UMIs
+        :param numpy array umis: the UMI sequences , a numpy string array
+        :rtype numpy array of int64
+        '''
+        width = umis.dtype.itemsize
+        if len(umis) == 0 or width == 0:
+            return np.ones(len(umis),dtype=np.int64)
+        bases = BASE_LUT[np.ascontiguousarray(umis).view(np.uint8).reshape(len(umis),width)]
+        codes = np.ones(len(umis),dtype=np.int64)
+        for j in xrange(min(width,MAX_UMI_LENGTH)):
+            column = bases[:,j]
+            shifted = (codes << 2) | (column & 3)
+            codes = np.where(column != PAD,shifted,codes)
+        bad = (bases == OTHER).any(axis=1)
+        if width > MAX_UMI_LENGTH:
+            bad |= (bases[:,MAX_UMI_LENGTH:] != PAD).any(axis=1)
+        for i in np.flatnonzero(bad).tolist():
+            umi = umis[i]
+            if umi not in self.unpacked:
+                self.unpacked[umi] = -1 - len(self.unpacked)
+            codes[i] = self.unpacked[umi]
+        return codes
+
+    def add(self,cells,genes,umis):
+        ''' Count a read for each (cell , gene , UMI)
+        :param numpy array cells: the cell id of each read
+        :param numpy array genes: the gene id of each read
+        :param numpy array umis: the UMI of each read , a numpy string array
+        '''
+        self.merge(cells.astype(np.int32),genes.astype(np.int32),self.pack(umis),
+                   np.ones(len(umis),dtype=np.int32))
+
+    def update(self,other):
+        ''' Merge the counts of another counter , e.g. from another chunk
+        :param UmiCounter other: the counter to add
+        '''
+        umis = other.umis
+        if other.unpacked:
+            ## the unpacked UMIs are numbered separately in each counter
+            umis = umis.copy()
+            for umi,code in other.unpacked.iteritems():
+                if umi not in self.unpacked:
+                    self.unpacked[umi] = -1 - len(self.unpacked)
+                umis[other.umis == code] = self.unpacked[umi]
+        self.merge(other.cells,other.genes,umis,other.reads)
+
+    def merge(self,cells,genes,umis,reads):
+        ''' Merge rows of packed counts into the counter
+        :param numpy array cells: the cell id of each row
+        :param numpy array genes: the gene id of each row
+        :param numpy array umis: the packed UMI of each row
+        :param numpy array reads: the reads of each row
+        '''
+        cells = np.concatenate((self.cells,cells))
+        genes = np.concatenate((self.genes,genes))
+        umis = np.concatenate((self.umis,umis))
+        reads = np.concatenate((self.reads,reads))
+        if len(umis) == 0:
+            return
+        order = sort_order(cells,genes,umis,len(self.unpacked))
+        cells,genes,umis,reads = cells[order],genes[order],umis[order],reads[order]
+        first = np.ones(len(umis),dtype=bool)
+        first[1:] = (cells[1:] != cells[:-1]) | (genes[1:] != genes[:-1]) | (umis[1:] != umis[:-1])
+        starts = np.flatnonzero(first)
+        self.cells = cells[starts]
+        self.genes = genes[starts]
+        self.umis = umis[starts]
+        self.reads = np.add.reduceat(reads,starts).astype(np.int32)
+
+    def molecules(self,cell,method="unique"):
+        ''' The molecules of each gene of a cell
+        :param int cell: the cell id
+        :param str method: how to collapse UMIs into molecules , see umi_dedup.METHODS
+        :returns gene id -> (molecules , distinct UMIs)
+        :rtype dict
+        '''
+        lo,hi = np.searchsorted(self.cells,[cell,cell+1]).tolist()
+        genes = self.genes[lo:hi]
+        first = np.ones(len(genes),dtype=bool)
+        first[1:] = genes[1:] != genes[:-1]
+        starts = np.flatnonzero(first)
+        bounds = np.append(starts,len(genes)).tolist()
+        gene_ids = genes[starts].tolist()
+        distinct = np.diff(bounds).tolist()
+        if method == "unique":
+            return dict(zip(gene_ids,zip(distinct,distinct)))
+        result = {}
+        for gene,start,stop,n in zip(gene_ids,bounds[:-1],bounds[1:],distinct):
+            umi_counts = dict(zip(self.umis[lo+start:lo+stop].tolist(),self.reads[lo+start:lo+stop].tolist()))
+            result[gene] = (collapse(umi_counts,method),n)
+        return result
@@ -0,0 +1,185 @@
+'''
+Collapsing of UMIs which differ by a sequencing error , used by count_umi
+to count the molecules of a gene (or primer) from its UMIs and their read counts.
+
+The UMIs are packed into integers , 2 bits per base , so that the UMIs one
+substitution away from a UMI are found by XORing it with a precomputed mask for
+every position and base , instead of comparing every pair of UMIs. The methods ,
+as in UMI-tools :
+1. unique      : every distinct UMI is a molecule
+2. cluster     : every connected group of UMIs (at Hamming distance 1) is a molecule
+3. adjacency   : within a group , the fewest UMIs , taken by decreasing read count ,
+                 which together with their neighbours account for the whole group
+4. directional : a UMI only absorbs a neighbour with count <= (its count + 1)/2 ,
+                 every group reached this way from the most abundant UMIs is a molecule
+
+A packed UMI carries a sentinel bit above its bases (see pack_umi) so that UMIs
+of different lengths never share a code. UMIs with bases other than A/C/G/T can
+not be packed and are each counted as a molecule.
+'''
+
+from collections import deque
+## Modules from this project
+from cell_index_correction import encode
+
+METHODS = ["unique","cluster","adjacency","directional"]
+
+## length -> XOR masks changing a single base of a packed UMI
+_MASKS = {}
+
+def pack_umi(umi):
+    ''' Pack a UMI into an integer , 2 bits per base below a sentinel bit
+    :param str umi: the UMI sequence
+    :return the packed code , -1 if the UMI has a base other than A/C/G/T
+    :rtype int
+    '''
+    code = encode(umi)
+    if code < 0:
+        return -1
+    return code | (1 << 2*len(umi))
+
+def umi_length(code):
+    ''' The length of a UMI packed by pack_umi
+    :param int code: the packed UMI
+    :rtype int
+    '''
+    return (code.bit_length() - 1)//2
+
+def hamming1_masks(length):
+    ''' XOR masks for all single base substitutions of a packed UMI
+    :param int length: the UMI length
+    :rtype list
+    '''
+    if length not in _MASKS:
+        _MASKS[length] = [v << 2*i for i in xrange(length) for v in (1,2,3)]
+    return _MASKS[length]
+
+def neighbours(code,counts,masks):
+    ''' The UMIs at Hamming distance 1 from a packed UMI
+    :param int code: the packed UMI
+    :param dict counts: packed UMI -> read count , for the UMIs seen
+    :param list masks: from hamming1_masks
+    :rtype list
+    '''
+    return [code ^ m for m in masks if code ^ m in counts]
+
+def by_count(counts):
+    ''' The packed UMIs by decreasing read count , ties by code
+    :param dict counts: packed UMI -> read count
+    :rtype list
+    '''
+    return sorted(counts,key=lambda code:(-counts[code],code))
+
+def components(counts,masks):
+    ''' The groups of UMIs connected at Hamming distance 1 , with the
+    neighbours of each UMI
+    :param dict counts: packed UMI -> read count
+    :param list masks: from hamming1_masks
+    :returns (list of groups , packed UMI -> list of neighbours)
+    :rtype tuple
+    '''
+    adjacency = dict((code,neighbours(code,counts,masks)) for code in counts)
+    seen = set()
+    groups = []
+    for code in by_count(counts):
+        if code in seen:
+            continue
+        group = [code]
+        seen.add(code)
+        queue = deque([code])
+        while queue:
+            for other in adjacency[queue.popleft()]:
+                if other not in seen:
+                    seen.add(other)
+                    group.append(other)
+                    queue.append(other)
+        groups.append(group)
+    return (groups,adjacency)
+
+def adjacency_molecules(group,counts,adjacency):
+    ''' Number of UMIs , by decreasing read count , whose neighbourhoods cover the group
+    :param list group: the packed UMIs of a group
+    :param dict counts: packed UMI -> read count
+    :param dict adjacency: packed UMI -> list of neighbours
+    :rtype int
+    '''
+    if len(group) == 1:
+        return 1
+    remaining = set(group)
+    lead = 0
+    for code in sorted(group,key=lambda code:(-counts[code],code)):
+        lead += 1
+        remaining.discard(code)
+        remaining.difference_update(adjacency[code])
+        if not remaining:
+            break
+    return lead
+
+def directional_molecules(counts,masks):
+    ''' Number of groups formed by letting each UMI absorb its neighbours with
+    count <= (count + 1)/2 , starting from the most abundant UMIs
+    :param dict counts: packed UMI -> read count
+    :param list masks: from hamming1_masks
+    :rtype int
+    '''
+    seen = set()
+    molecules = 0
+    for code in by_count(counts):
+        if code in seen:
+            continue
+        molecules += 1
+        seen.add(code)
+        queue = deque([code])
+        while queue:
+            node = queue.popleft()
+            for other in neighbours(node,counts,masks):
+                if other not in seen and counts[node] >= 2*counts[other] - 1:
+                    seen.add(other)
+                    queue.append(other)
+    return molecules
+
+def collapse(umi_counts,method="unique"):
+    ''' Count the molecules from the packed UMIs of a gene
+    :param dict umi_counts: packed UMI (see pack_umi) -> read count ,
+                            UMIs which could not be packed have distinct negative codes
+    :param str method: one of METHODS
+    :rtype int
+    '''
+    if method == "unique" or len(umi_counts) <= 1:
+        return len(umi_counts)
+    by_length = {}
+    molecules = 0
+    for code,count in umi_counts.iteritems():
+        if code < 0:
+            molecules += 1
+        else:
+            by_length.setdefault(umi_length(code),{})[code] = count
+    for length,counts in by_length.iteritems():
+        masks = hamming1_masks(length)
+        if method == "directional":
+            molecules += directional_molecules(counts,masks)
+            continue
+        groups,adjacency = components(counts,masks)
+        if method == "cluster":
+            molecules += len(groups)
+        else:
+            molecules += sum(adjacency_molecules(group,counts,adjacency) for group in groups)
+    return molecules
+
+def count_molecules(umi_counts,method="unique"):
+    ''' Count the molecules from the UMIs of a gene
+    :param dict umi_counts: UMI -> read count
+    :param str method: one of METHODS
+    :rtype int
+    '''
+    if method == "unique" or len(umi_counts) <= 1:
+        return len(umi_counts)
+    packed = {}
+    unpacked = 0
+    for umi,count in umi_counts.iteritems():
+        code = pack_umi(umi)
+        if code < 0:
+            unpacked -= 1
+            code = unpacked
+        packed[code] = count
+    return collapse(packed,method)
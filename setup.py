@@ -0,0 +1,18 @@
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Build import cythonize
+
+'''
+Build the cython kernels of core/_utils.pyx ahead of the runs , instead of
+compiling them with pyximport when the pipeline modules are imported :
+
+    python setup.py build_ext --inplace
+
+writes the extension next to _utils.pyx in core/. Without it demultiplex_cells
+and shared_ring fall back to pyximport , which is fine for development.
+'''
+
+setup(
+    name="qiaseq-singlecell-rna",
+    ext_modules=cythonize([Extension("core._utils",["core/_utils.pyx"])]),
+)
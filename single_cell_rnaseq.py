@@ -7,20 +7,20 @@ import luigi
 import logging
 import ConfigParser
 import datetime
+from collections import OrderedDict
+import time
 ## Modules from this project
 sys.path.append(os.path.join(os.path.dirname(
     os.path.realpath(__file__)),'core'))
-from demultiplex_cells import demux
-from align_transcriptome import star_alignment,star_load_index,star_remove_index,run_cmd
-from count_umi import count_umis,count_umis_wts
-from combine_cell_results import merge_count_files,merge_metric_files
-from combine_sample_results import combine_count_files,combine_cell_metrics,combine_sample_metrics,clean_for_clustering,check_metric_counts
-from create_excel_sheet import write_excel_workbook
-from create_run_summary import is_file_empty, write_run_summary, calc_stats_gene_count, calc_median_cell_metrics
-from create_annotation_tables import create_gene_tree,create_gene_hash
+## Only the light helpers needed to build the task graph are imported here , the
+## stage modules (pysam , pathos , xlsxwriter , the cython kernels , ...) are imported
+## in the run() of the tasks using them , so that the scheduler and the workers start fast
+from fastq_io import sample_bam_path,cell_fastq_path,read_cell_index_file
+from sparse_counts import sparse_files
+from profiling import stage,start_task,finish_task,profile_file,write_run_profile
 
 ## Some globals to cache across tasks
-GENE_TREE = None ## IntervalTree datastructure for use in WTS
+GENE_INDEX = None ## Sorted gene interval index for use in WTS
 GENE_HASH = None ## Annotations for genes , for use in Targeted case
 ## Set up logging
 logger = logging.getLogger("pipeline")
@@ -35,20 +35,106 @@ class config(luigi.Config):
     star = luigi.Parameter(description="Path to the STAR executable")
     star_params = luigi.Parameter(description="Params for STAR")
     star_load_params = luigi.Parameter(description="Params for STAR to load a genome file")
+    star_exit_params = luigi.Parameter(description="Params for STAR to remove a genome loaded in shared memory",default="--genomeLoad Remove")
+    star_shared_genome = luigi.IntParameter(description="0/1 ; Whether to load the genome once into shared memory with star_load_params and keep it for all alignments",default=0)
+    star_align_per_sample = luigi.IntParameter(description="0/1 ; Whether to align all cell fastqs of a sample in one STAR run , with a read group per cell",default=0)
     genome_dir = luigi.Parameter(description="The path to the star index dir")
     seqtype = luigi.Parameter(description="Whether this is a targetted or wts experiment")
     primer_file = luigi.Parameter(description="The primer file,if wts this is not applicable")
     annotation_gtf = luigi.Parameter(description="Gencode annotation file")
     ercc_bed = luigi.Parameter(description="ERCC bed file with coordinate information")
+    annotation_cache_dir = luigi.Parameter(description="Directory for the annotation cache built from the gtf , empty for the directory of the gtf",default="")
     is_low_input = luigi.Parameter(description="Whether the sequencing protocol was for a low input application")
     catalog_number = luigi.Parameter(description="The catalog number for this primer pool")
     species = luigi.Parameter(description="The species name")
     genome = luigi.Parameter(description="The reference genome build version",default="Unknown")
     annotation = luigi.Parameter(description="The genome annotation version",default="Unknown")
-    editdist = luigi.IntParameter(description="Whether to allow a single base mismatch in the cell index")
+    editdist = luigi.IntParameter(description="Max number of base mismatches (0,1 or 2) to correct in the cell index")
     cell_indices_used = luigi.Parameter(description="Comma delimeted list of Cell Ids to use , i.e. C1,C2,C3,etc. If using all cell indices in the file , please specify 'all' here.")
     buffer_size       = luigi.IntParameter(description="Read this many MB from fastq file to memory for each read pair for each cpu",default=16)
+    demux_mode        = luigi.Parameter(description="batch/streaming ; streaming overlaps reading, processing and writing during demultiplexing",default="batch")
+    demux_chunks_in_flight = luigi.IntParameter(description="Streaming demux only, max number of buffer_size chunks held in memory",default=8)
+    demux_autotune         = luigi.IntParameter(description="0/1 ; Whether to tune buffer_size and the chunks processed at a time on the first chunks demultiplexed, see core/chunk_tuning.py",default=0)
+    demux_memory_budget    = luigi.IntParameter(description="Demux auto tuning only, MB the fastq chunks may hold in the main process and the workers",default=1024)
+    demux_autotune_chunks  = luigi.IntParameter(description="Demux auto tuning only, number of chunks processed before tuning",default=8)
+    demux_writer_threads   = luigi.IntParameter(description="Streaming demux only, number of threads writing the cell fastqs",default=4)
+    demux_compression      = luigi.Parameter(description="none/gzip/bgzf ; compression of the demultiplexed cell fastqs",default="none")
+    demux_decompress_threads = luigi.IntParameter(description="Number of pigz threads for decompressing each input fastq, 0 to use python's gzip module",default=0)
+    cell_index_indel         = luigi.IntParameter(description="0/1 ; Whether to also correct a single insertion/deletion in the cell index",default=0)
+    demux_shared_memory      = luigi.IntParameter(description="0/1 ; Whether to hand the fastq chunks to the demux workers through shared memory instead of pickling them",default=0)
+    umi_dedup                = luigi.Parameter(description="unique/cluster/adjacency/directional ; how UMIs one base apart are collapsed when counting molecules",default="unique")
+    count_chunk_size         = luigi.IntParameter(description="UMI counting , MB of reads to hold in memory at a time",default=256)
+    count_output_format      = luigi.Parameter(description="dense/sparse/both ; combined UMI counts as a tsv with a column per cell , as Matrix Market files , or both",default="dense")
+    demux_output             = luigi.Parameter(description="fastq/bam ; demultiplex to one fastq per cell , or to one unaligned BAM per sample with CB/UB tags which is aligned and counted once per sample",default="fastq")
+    read_trace               = luigi.Parameter(description="Targeted UMI counting only , reads traced to the counting log , e.g. every=1000 , reads=id1,id2 , names=GENE1 or all , see core/read_trace.py ; empty to log the counts of each outcome only",default="")
+    cells_per_task           = luigi.IntParameter(description="Per cell alignment and counting only , number of cells aligned and counted by one task , 1 for a task per cell. With luigi --workers > 1 each task runs in its own process , the worker pools are then only reused across the cells of a task",default=1)
     
+def alignment_params():
+    ''' Return the STAR alignment params for this run
+    :rtype str
+    '''
+    if config().star_shared_genome:
+        from align_transcriptome import star_shared_genome_options
+        return star_shared_genome_options(config().star_params)
+    return config().star_params
+
+def gene_index():
+    ''' The gene interval index for WTS , loaded from the annotation cache on first use in
+    this process , i.e. by the counting tasks and not when the task graph is built
+    :rtype GeneIndex
+    '''
+    global GENE_INDEX
+    if GENE_INDEX is None:
+        from annotation_cache import load_gene_index
+        GENE_INDEX = load_gene_index(config().annotation_gtf,config().ercc_bed,config().species,
+                                     config().annotation_cache_dir or None,logger)
+    return GENE_INDEX
+
+def gene_hash():
+    ''' The gene annotations for targeted , loaded from the annotation cache on first use in this process
+    :rtype dict
+    '''
+    global GENE_HASH
+    if GENE_HASH is None:
+        from annotation_cache import load_gene_hash
+        GENE_HASH = load_gene_hash(config().annotation_gtf,config().ercc_bed,config().annotation_cache_dir or None,logger)
+    return GENE_HASH
+
+def used_cells(cell_index_file):
+    ''' The cells of cell_indices_used , in cell index file order
+    :param str cell_index_file: the cell index file
+    :returns list of (cell number , cell index)
+    :rtype list
+    '''
+    cell_indices = read_cell_index_file(cell_index_file,config().cell_indices_used)
+    return [(cell_num,cell_index) for cell_index,cell_num in cell_indices.items()]
+
+def shard_cells(cell_index_file,shard):
+    ''' The cells aligned and counted by a shard task
+    :param str cell_index_file: the cell index file
+    :param int shard: the shard number , from 0
+    :returns list of (cell number , cell index)
+    :rtype list
+    '''
+    n = config().cells_per_task
+    return used_cells(cell_index_file)[shard*n:(shard+1)*n]
+
+def write_shard_timing(timing_file,timings):
+    ''' Write the seconds spent on each cell of a shard task
+    :param str timing_file: the output file
+    :param list timings: list of (cell number , cell index , seconds)
+    '''
+    with open(timing_file,'w') as OUT:
+        OUT.write("cell\tcell_index\tseconds\n")
+        for cell_num,cell_index,seconds in timings:
+            OUT.write("{n}\t{c}\t{t:.2f}\n".format(n=cell_num,c=cell_index,t=seconds))
+
+def per_sample_counting():
+    ''' Whether alignment and UMI counting run once per sample instead of once per cell
+    :rtype bool
+    '''
+    return config().demux_output == "bam" or bool(config().star_align_per_sample)
+
 class MyExtTask(luigi.ExternalTask):
     ''' Checks whether the file specified exists on disk
     '''
@@ -111,13 +197,22 @@ class DeMultiplexer(luigi.Task):
     def run(self):
         ''' Work entails demultiplexing of Fastqs
         '''
+        from demultiplex_cells import demux
+        from align_transcriptome import check_star_version,STAR_BAM_INPUT_VERSION
         logger.info("Started Task: {x}-{y} {z}".format(x='DeMultiplexer',y=self.sample_name,z=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        if config().demux_output == "bam": ## fail before demultiplexing to a BAM which STAR can not align
+            check_star_version(config().star,STAR_BAM_INPUT_VERSION,"demux_output = bam")
         is_wts = config().seqtype.upper() == "WTS"
         return_demux_rate = True
         try:
             demux_rate = demux(self.R1_fastq,self.R2_fastq,self.cell_index_file,self.sample_dir,self.temp_metric_file,
                                config().cell_indices_used,self.vector_sequence,self.instrument,is_wts,return_demux_rate,
-                               self.cell_index_len,self.mt_len,config().editdist,self.num_errors,self.num_cores,config().buffer_size,self.logfile)
+                               self.cell_index_len,self.mt_len,config().editdist,self.num_errors,self.num_cores,config().buffer_size,self.logfile,
+                               config().demux_mode,config().demux_chunks_in_flight,config().demux_writer_threads,
+                               config().demux_compression,config().demux_decompress_threads,
+                               config().cell_index_indel,self.output_dir,config().demux_shared_memory,
+                               config().demux_output,config().demux_autotune,config().demux_memory_budget,
+                               config().demux_autotune_chunks)
         except Exception as e:
             raise(type(e)(e.message + " for sample : {}".format(self.sample_name)))
         
@@ -149,6 +244,9 @@ class LoadGenomeIndex(luigi.Task):
         self.target_dir = os.path.join(self.output_dir,'targets')
         if not os.path.exists(self.target_dir):
             os.makedirs(self.target_dir)
+        self.logdir = os.path.join(self.output_dir,'logs')
+        if not os.path.exists(self.logdir):
+            os.makedirs(self.logdir)
         ## The verification file for this task
         self.verification_file = os.path.join(self.target_dir,
                                               self.__class__.__name__+
@@ -162,8 +260,13 @@ class LoadGenomeIndex(luigi.Task):
     def run(self):
         ''' Work entails loading the genome index
         '''
+        from align_transcriptome import star_load_index
         logger.info("Started Task: {x} {y}".format(x='LoadGenomeIndex',y=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-        ## star_load_index(config().star,config().genome_dir,config().star_load_params)
+        if config().star_shared_genome: ## otherwise each alignment loads the genome itself
+            with stage("STAR genome load") as timer:
+                star_load_index(config().star,config().genome_dir,config().star_load_params +
+                                ' --outFileNamePrefix %s'%os.path.join(self.logdir,'LoadGenomeIndex.'))
+            logger.info("Loaded genome into shared memory in {:.1f} s".format(timer.wall))
         ## Create the verification file
         with open(self.verification_file,'w') as OUT:
             print >> OUT,"verification"
@@ -226,11 +329,17 @@ class Alignment(luigi.Task):
     def run(self):
         ''' Work is to run STAR alignment
         '''
+        from align_transcriptome import star_alignment,star_read_files_command
+        from create_run_summary import is_file_empty
         logger.info("Started Task: {x}-{y}-{z} {v}".format(x='STAR Alignment',y=self.sample_name,z=self.cell_num,v=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         if not is_file_empty(self.cell_fastq): ## Make sure the file is not empty
             ## Do the alignment
-            star_alignment(config().star,config().genome_dir,os.path.join(self.cell_dir,''),self.logfile,
-                           config().star_params,self.cell_fastq)
+            star_params = alignment_params()
+            star_params += star_read_files_command(star_params,self.cell_fastq)
+            with stage("STAR") as timer:
+                star_alignment(config().star,config().genome_dir,os.path.join(self.cell_dir,''),self.logfile,
+                               star_params,self.cell_fastq)
+            logger.info("STAR wall time for {x}-{y} : {t:.1f} s".format(x=self.sample_name,y=self.cell_num,t=timer.wall))
         ## Create the verification file
         with open(self.verification_file,'w') as OUT:
             print >> OUT,"verification"
@@ -295,15 +404,19 @@ class CountUMI(luigi.Task):
     def run(self):
         ''' Work to be done is counting of UMIs
         '''
+        from count_umi import count_umis,count_umis_wts
+        from create_run_summary import is_file_empty
         logger.info("Started Task: {x}-{y}-{z} {v}".format(x='UMI Counting',y=self.sample_name,z=self.cell_num,v=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         if not is_file_empty(self.cell_fastq): ## Make sure the file is not empty
             if config().seqtype.upper() == 'WTS':
-                count_umis_wts(GENE_TREE,self.bam,self.outfile,
-                               self.metricsfile,self.logfile,self.num_cores)
+                count_umis_wts(gene_index(),self.bam,self.outfile,
+                               self.metricsfile,self.logfile,self.num_cores,config().count_chunk_size*1024**2,
+                               config().umi_dedup)
             else:
-                count_umis(GENE_HASH,config().primer_file,self.bam,
+                count_umis(gene_hash(),config().primer_file,self.bam,
                            self.outfile_primer,self.outfile,
-                           self.metricsfile,self.logfile,self.num_cores)
+                           self.metricsfile,self.logfile,self.num_cores,config().count_chunk_size*1024**2,
+                           config().umi_dedup,trace=config().read_trace)
 
         with open(self.verification_file,'w') as OUT:
             print >> OUT,"verification"
@@ -314,6 +427,323 @@ class CountUMI(luigi.Task):
         '''
         return luigi.LocalTarget(self.verification_file)
 
+class AlignShard(luigi.Task):
+    ''' Task for running STAR on the fastqs of a shard of cells , see config.cells_per_task
+    '''
+    ## Define some parameters
+    R1_fastq = luigi.Parameter()
+    R2_fastq = luigi.Parameter()
+    output_dir = luigi.Parameter()
+    sample_name = luigi.Parameter()
+    cell_index_file = luigi.Parameter()
+    vector_sequence = luigi.Parameter()
+    isolator = luigi.Parameter()
+    cell_index_len = luigi.IntParameter()
+    mt_len = luigi.IntParameter()
+    num_cores = luigi.IntParameter()
+    num_errors = luigi.IntParameter()
+    instrument = luigi.Parameter()
+
+    shard = luigi.IntParameter()
+
+    def __init__(self,*args,**kwargs):
+        ''' Class constructor
+        '''
+        super(AlignShard,self).__init__(*args,**kwargs)
+        self.sample_dir = os.path.join(self.output_dir,self.sample_name)
+        self.target_dir = os.path.join(self.sample_dir,'targets')
+        self.logdir = os.path.join(self.sample_dir,'logs')
+        ## The verification file for this task
+        self.verification_file = os.path.join(self.target_dir,
+                                              self.__class__.__name__+
+                                              '.'+str(self.shard)+
+                                              '.verification.txt')
+        self.timing_file = os.path.join(self.logdir,
+                                        self.__class__.__name__ + "." +
+                                        self.sample_name +
+                                        '.' + str(self.shard)+'.timing.txt')
+
+    def requires(self):
+        ''' Task requires loading of GenomeIndex and Demultiplexing of Fastqs
+        '''
+        yield LoadGenomeIndex(output_dir=self.output_dir)
+        yield self.clone(DeMultiplexer)
+
+    def run(self):
+        ''' Work is to run STAR alignment for each cell of the shard
+        '''
+        from align_transcriptome import star_alignment,star_read_files_command
+        from create_run_summary import is_file_empty
+        logger.info("Started Task: {x}-{y}-shard{z} {v}".format(x='STAR Alignment',y=self.sample_name,z=self.shard,v=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        shard_start = time.time()
+        timings = []
+        for cell_num,cell_index in shard_cells(self.cell_index_file,self.shard):
+            start = time.time()
+            cell_fastq = cell_fastq_path(self.sample_dir,cell_num,cell_index,config().demux_compression)
+            if not is_file_empty(cell_fastq): ## Make sure the file is not empty
+                cell_dir = os.path.join(self.sample_dir,'Cell%i_%s'%(cell_num,cell_index))
+                logfile = os.path.join(self.logdir,self.__class__.__name__+"."+self.sample_name+'.'+str(cell_num)+'.log.txt')
+                star_params = alignment_params()
+                star_params += star_read_files_command(star_params,cell_fastq)
+                with stage("STAR"):
+                    star_alignment(config().star,config().genome_dir,os.path.join(cell_dir,''),logfile,
+                                   star_params,cell_fastq)
+            timings.append((cell_num,cell_index,time.time()-start))
+            logger.info("STAR wall time for {x}-{y} : {t:.1f} s".format(x=self.sample_name,y=cell_num,t=timings[-1][2]))
+        write_shard_timing(self.timing_file,timings)
+        logger.info("STAR wall time for {x}-shard{y} , {n} cells : {t:.1f} s".format(x=self.sample_name,y=self.shard,n=len(timings),t=time.time()-shard_start))
+        ## Create the verification file
+        with open(self.verification_file,'w') as OUT:
+            print >> OUT,"verification"
+        logger.info("Finished Task: {x}-{y}-shard{z} {v}".format(x='STAR Alignment',y=self.sample_name,z=self.shard,v=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def output(self):
+        ''' Output from this task for verification
+        '''
+        return luigi.LocalTarget(self.verification_file)
+
+class CountUMIShard(luigi.Task):
+    ''' Task for counting UMIs of a shard of cells , with the counting pool of this process
+    '''
+    ## Parameters
+    R1_fastq = luigi.Parameter()
+    R2_fastq = luigi.Parameter()
+    output_dir = luigi.Parameter()
+    sample_name = luigi.Parameter()
+    cell_index_file = luigi.Parameter()
+    vector_sequence = luigi.Parameter()
+    isolator = luigi.Parameter()
+    cell_index_len = luigi.IntParameter()
+    mt_len = luigi.IntParameter()
+    num_cores = luigi.IntParameter()
+    num_errors = luigi.IntParameter()
+    instrument = luigi.Parameter()
+
+    shard = luigi.IntParameter()
+
+    def __init__(self,*args,**kwargs):
+        ''' Class constructor
+        '''
+        super(CountUMIShard,self).__init__(*args,**kwargs)
+        self.sample_dir = os.path.join(self.output_dir,self.sample_name)
+        self.target_dir = os.path.join(self.sample_dir,'targets')
+        self.logdir = os.path.join(self.sample_dir,'logs')
+        ## The verification file for this task
+        self.verification_file = os.path.join(self.target_dir,
+                                              self.__class__.__name__+
+                                              '.'+str(self.shard)+
+                                              '.verification.txt')
+        self.timing_file = os.path.join(self.logdir,
+                                        self.__class__.__name__ + "." +
+                                        self.sample_name +
+                                        '.' + str(self.shard)+'.timing.txt')
+
+    def requires(self):
+        ''' Requirement is the completion of the AlignShard task
+        '''
+        return self.clone(AlignShard)
+
+    def run(self):
+        ''' Work to be done is counting of UMIs for each cell of the shard
+        '''
+        from count_umi import count_umis,count_umis_wts,counting_pool
+        from create_run_summary import is_file_empty
+        logger.info("Started Task: {x}-{y}-shard{z} {v}".format(x='UMI Counting',y=self.sample_name,z=self.shard,v=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        shard_start = time.time()
+        wts = config().seqtype.upper() == 'WTS'
+        if wts:
+            pool = counting_pool(self.num_cores,gene_index=gene_index())
+        else:
+            pool = counting_pool(self.num_cores,primer_bed=config().primer_file)
+        timings = []
+        for cell_num,cell_index in shard_cells(self.cell_index_file,self.shard):
+            start = time.time()
+            cell_fastq = cell_fastq_path(self.sample_dir,cell_num,cell_index,config().demux_compression)
+            if not is_file_empty(cell_fastq): ## Make sure the file is not empty
+                cell_dir = os.path.join(self.sample_dir,'Cell%i_%s'%(cell_num,cell_index))
+                bam = os.path.join(cell_dir,'Aligned.sortedByCoord.out.bam')
+                outfile = os.path.join(cell_dir,'umi_count.txt')
+                metricsfile = os.path.join(cell_dir,'read_stats.txt')
+                logfile = os.path.join(self.logdir,self.__class__.__name__+"."+self.sample_name+'.'+str(cell_num)+'.log.txt')
+                if wts:
+                    count_umis_wts(gene_index(),bam,outfile,metricsfile,logfile,self.num_cores,
+                                   config().count_chunk_size*1024**2,config().umi_dedup,pool=pool)
+                else:
+                    count_umis(gene_hash(),config().primer_file,bam,
+                               os.path.join(cell_dir,'umi_count.primers.txt'),outfile,
+                               metricsfile,logfile,self.num_cores,config().count_chunk_size*1024**2,
+                               config().umi_dedup,pool=pool,trace=config().read_trace)
+            timings.append((cell_num,cell_index,time.time()-start))
+            logger.info("UMI counting time for {x}-{y} : {t:.1f} s".format(x=self.sample_name,y=cell_num,t=timings[-1][2]))
+        logger.info(pool.summary())
+        write_shard_timing(self.timing_file,timings)
+        logger.info("UMI counting time for {x}-shard{y} , {n} cells : {t:.1f} s".format(x=self.sample_name,y=self.shard,n=len(timings),t=time.time()-shard_start))
+        with open(self.verification_file,'w') as OUT:
+            print >> OUT,"verification"
+        logger.info("Finished Task: {x}-{y}-shard{z} {v}".format(x='UMI Counting',y=self.sample_name,z=self.shard,v=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def output(self):
+        ''' The output from this task
+        '''
+        return luigi.LocalTarget(self.verification_file)
+
+class AlignSample(luigi.Task):
+    ''' Task for running STAR once for a whole sample , on the unaligned BAM
+    when demultiplexing to BAM , otherwise on all the cell fastqs with a read group per cell
+    '''
+    ## Define some parameters
+    R1_fastq = luigi.Parameter()
+    R2_fastq = luigi.Parameter()
+    output_dir = luigi.Parameter()
+    sample_name = luigi.Parameter()
+    cell_index_file = luigi.Parameter()
+    vector_sequence = luigi.Parameter()
+    isolator = luigi.Parameter()
+    cell_index_len = luigi.IntParameter()
+    mt_len = luigi.IntParameter()
+    num_cores = luigi.IntParameter()
+    num_errors = luigi.IntParameter()
+    instrument = luigi.Parameter()
+
+    def __init__(self,*args,**kwargs):
+        ''' Class constructor
+        '''
+        super(AlignSample,self).__init__(*args,**kwargs)
+        self.sample_dir = os.path.join(self.output_dir,self.sample_name)
+        self.unaligned_bam = sample_bam_path(self.sample_dir)
+        ## cell index -> cell fastq , for the cells demultiplexed
+        self.cell_fastqs = OrderedDict()
+        for cell_num,cell_index in used_cells(self.cell_index_file):
+            self.cell_fastqs[cell_index] = cell_fastq_path(self.sample_dir,cell_num,cell_index,config().demux_compression)
+        self.target_dir = os.path.join(self.sample_dir,'targets')
+        self.logdir = os.path.join(self.sample_dir,'logs')
+        ## The verification file for this task
+        self.verification_file = os.path.join(self.target_dir,
+                                              self.__class__.__name__+
+                                              '.verification.txt')
+        self.logfile = os.path.join(self.logdir,
+                                    self.__class__.__name__ + "." +
+                                    self.sample_name + '.log.txt')
+
+    def requires(self):
+        ''' Task requires loading of GenomeIndex and Demultiplexing of Fastqs
+        '''
+        yield LoadGenomeIndex(output_dir=self.output_dir)
+        yield self.clone(DeMultiplexer)
+
+    def run(self):
+        ''' Work is to run STAR alignment , the reads keep the CB/UB tags or get the
+        cell index as their read group
+        '''
+        from align_transcriptome import star_alignment,star_read_files_command,star_bam_input_options,star_read_group_options
+        from align_transcriptome import check_star_version,STAR_BAM_INPUT_VERSION
+        from create_run_summary import is_file_empty
+        logger.info("Started Task: {x}-{y} {z}".format(x='STAR Sample Alignment',y=self.sample_name,z=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        start = time.time()
+        star_params = alignment_params()
+        if config().demux_output == "bam":
+            check_star_version(config().star,STAR_BAM_INPUT_VERSION,"Aligning the unaligned BAM of demux_output = bam")
+            star_params += star_bam_input_options(star_params)
+            reads = self.unaligned_bam
+        else:
+            read_groups = [cell_index for cell_index,fastq in self.cell_fastqs.items() if not is_file_empty(fastq)]
+            fastqs = [self.cell_fastqs[cell_index] for cell_index in read_groups]
+            reads = ','.join(fastqs)
+            if fastqs:
+                star_params += star_read_files_command(star_params,fastqs[0])
+                star_params += star_read_group_options(star_params,read_groups)
+        if reads: ## Make sure some cell fastq is not empty
+            with stage("STAR"):
+                star_alignment(config().star,config().genome_dir,os.path.join(self.sample_dir,''),self.logfile,
+                               star_params,reads)
+            logger.info("STAR wall time for {x} : {t:.1f} s".format(x=self.sample_name,t=time.time()-start))
+        else:
+            logger.info("No reads in the cell fastqs of {x} , skipping STAR".format(x=self.sample_name))
+        ## Create the verification file
+        with open(self.verification_file,'w') as OUT:
+            print >> OUT,"verification"
+        logger.info("Finished Task: {x}-{y} {z}".format(x='STAR Sample Alignment',y=self.sample_name,z=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def output(self):
+        ''' Output from this task for verification
+        '''
+        return luigi.LocalTarget(self.verification_file)
+
+class CountUMISample(luigi.Task):
+    ''' Task for counting UMIs for all cells of a sample in one pass over
+    the aligned sample BAM , used with AlignSample
+    '''
+    ## Parameters
+    R1_fastq = luigi.Parameter()
+    R2_fastq = luigi.Parameter()
+    output_dir = luigi.Parameter()
+    sample_name = luigi.Parameter()
+    cell_index_file = luigi.Parameter()
+    vector_sequence = luigi.Parameter()
+    isolator = luigi.Parameter()
+    cell_index_len = luigi.IntParameter()
+    mt_len = luigi.IntParameter()
+    num_cores = luigi.IntParameter()
+    num_errors = luigi.IntParameter()
+    instrument = luigi.Parameter()
+
+    def __init__(self,*args,**kwargs):
+        ''' Class constructor
+        '''
+        super(CountUMISample,self).__init__(*args,**kwargs)
+        self.sample_dir = os.path.join(self.output_dir,self.sample_name)
+        self.bam = os.path.join(self.sample_dir,'Aligned.sortedByCoord.out.bam')
+        self.target_dir = os.path.join(self.sample_dir,'targets')
+        self.logdir = os.path.join(self.sample_dir,'logs')
+        ## The verification file for this task
+        self.verification_file = os.path.join(self.target_dir,
+                                              self.__class__.__name__+
+                                              '.verification.txt')
+        self.logfile = os.path.join(self.logdir,
+                                    self.__class__.__name__ + "." +
+                                    self.sample_name + '.log.txt')
+        ## The output files for each cell demultiplexed , in the cell directories
+        self.outputs = {}
+        for cell_num,cell_index in used_cells(self.cell_index_file):
+            cell_dir = os.path.join(self.sample_dir,'Cell%i_%s'%(cell_num,cell_index))
+            self.outputs[cell_index] = (os.path.join(cell_dir,'umi_count.primers.txt'),
+                                        os.path.join(cell_dir,'umi_count.txt'),
+                                        os.path.join(cell_dir,'read_stats.txt'))
+
+    def requires(self):
+        ''' Requirement is the completion of the AlignSample task
+        '''
+        return self.clone(AlignSample)
+
+    def run(self):
+        ''' Work to be done is counting of UMIs , split by the CB tag or the read group
+        '''
+        from count_umi import count_umis_by_cell,count_umis_wts_by_cell
+        logger.info("Started Task: {x}-{y} {z}".format(x='UMI Counting',y=self.sample_name,z=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        if config().demux_output == "bam":
+            cell_tag,umi_tag = "CB","UB"
+        else: ## the UMI is still in the read name
+            cell_tag,umi_tag = "RG",None
+        if not os.path.exists(self.bam): ## AlignSample skipped STAR , no cell fastq had reads
+            logger.info("No aligned BAM for {x} , skipping UMI counting".format(x=self.sample_name))
+        elif config().seqtype.upper() == 'WTS':
+            outputs = dict((cell_index,(outfile,metricsfile)) for cell_index,(outfile_primer,outfile,metricsfile) in self.outputs.items())
+            count_umis_wts_by_cell(gene_index(),self.bam,outputs,self.logfile,self.num_cores,cell_tag,umi_tag,
+                                   config().count_chunk_size*1024**2,config().umi_dedup)
+        else:
+            count_umis_by_cell(gene_hash(),config().primer_file,self.bam,self.outputs,
+                               self.logfile,self.num_cores,cell_tag,umi_tag,config().count_chunk_size*1024**2,
+                               config().umi_dedup,trace=config().read_trace)
+
+        with open(self.verification_file,'w') as OUT:
+            print >> OUT,"verification"
+        logger.info("Finished Task: {x}-{y} {z}".format(x='UMI Counting',y=self.sample_name,z=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def output(self):
+        ''' The output from this task
+        '''
+        return luigi.LocalTarget(self.verification_file)
+
 class JoinCountFiles(luigi.Task):
     ''' Task for joining UMI count and metric files
     '''
@@ -365,14 +795,41 @@ class JoinCountFiles(luigi.Task):
         ''' Dependncies are the completion of the individual UMI counting tasks
         for each cell
         '''
+        if per_sample_counting(): ## counted in one pass over the sample
+            yield CountUMISample(R1_fastq=self.R1_fastq,
+                                 R2_fastq=self.R2_fastq,
+                                 output_dir=self.output_dir,
+                                 sample_name=self.sample_name,
+                                 cell_index_file=self.cell_index_file,
+                                 vector_sequence=self.vector_sequence,
+                                 isolator=self.isolator,
+                                 cell_index_len=self.cell_index_len,
+                                 mt_len=self.mt_len,
+                                 num_cores=self.num_cores,
+                                 num_errors=self.num_errors,
+                                 instrument=self.instrument)
+            return
+        cells = used_cells(self.cell_index_file) ## the other cells are not demultiplexed
+        if config().cells_per_task > 1: ## a task per shard of cells
+            nshards = (len(cells) + config().cells_per_task - 1) // config().cells_per_task
+            yield [CountUMIShard(R1_fastq=self.R1_fastq,
+                                 R2_fastq=self.R2_fastq,
+                                 output_dir=self.output_dir,
+                                 sample_name=self.sample_name,
+                                 cell_index_file=self.cell_index_file,
+                                 vector_sequence=self.vector_sequence,
+                                 isolator=self.isolator,
+                                 cell_index_len=self.cell_index_len,
+                                 mt_len=self.mt_len,
+                                 num_cores=self.num_cores,
+                                 num_errors=self.num_errors,
+                                 instrument=self.instrument,
+                                 shard=shard) for shard in xrange(nshards)]
+            return
         ## Schedule the dependencies first
         dependencies = []
-        for i,cell_index in enumerate(self.cell_indices):
-            cell_num = i+1
-            cell_dir = os.path.join(self.sample_dir,'Cell%i_%s'%(
-                cell_num,cell_index))
-            cell_fastq = os.path.join(cell_dir,'cell_'+str(cell_num)+
-                                      '_R1.fastq')
+        for cell_num,cell_index in cells:
+            cell_fastq = cell_fastq_path(self.sample_dir,cell_num,cell_index,config().demux_compression)
             dependencies.append(CountUMI(R1_fastq=self.R1_fastq,
                                         R2_fastq=self.R2_fastq,
                                         output_dir=self.output_dir,
@@ -393,10 +850,13 @@ class JoinCountFiles(luigi.Task):
     def run(self):
         ''' Work to be done is merging individual cell files for a given sample
         '''
+        from combine_cell_results import merge_count_files,merge_metric_files
         logger.info("Started Task: {x}-{y} {z}".format(x='JoinCountFiles',y=self.sample_name,z=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         ## Merge gene level count files first
         files_to_merge = glob.glob(os.path.join(self.sample_dir,"*/umi_count.txt"))
-        merge_count_files(self.sample_dir,self.count_file,self.sample_name,True,len(self.cell_indices),files_to_merge)
+        with stage("merge gene counts",cells=len(files_to_merge)) as timer:
+            merge_count_files(self.sample_dir,self.count_file,self.sample_name,True,len(self.cell_indices),files_to_merge)
+        logger.info("Merged gene counts of {x} {n} cells in {t:.1f} s".format(x=self.sample_name,n=len(files_to_merge),t=timer.wall))
         ## Join the files
         if config().seqtype.upper() == 'WTS':
             wts = True
@@ -404,10 +864,14 @@ class JoinCountFiles(luigi.Task):
             ## Merge primer level count files
             wts = False
             files_to_merge = glob.glob(os.path.join(self.sample_dir,"*/umi_count.primers.txt"))
-            merge_count_files(self.sample_dir,self.count_file_primers,self.sample_name,wts,len(self.cell_indices),files_to_merge)            
+            with stage("merge primer counts",cells=len(files_to_merge)) as timer:
+                merge_count_files(self.sample_dir,self.count_file_primers,self.sample_name,wts,len(self.cell_indices),files_to_merge)
+            logger.info("Merged primer counts of {x} {n} cells in {t:.1f} s".format(x=self.sample_name,n=len(files_to_merge),t=timer.wall))
         ## Merge metric files
         files_to_merge = glob.glob(os.path.join(self.sample_dir,"*/read_stats.txt"))
-        merge_metric_files(self.sample_dir,self.temp_metric_file,self.metric_file,self.metric_file_cell,self.sample_name,wts,len(self.cell_indices),config().editdist,files_to_merge)
+        with stage("merge metrics",cells=len(files_to_merge)) as timer:
+            merge_metric_files(self.sample_dir,self.temp_metric_file,self.metric_file,self.metric_file_cell,self.sample_name,wts,len(self.cell_indices),config().editdist,files_to_merge)
+        logger.info("Merged metrics of {x} in {t:.1f} s".format(x=self.sample_name,t=timer.wall))
         with open(self.verification_file,'w') as OUT:
             print >> OUT,"verification"
         logger.info("Finished Task: {x}-{y} {z}".format(x='JoinCountFiles',y=self.sample_name,z=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
@@ -417,6 +881,80 @@ class JoinCountFiles(luigi.Task):
         '''
         return luigi.LocalTarget(self.verification_file)
 
+def join_count_tasks(task):
+    ''' Return the JoinCountFiles task of each sample in the samples config
+    :param object task: a run level task , CombineSamples or ReleaseGenomeIndex
+    :rtype list
+    '''
+    dependencies = []
+    parser = ConfigParser.ConfigParser()
+    parser.read(task.samples_cfg)        
+    for section in parser.sections():            
+        sample_name = section
+        R1_fastq = parser.get(section,'R1_fastq')
+        R2_fastq = parser.get(section,'R2_fastq')
+        instrument = parser.get(section,'Instrument')
+        dependencies.append(
+            JoinCountFiles(
+                R1_fastq=R1_fastq,R2_fastq=R2_fastq,
+                output_dir=os.path.join(task.output_dir,"primary_analysis"),sample_name=sample_name,
+                cell_index_file=task.cell_index_file,vector_sequence=task.vector_sequence,
+                isolator=task.isolator,mt_len=task.mt_len,num_cores=task.num_cores,
+                num_errors=task.num_errors,instrument=instrument
+            )
+        )
+    return dependencies
+
+class ReleaseGenomeIndex(luigi.Task):
+    ''' Task for removing the genome loaded in shared memory by LoadGenomeIndex ,
+    once all the samples are aligned
+    '''
+    # Parameters
+    output_dir = luigi.Parameter()
+    samples_cfg = luigi.Parameter()
+    cell_index_file = luigi.Parameter()
+    vector_sequence = luigi.Parameter()
+    isolator = luigi.Parameter()
+    mt_len = luigi.IntParameter()
+    num_cores = luigi.IntParameter()
+    num_errors = luigi.IntParameter()
+
+    def __init__(self,*args,**kwargs):
+        ''' Class constructor
+        '''
+        super(ReleaseGenomeIndex,self).__init__(*args,**kwargs)
+        self.primary_dir = os.path.join(self.output_dir,"primary_analysis")
+        self.logdir = os.path.join(self.primary_dir,'logs')
+        ## The verification file for this task
+        self.target_dir = os.path.join(self.output_dir,'targets')
+        if not os.path.exists(self.target_dir):
+            os.makedirs(self.target_dir)
+        self.verification_file = os.path.join(self.target_dir,
+                                              self.__class__.__name__+
+                                              '.verification.txt')
+
+    def requires(self):
+        ''' The alignments for all samples need to be finished
+        '''
+        yield join_count_tasks(self)
+
+    def run(self):
+        ''' Work entails removing the genome from shared memory
+        '''
+        from align_transcriptome import star_remove_index
+        logger.info("Started Task: {x} {y}".format(x='ReleaseGenomeIndex',y=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        with stage("STAR genome release"):
+            star_remove_index(config().star,config().genome_dir,config().star_exit_params +
+                              ' --outFileNamePrefix %s'%os.path.join(self.logdir,'ReleaseGenomeIndex.'))
+        with open(self.verification_file,'w') as OUT:
+            print >> OUT,"verification"
+        logger.info("Finished Task: {x} {y}".format(x='ReleaseGenomeIndex',y=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def output(self):
+        ''' Output from this task
+        '''
+        return luigi.LocalTarget(self.verification_file)
+
 class CombineSamples(luigi.Task):
     ''' Task for combining results from multiple samples
     '''
@@ -447,66 +985,44 @@ class CombineSamples(luigi.Task):
         self.verification_file = os.path.join(self.target_dir,
                                               self.__class__.__name__+
                                               '.verification.txt')
-        ## Annotation information from gencode
-        if config().seqtype.upper() == 'WTS':
-            global GENE_TREE
-            GENE_TREE = create_gene_tree(config().annotation_gtf,config().ercc_bed,config().species)
-        else:
-            global GENE_HASH
-            GENE_HASH = create_gene_hash(config().annotation_gtf,config().ercc_bed)
         
     def requires(self):
-        ''' Task dependencies are joining sample count files
+        ''' Task dependencies are joining sample count files , and releasing
+        the genome once all samples are aligned
         '''
-        dependencies = []
-        parser = ConfigParser.ConfigParser()
-        parser.read(self.samples_cfg)        
-        for section in parser.sections():            
-            sample_name = section
-            R1_fastq = parser.get(section,'R1_fastq')
-            R2_fastq = parser.get(section,'R2_fastq')
-            instrument = parser.get(section,'Instrument')
-            dependencies.append(
-                JoinCountFiles(
-                    R1_fastq=R1_fastq,R2_fastq=R2_fastq,
-                    output_dir=self.primary_dir,sample_name=sample_name,
-                    cell_index_file=self.cell_index_file,vector_sequence=self.vector_sequence,
-                    isolator=self.isolator,mt_len=self.mt_len,num_cores=self.num_cores,
-                    num_errors=self.num_errors,instrument=instrument
-                )
-            )
-        yield dependencies        
+        yield join_count_tasks(self)
+        if config().star_shared_genome:
+            yield self.clone(ReleaseGenomeIndex)
 
     def run(self):
         ''' Work to run is merging sample count and metric files
         '''
+        from combine_sample_results import combine_count_files,combine_cell_metrics,combine_sample_metrics,check_metric_counts
         logger.info("Started Task: {x} {y}".format(x='CombineSamples',y=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         ## Aggregate on gene level
         files_to_merge = glob.glob(os.path.join(self.primary_dir,"*/*/umi_count.txt"))
-        cells_to_restrict,cells_dropped,total_UMIs_genes = combine_count_files(files_to_merge,self.combined_count_file,True)
+        with stage("combine gene counts",cells=len(files_to_merge)) as timer:
+            cells_to_restrict,cells_dropped,total_UMIs_genes = combine_count_files(files_to_merge,self.combined_count_file,True,
+                                                                                   output_format=config().count_output_format)
+        logger.info("Combined gene counts of {n} cells in {t:.1f} s".format(n=len(files_to_merge),t=timer.wall))
         ## Also, aggregate on primer level for targeted
         if config().seqtype.upper() != 'WTS':
             files_to_merge = glob.glob(os.path.join(self.primary_dir,"*/*/umi_count.primers.txt"))
-            cells_to_restrict,cells_dropped,total_UMIs_primers = combine_count_files(files_to_merge,self.combined_count_file_primers,False,cells_to_restrict)
-        ## Aggregate metrics for cells
-        files_to_merge = glob.glob(os.path.join(self.primary_dir,"*/*_cell_stats.txt"))
-        cell_metrics = combine_cell_metrics(files_to_merge,self.combined_cell_metrics_file,config().is_low_input,cells_to_restrict)
-        ## Aggregate metrics across different samples
-        files_to_merge = glob.glob(os.path.join(self.primary_dir,"*/*_read_stats.txt"))
-        sample_metrics = combine_sample_metrics(files_to_merge,self.combined_sample_metrics_file,config().is_low_input,cells_dropped,self.output_dir)
-        ## Ensure metrics tally up between sample level and cell level files
-        check_metric_counts(sample_metrics,cell_metrics,total_UMIs_genes)        
-        
-        ## Sort the UMI count files by gene/primer coordinates
-        cmd1_gene = """ cat {count_file}| awk 'NR == 1; NR > 1 {{print $0 | "sort --ignore-case -V -k4,4 -k5,5 -k6,6"}}' > {temp}"""
-        cmd1_primer = """ cat {count_file}| awk 'NR == 1; NR > 1 {{print $0 | "sort --ignore-case -V -k3,3 -k4,4 -k5,5"}}' > {temp}"""
-        cmd2 = """ cp {temp} {count_file} """
-        
-        if config().seqtype.upper() != 'WTS':
-            run_cmd(cmd1_primer.format(count_file=self.combined_count_file_primers,temp='temp.txt'))
-            run_cmd(cmd2.format(temp='temp.txt',count_file=self.combined_count_file_primers))
-        run_cmd(cmd1_gene.format(count_file=self.combined_count_file,temp='temp.txt'))
-        run_cmd(cmd2.format(temp='temp.txt',count_file=self.combined_count_file))
+            with stage("combine primer counts",cells=len(files_to_merge)) as timer:
+                cells_to_restrict,cells_dropped,total_UMIs_primers = combine_count_files(files_to_merge,self.combined_count_file_primers,False,cells_to_restrict,
+                                                                                         output_format=config().count_output_format)
+            logger.info("Combined primer counts of {n} cells in {t:.1f} s".format(n=len(files_to_merge),t=timer.wall))
+        with stage("combine metrics") as timer:
+            ## Aggregate metrics for cells
+            files_to_merge = glob.glob(os.path.join(self.primary_dir,"*/*_cell_stats.txt"))
+            cell_metrics = combine_cell_metrics(files_to_merge,self.combined_cell_metrics_file,config().is_low_input,cells_to_restrict)
+            ## Aggregate metrics across different samples
+            files_to_merge = glob.glob(os.path.join(self.primary_dir,"*/*_read_stats.txt"))
+            sample_metrics = combine_sample_metrics(files_to_merge,self.combined_sample_metrics_file,config().is_low_input,cells_dropped,self.output_dir)
+            ## Ensure metrics tally up between sample level and cell level files
+            check_metric_counts(sample_metrics,cell_metrics,total_UMIs_genes)
+        logger.info("Combined cell and sample metrics in {t:.1f} s".format(t=timer.wall))
+        ## The UMI count files are written already sorted by gene/primer coordinates and cells
         with open(self.verification_file,'w') as IN:
             IN.write('done\n')
         logger.info("Finished Task: {x} {y}".format(x='CombineSamples',y=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
@@ -552,6 +1068,11 @@ class ClusteringAnalysis(luigi.Task):
             os.path.realpath(__file__)),'core/secondary_analysis_pipeline_BASiCS.R')
         self.script_path_scran =  os.path.join(os.path.dirname(
             os.path.realpath(__file__)),'core/secondary_analysis_pipeline_scran.R')        
+        ## The R code reads the sparse counts directly when there is no dense file
+        if config().count_output_format == "sparse":
+            self.count_input = sparse_files(self.combined_count_file)[0]
+        else:
+            self.count_input = self.combined_count_file+'.clean'
         ## Pipeline specific params        
         self.target_dir = os.path.join(self.output_dir,'targets')
         if not os.path.exists(self.target_dir):
@@ -559,32 +1080,34 @@ class ClusteringAnalysis(luigi.Task):
         self.verification_file = os.path.join(self.target_dir,
                                               self.__class__.__name__+
                                               '.verification.txt')
+        ## The resource profile of the run , written once this last task is done
+        self.run_profile_file = os.path.join(self.target_dir,'QIAseqUltraplexRNA_{}_profile.json'.format(self.runid))
         self.cmd_basics = (
-            """ Rscript {script_path} {rundir} {count_file}.clean {ercc_file}"""
+            """ Rscript {script_path} {rundir} {count_file} {ercc_file}"""
             """ {qc_file}.clean {runid} {niter} {ncpu} {k} {perplexity}"""
             """ {hvgthres} 2>&1""".format(
                 script_path=self.script_path_basics,rundir=self.output_dir,
-                count_file=self.combined_count_file,ercc_file=self.ercc_file,
+                count_file=self.count_input,ercc_file=self.ercc_file,
                 qc_file=self.combined_cell_metrics_file,runid=self.runid,
                 niter=self.niter,ncpu=self.ncpu,k=self.k,
                 perplexity=self.perplexity,hvgthres=self.hvgthres
             ))
         self.cmd_scran = (
-            """ Rscript {script_path} {rundir} {count_file}.clean {ercc_file}"""
+            """ Rscript {script_path} {rundir} {count_file} {ercc_file}"""
             """ {qc_file}.clean {runid} {ncpu} {k} {perplexity}"""
             """ {hvgthres} 2>&1""".format(
                 script_path=self.script_path_scran,rundir=self.output_dir,
-                count_file=self.combined_count_file,ercc_file=self.ercc_file,
+                count_file=self.count_input,ercc_file=self.ercc_file,
                 qc_file=self.combined_cell_metrics_file,runid=self.runid,
                 ncpu=self.ncpu,k=self.k,
                 perplexity=self.perplexity,hvgthres=self.hvgthres
             ))
         self.cmd_scran_low_ercc = (
-            """ Rscript {script_path} {rundir} {count_file}.clean {ercc_file}"""
+            """ Rscript {script_path} {rundir} {count_file} {ercc_file}"""
             """ {qc_file}.clean {runid} {ncpu} {k} {perplexity}"""
             """ {hvgthres} 2>&1""".format(
                 script_path=self.script_path_scran,rundir=self.output_dir,
-                count_file=self.combined_count_file,ercc_file="none",
+                count_file=self.count_input,ercc_file="none",
                 qc_file=self.combined_cell_metrics_file,runid=self.runid,
                 ncpu=self.ncpu,k=self.k,
                 perplexity=self.perplexity,hvgthres=self.hvgthres
@@ -601,12 +1124,17 @@ class ClusteringAnalysis(luigi.Task):
     def run(self):
         ''' Work to be done here is to run the R code
         '''
+        from align_transcriptome import run_cmd
+        from combine_sample_results import clean_for_clustering
+        from create_run_summary import write_run_summary,calc_stats_gene_count,calc_median_cell_metrics
         logger.info("Starting Task: {x} {y}".format(x='ClusteringAnalysis',y=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         ## Clean the output files first
-        clean_for_clustering(self.combined_cell_metrics_file,self.combined_count_file)
+        sparse = config().count_output_format == "sparse"
+        clean_for_clustering(self.combined_cell_metrics_file,None if sparse else self.combined_count_file)
 
         ## Calculate some statistics for running the appropriate normalization
-        cell_stats,num_genes,num_ercc,num_umis_genes,num_umis_ercc = calc_stats_gene_count(self.combined_count_file)
+        cell_stats,num_genes,num_ercc,num_umis_genes,num_umis_ercc = calc_stats_gene_count(
+            self.count_input if sparse else self.combined_count_file)
         num_cells     = len(cell_stats)
         median_ercc   = calc_median_cell_metrics(cell_stats,'umis_ercc',cells_to_drop = [], drop_outlier_cells=True)
         median_genes  = calc_median_cell_metrics(cell_stats,'umis_genes',cells_to_drop = [], drop_outlier_cells=True)
@@ -618,12 +1146,14 @@ class ClusteringAnalysis(luigi.Task):
             ## Run clustering analysis
             if median_ercc < 100:
                 logger.info("Running scran script with no ercc normalization")
-                run_cmd(self.cmd_scran_low_ercc)
+                with stage("R clustering"):
+                    run_cmd(self.cmd_scran_low_ercc)
                 normalization = "total-UMIs"
                 hvg = "N/A"
             else:
                 try:
-                    run_cmd(self.cmd_basics)
+                    with stage("R clustering"):
+                        run_cmd(self.cmd_basics)
                     normalization = "BASiCS"
                     hvg = "BASiCS"
                 except subprocess.CalledProcessError as e1:
@@ -638,7 +1168,8 @@ class ClusteringAnalysis(luigi.Task):
                                 run_cmd("mv {old} {new}".format(old=clustering_out,new=clustering_out+"_basics_failed"))
                             if os.path.exists(misc_out):
                                 run_cmd("mv {old} {new}".format(old=misc_out,new=misc_out+"_basics_failed"))
-                            run_cmd(self.cmd_scran)
+                            with stage("R clustering"):
+                                run_cmd(self.cmd_scran)
                         except Exception as e2:
                             raise(Exception(e2))
                     else: ## Raise Exception if failed for reasons other than MCMC
@@ -656,7 +1187,8 @@ class ClusteringAnalysis(luigi.Task):
         
         ## Create Run level summary file
         metrics_from_countfile = (cell_stats,num_genes,num_ercc,num_umis_genes,num_umis_ercc)
-        write_run_summary(self.run_summary_file,has_clustering_run,self.runid,config().seqtype,config().species,config().genome,config().annotation,self.samples_cfg,self.combined_sample_metrics_file,self.combined_cell_metrics_file,cells_dropped_file,metrics_from_countfile,normalization,hvg)
+        with stage("run summary"):
+            write_run_summary(self.run_summary_file,has_clustering_run,self.runid,config().seqtype,config().species,config().genome,config().annotation,self.samples_cfg,self.combined_sample_metrics_file,self.combined_cell_metrics_file,cells_dropped_file,metrics_from_countfile,normalization,hvg)
         # Add pdf file to run directory
         ## run_cmd("cp /srv/qgen/code/qiaseq-singlecell-rna/QIAseqUltraplexRNA_README.pdf {}".format(self.output_dir))
         with open(self.verification_file,'w') as IN:
@@ -702,6 +1234,8 @@ class WriteExcelSheet(luigi.Task):
         self.verification_file = os.path.join(self.target_dir,
                                               self.__class__.__name__+
                                               '.verification.txt')
+        ## The resource profile of the run , written once this last task is done
+        self.run_profile_file = os.path.join(self.target_dir,'QIAseqUltraplexRNA_{}_profile.json'.format(self.runid))
         if config().seqtype.upper() == 'WTS':
             self.files_to_write = [self.combined_sample_metrics_file,self.combined_cell_metrics_file,self.combined_count_file]
         else:
@@ -716,18 +1250,27 @@ class WriteExcelSheet(luigi.Task):
     def run(self):
         ''' Work to be done here is writing the excel workbook
         '''
+        from create_excel_sheet import write_excel_workbook
+        from create_run_summary import write_run_summary,calc_stats_gene_count
+        from sparse_counts import export_dense
         logger.info("Starting Task: {x} {y}".format(x='WriteExcelSheet',y=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))        
         if config().catalog_number.startswith("polyA"):
             catalog_number = None
         else:
             catalog_number = config().catalog_number
-        write_excel_workbook(self.files_to_write,self.combined_workbook,catalog_number,config().species)
+        with stage("excel"):
+            if config().count_output_format == "sparse": ## The workbook needs the dense count files
+                export_dense(self.combined_count_file,True)
+                if config().seqtype.upper() != 'WTS':
+                    export_dense(self.combined_count_file_primers,False)
+            write_excel_workbook(self.files_to_write,self.combined_workbook,catalog_number,config().species)
         ## Create Run level summary file
-        cell_stats,num_genes,num_ercc,num_umis_genes,num_umis_ercc = calc_stats_gene_count(self.combined_count_file)
-        metrics_from_countfile = (cell_stats,num_genes,num_ercc,num_umis_genes,num_umis_ercc)
-        has_clustering_run = False
-        write_run_summary(self.run_summary_file,has_clustering_run,self.runid,config().seqtype,config().species,config().genome,config().annotation,
-                          self.samples_cfg,self.combined_sample_metrics_file,self.combined_cell_metrics_file,None,metrics_from_countfile,None,None)
+        with stage("run summary"):
+            cell_stats,num_genes,num_ercc,num_umis_genes,num_umis_ercc = calc_stats_gene_count(self.combined_count_file)
+            metrics_from_countfile = (cell_stats,num_genes,num_ercc,num_umis_genes,num_umis_ercc)
+            has_clustering_run = False
+            write_run_summary(self.run_summary_file,has_clustering_run,self.runid,config().seqtype,config().species,config().genome,config().annotation,
+                              self.samples_cfg,self.combined_sample_metrics_file,self.combined_cell_metrics_file,None,metrics_from_countfile,None,None)
         # Add pdf file to run directory
         ## run_cmd("cp /srv/qgen/code/qiaseq-singlecell-rna/QIAseqUltraplexRNA_README.pdf {}".format(self.output_dir))        
         with open(self.verification_file,'w') as IN:
@@ -739,3 +1282,54 @@ class WriteExcelSheet(luigi.Task):
         ''' The output from this task is to check the verification file
         '''
         return luigi.LocalTarget(self.verification_file)
+
+def run_settings(task):
+    ''' The settings kept with the run profile , those tuned with it
+    :param object task: the last task of the run , ClusteringAnalysis or WriteExcelSheet
+    :rtype OrderedDict
+    '''
+    settings = OrderedDict([('num_cores',task.num_cores)])
+    for name in ['buffer_size','demux_mode','demux_chunks_in_flight','demux_autotune','demux_memory_budget',
+                 'demux_autotune_chunks','demux_writer_threads','demux_compression',
+                 'demux_decompress_threads','demux_shared_memory','demux_output','star_align_per_sample',
+                 'star_shared_genome','cells_per_task','count_chunk_size','umi_dedup','count_output_format']:
+        settings[name] = getattr(config(),name)
+    return settings
+
+@luigi.Task.event_handler(luigi.Event.START)
+def start_profile(task):
+    ''' Start the resource profile of a task , in the process running it , see core/profiling.py
+    :param object task: the task
+    '''
+    if hasattr(task,'verification_file'):
+        start_task(task.get_task_family(),task.to_str_params(only_significant=True))
+
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+def write_profile(task):
+    ''' Write the resource profile of a task next to its verification file , and
+    the profile of the run once its last task is done. Then log , and close in a
+    task process , the worker pools , see core/executor.py
+    :param object task: the task
+    '''
+    if hasattr(task,'verification_file'):
+        finish_task(profile_file(task.verification_file))
+        if hasattr(task,'run_profile_file'):
+            write_run_profile(task.output_dir,task.run_profile_file,run_settings(task))
+            logger.info("Wrote the run profile : {}".format(task.run_profile_file))
+    end_pools()
+
+@luigi.Task.event_handler(luigi.Event.FAILURE)
+def close_pools(task,exception):
+    ''' Log , and close in a task process , the worker pools of a failed task , see core/executor.py
+    :param object task: the task
+    :param Exception exception: the error raised by the task
+    '''
+    end_pools()
+
+def end_pools():
+    ''' End of a task , log the usage of the worker pools and close them in a task process ,
+    see core/executor.py end_task
+    '''
+    executor = sys.modules.get('executor') ## no pools unless the stages of the task imported it
+    if executor is not None:
+        executor.end_task(logger)
@@ -0,0 +1,157 @@
+'''
+Check that the vectorised gene assignment (gene_index.assign_genes) agrees with
+find_gene read by read , on a toy annotation and a BAM of reads picked for the
+rules of find_gene : unmapped reads , ERCC reads on and off their locus , both
+strands , reads overlapping several genes (ties on the 5' distance and the overlap)
+and reads whose hits do not overlap them by a single base.
+
+Usage : python -m unittest discover tests
+'''
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','core'))
+import pysam
+from create_annotation_tables import create_gene_index
+from find_gene import find_gene
+from gene_index import GeneIndex,assign_genes,UNMAPPED,UNKNOWN,UNKNOWN_CHROM
+from count_umi import iterate_bam_columns,iterate_bam_reads,read_slice,read_tuples
+
+## find_gene result for each assign_genes code
+CODE_NAMES = {UNMAPPED:'Unmapped',UNKNOWN:'Unknown',UNKNOWN_CHROM:'Unknown_Chrom'}
+
+## chrom , start , end , strand , gene
+GENES = [('chr1',1000,2000,'+','GA'),
+         ('chr1',1000,3000,'+','GB'),
+         ('chr1',1500,2500,'+','GC'),
+         ('chr1',5000,6000,'+','GD'),
+         ('chr1',5500,6000,'+','GE'),
+         ('chr1',8000,9000,'+','GF'),
+         ('chr1',1000,2000,'-','RA'),
+         ('chr1',1200,2000,'-','RB'),
+         ('chr2',100,400,'+','GG'),
+         ('chrUn_gl000220',100,500,'+','GU')] ## a contig , skipped for human
+ERCCS = [('ERCC-00001',1,1000)]
+## name , chrom (None if unmapped) , 0-based start , cigar , is_reverse , expected gene or outcome
+READS = [('unmapped',None,0,None,False,'Unmapped'),
+         ('single',"chr1",8100,"50M",False,'GF'),
+         ('tie',"chr1",1100,"50M",False,'GA'), ## same 5' distance and overlap , the first hit
+         ('closer_five_prime',"chr1",1600,"50M",False,'GC'),
+         ('spliced',"chr1",900,"5S60M500N40M",False,'GA'),
+         ('insertion',"chr1",1580,"20M3I27M",False,'GC'),
+         ('first_hit_no_overlap',"chr1",2000,"50M",False,'GC'), ## at the end of GA
+         ('no_overlap_all_hits',"chr1",6000,"30M",False,'Unknown'),
+         ('no_overlap_single_hit',"chr1",9000,"30M",False,'GF'),
+         ('no_gene',"chr1",30000,"50M",False,'Unknown'),
+         ('reverse_single',"chr1",1100,"50M",True,'RA'),
+         ('reverse_tie',"chr1",1300,"50M",True,'RA'),
+         ('reverse_less_overlap',"chr1",1180,"40M",True,'RB'), ## same 5' distance , less overlap
+         ('reverse_no_gene',"chr2",150,"50M",True,'Unknown'),
+         ('other_chrom',"chr2",150,"50M",False,'GG'),
+         ('not_annotated',"chr3",100,"50M",False,'Unknown'),
+         ('contig',"chrUn_gl000220",150,"50M",False,'Unknown'),
+         ('ercc_on_locus',"ERCC-00001",100,"50M",False,'ERCC-00001'),
+         ('ercc_on_locus_reverse',"ERCC-00001",200,"50M",True,'ERCC-00001'),
+         ('ercc_off_locus',"ERCC-00001",2000,"50M",False,'Unknown_Chrom'),
+         ('ercc_not_in_bed',"ERCC-00002",100,"50M",False,'Unknown_Chrom')]
+CHROMS = [('chr1',100000),('chr2',1000),('chr3',1000),('chrUn_gl000220',1000),('ERCC-00001',5000),('ERCC-00002',5000)]
+
+def write_fixture(work_dir):
+    ''' Write the toy gtf , ERCC bed and sorted BAM
+    :param str work_dir: the directory to write to
+    :returns (gtf , bed , bam)
+    :rtype tuple
+    '''
+    gtf = os.path.join(work_dir,'genes.gtf')
+    with open(gtf,'w') as OUT:
+        OUT.write('#toy annotation\n')
+        for chrom,start,end,strand,gene in GENES:
+            attributes = 'gene_id "ENSG_{g}"; gene_type "protein_coding"; gene_name "{g}";'.format(g=gene)
+            OUT.write('\t'.join([chrom,'test','gene',str(start),str(end),'.',strand,'.',attributes])+'\n')
+    bed = os.path.join(work_dir,'ercc.bed')
+    with open(bed,'w') as OUT:
+        for ercc,start,end in ERCCS:
+            OUT.write('\t'.join([ercc,str(start),str(end),'ACGTACGTAC','+',ercc])+'\n')
+    bam = os.path.join(work_dir,'Aligned.sortedByCoord.out.bam')
+    tids = dict((chrom,i) for i,(chrom,length) in enumerate(CHROMS))
+    header = {'HD':{'VN':'1.4','SO':'coordinate'},'SQ':[{'SN':chrom,'LN':length} for chrom,length in CHROMS]}
+    ## sorted by coordinate , the unmapped reads last
+    reads = sorted(READS,key=lambda read:(read[1] is None,tids.get(read[1]),read[2]))
+    with pysam.AlignmentFile(bam,'wb',header=header) as OUT:
+        for name,chrom,pos,cigar,is_reverse,expected in reads:
+            read = pysam.AlignedSegment()
+            read.query_name = name+':ACGTACGTACGT'
+            read.query_sequence = 'A'*50
+            if chrom is None:
+                read.flag = 4
+                read.reference_id = -1
+                read.reference_start = -1
+            else:
+                read.flag = 16 if is_reverse else 0
+                read.reference_id = tids[chrom]
+                read.reference_start = pos
+                read.cigarstring = cigar
+                read.query_sequence = 'A'*read.infer_query_length()
+                read.mapping_quality = 255
+            read.set_tag('NH',1)
+            OUT.write(read)
+    return (gtf,bed,bam)
+
+class TestAssignGenes(unittest.TestCase):
+    ''' assign_genes against find_gene on the toy fixture
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp()
+        gtf,bed,cls.bam = write_fixture(cls.work_dir)
+        cls.gene_index = create_gene_index(gtf,bed,'human')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.work_dir)
+
+    def assign(self,gene_index):
+        ''' Annotate the reads of the BAM both ways , as count_umi reads them
+        :param GeneIndex gene_index: the gene index
+        :returns (read name -> find_gene result , read name -> (assign_genes code , ercc))
+        :rtype tuple
+        '''
+        chunk = next(iterate_bam_reads(self.bam,names=True))
+        expected = dict((read[0].split(':')[0],find_gene(gene_index,read))
+                        for read in read_tuples(read_slice(chunk,0,len(chunk.tid))))
+        columns = next(iterate_bam_columns(self.bam))
+        codes,ercc = assign_genes(gene_index,columns.ref_names,columns.tid,columns.pos,columns.end,columns.is_reverse)
+        names = [read[0].split(':')[0] for read in read_tuples(read_slice(chunk,0,len(chunk.tid)))]
+        observed = dict(zip(names,zip(codes.tolist(),ercc.tolist())))
+        return (expected,observed)
+
+    def check(self,gene_index):
+        ''' Both ways agree on every read , and on the gene expected for each case
+        :param GeneIndex gene_index: the gene index
+        '''
+        expected,observed = self.assign(gene_index)
+        self.assertEqual(sorted(expected),sorted(read[0] for read in READS))
+        for name,chrom,pos,cigar,is_reverse,gene in READS:
+            gene_info,mt,count,nh = expected[name]
+            code,is_ercc = observed[name]
+            observed_info = CODE_NAMES[code] if code < 0 else gene_index.genes[code]
+            observed_count = 0 if code < 0 or is_ercc else 1
+            self.assertEqual(observed_info,gene_info,name)
+            self.assertEqual(observed_count,count,name)
+            self.assertEqual(is_ercc,chrom is not None and chrom.startswith('ERCC'),name)
+            self.assertEqual(gene_info[1] if isinstance(gene_info,tuple) else gene_info,gene,name)
+
+    def test_assign_genes_matches_find_gene(self):
+        self.check(self.gene_index)
+
+    def test_cached_index(self):
+        ''' The index rebuilt from its columns , as loaded from the annotation cache
+        '''
+        self.check(GeneIndex.from_columns(self.gene_index.to_columns()))
+
+if __name__ == '__main__':
+    unittest.main()